@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+import argparse
+
+from bam_manipulation.barcode_coverage import barcode_coverage, estimate_barcode_coverage, write_coverage_results
+
+
+def key_value(arg):
+    key, value = arg.split("=", 1)
+    return key, value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Count reads whose cell barcode is in the barcode mapping, per sample")
+    parser.add_argument("mapping", help="Barcode mapping CSV with sample and cell_barcode columns (e.g. cc_barcode.csv)")
+    parser.add_argument("--bam", type=key_value, action="append", required=True, metavar="SAMPLE=BAM",
+                        help="Sample name and indexed BAM, e.g. Mira_1=cellranger_count_Sm/Mira_1/outs/possorted_genome_bam.bam")
+    parser.add_argument("--sample-map", type=key_value, action="append", default=[], metavar="SAMPLE=MAPPING_SAMPLE",
+                        help="Value of the mapping's sample column for a sample, e.g. Mira_1=sample4")
+    parser.add_argument("--processes", type=int, default=4, help="Worker processes shared by all samples (default: 4)")
+    parser.add_argument("--shard-size", type=int, help="Split contigs into shards of at most this many bp")
+    parser.add_argument("--output", default="barcode_coverage_parallel_results.csv", help="Summary CSV (default: %(default)s)")
+    parser.add_argument("--barcode-counts", help="Optional CSV of matched reads per sample and barcode")
+    parser.add_argument("--checkpoint", help="Record finished shards here so a rerun after the job is killed resumes")
+    parser.add_argument("--estimate", type=float, metavar="FRACTION",
+                        help="Estimate from this fraction of randomly chosen index windows, with confidence intervals")
+    parser.add_argument("--window-size", type=int, default=100_000, help="Window length in bp for --estimate (default: %(default)s)")
+    parser.add_argument("--confidence", type=float, default=0.95, help="Confidence level for --estimate (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for --estimate (default: %(default)s)")
+    args = parser.parse_args()
+    if args.estimate is not None and not 0 < args.estimate <= 1:
+        parser.error("--estimate must be a fraction in (0, 1]")
+    if not 0 < args.confidence < 1:
+        parser.error("--confidence must be between 0 and 1")
+
+    if args.estimate is not None:
+        results = estimate_barcode_coverage(dict(args.bam), args.mapping, sample_map=dict(args.sample_map),
+                                            fraction=args.estimate, window_size=args.window_size,
+                                            confidence=args.confidence, seed=args.seed, processes=args.processes)
+    else:
+        results = barcode_coverage(dict(args.bam), args.mapping, sample_map=dict(args.sample_map),
+                                   processes=args.processes, shard_size=args.shard_size,
+                                   checkpoint=args.checkpoint)
+    write_coverage_results(results, args.output, args.barcode_counts)
+    for result in results:
+        print(result.to_row())
+    print(f"✅ All samples processed. Results saved to {args.output}")
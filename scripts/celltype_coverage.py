@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+import argparse
+
+from bam_manipulation.celltype_coverage import celltype_coverage
+
+
+def key_value(arg):
+    key, value = arg.split("=", 1)
+    return key, value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per-cell-type coverage tracks (bedGraph and sliceable arrays) from unsplit sample BAMs")
+    parser.add_argument("mapping", help="Barcode mapping CSV with sample, cell_barcode and Cluster columns (e.g. cc_barcode.csv)")
+    parser.add_argument("output_dir", help="Directory for {celltype}.bedgraph tracks, arrays and coverage.json")
+    parser.add_argument("--bam", type=key_value, action="append", required=True, metavar="SAMPLE=BAM",
+                        help="Sample name and indexed BAM, e.g. Mira_1=cellranger_count_Sm/Mira_1/outs/possorted_genome_bam.bam")
+    parser.add_argument("--sample-map", type=key_value, action="append", default=[], metavar="SAMPLE=MAPPING_SAMPLE",
+                        help="Value of the mapping's sample column for a sample, e.g. Mira_1=sample4")
+    parser.add_argument("--bin-size", type=int, default=10, help="Bin width in bp; 1 for per-base depth (default: %(default)s)")
+    parser.add_argument("--processes", type=int, default=4, help="Worker processes, one contig each (default: %(default)s)")
+    parser.add_argument("--min-mapq", type=int, default=0, help="Minimum mapping quality (default: %(default)s)")
+    parser.add_argument("--bigwig", action="store_true", help="Also write {celltype}.bw (requires pyBigWig)")
+    args = parser.parse_args()
+
+    tracks = celltype_coverage(dict(args.bam), args.mapping, args.output_dir, sample_map=dict(args.sample_map),
+                               bin_size=args.bin_size, processes=args.processes, min_mapq=args.min_mapq,
+                               bigwig=args.bigwig)
+    for celltype in tracks.celltypes:
+        print(f"✅ {celltype}: {tracks.reads[celltype]} reads -> {tracks.bedgraph(celltype)}")
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+import argparse
+
+from bam_manipulation.junction_matrix import junction_matrix
+
+
+def key_value(arg):
+    key, value = arg.split("=", 1)
+    return key, value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Count splice junction reads per cell type or barcode from unsplit sample BAMs")
+    parser.add_argument("mapping", help="Barcode mapping CSV with sample, cell_barcode and Cluster columns (e.g. cc_barcode.csv)")
+    parser.add_argument("--bam", type=key_value, action="append", required=True, metavar="SAMPLE=BAM",
+                        help="Sample name and indexed BAM, e.g. Mira_1=cellranger_count_Sm/Mira_1/outs/possorted_genome_bam.bam")
+    parser.add_argument("--sample-map", type=key_value, action="append", default=[], metavar="SAMPLE=MAPPING_SAMPLE",
+                        help="Value of the mapping's sample column for a sample, e.g. Mira_1=sample4")
+    parser.add_argument("--by", choices=["celltype", "barcode"], default="celltype", help="Matrix columns (default: %(default)s)")
+    parser.add_argument("--processes", type=int, default=4, help="Worker processes shared by all samples (default: 4)")
+    parser.add_argument("--shard-size", type=int, help="Split contigs into shards of at most this many bp")
+    parser.add_argument("--output", default="junction_counts.npz", help="Output .npz (default: %(default)s)")
+    args = parser.parse_args()
+
+    matrix = junction_matrix(dict(args.bam), args.mapping, sample_map=dict(args.sample_map), by=args.by,
+                             processes=args.processes, shard_size=args.shard_size)
+    matrix.save(args.output)
+    print(f"✅ {matrix.shape[0]} junctions x {matrix.shape[1]} {args.by} columns saved to {args.output}")
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+import argparse
+
+from plotting.batch import load_gene_regions, plot_regions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plot cell-type junction BEDs over many regions or genes with pyGenomeTracks")
+    parser.add_argument("bed_files", nargs="+", help="Cell-type BED files, one track each (e.g. *.filtered.bed)")
+    parser.add_argument("--region", action="append", default=[], help="Region contig:start-end (repeatable)")
+    parser.add_argument("--genes", help="Gene table with 'Gene ID' and 'Genomic Coordinates' columns; all genes are "
+                                        "plotted unless --gene is given (e.g. analysis/genes_of_interest.csv)")
+    parser.add_argument("--gene", action="append", default=[], help="Gene ID from --genes to plot (repeatable)")
+    parser.add_argument("--colormaps", nargs="+", help="One colour(map) per BED file")
+    parser.add_argument("--titles", nargs="+", help="One title per BED file (default: file name)")
+    parser.add_argument("--gene-file", help="Gene/CDS BED drawn above the cell-type tracks")
+    parser.add_argument("--min-score", type=float, default=0)
+    parser.add_argument("--max-score", type=float, default=1000)
+    parser.add_argument("--output-dir", default=".", help="Output directory for PNGs (default: .)")
+    parser.add_argument("--processes", type=int, default=4, help="Concurrent pyGenomeTracks processes (default: 4)")
+    parser.add_argument("--cache-dir", default=".plot_cache", help="Image cache directory (default: %(default)s)")
+    parser.add_argument("--no-preslice", action="store_true", help="Give pyGenomeTracks the whole BED files")
+    parser.add_argument("--padding", type=int, default=10_000, help="Bases kept either side of each region when "
+                                                                   "pre-slicing (default: %(default)s)")
+    parser.add_argument("--index-dir", default=".track_index",
+                        help="Directory for indexed BED copies (default: %(default)s)")
+    args = parser.parse_args()
+
+    gene_regions = load_gene_regions(args.genes) if args.genes else {}
+    regions = args.region + (args.gene or list(gene_regions) if args.genes else [])
+    if not regions:
+        parser.error("nothing to plot: give --region and/or --genes")
+    tracks = {"bed_files": args.bed_files, "titles": args.titles, "gene_file": args.gene_file,
+              "min_score": args.min_score, "max_score": args.max_score}
+    if args.colormaps:
+        tracks["colormaps"] = args.colormaps
+    outputs = plot_regions(regions, output_dir=args.output_dir, processes=args.processes, cache_dir=args.cache_dir,
+                           gene_regions=gene_regions, preslice=not args.no_preslice, padding=args.padding,
+                           index_dir=args.index_dir, **tracks)
+    print(f"✅ {len(outputs)} plots saved to: {args.output_dir}")
@@ -1,11 +1,20 @@
 #!/usr/bin/env python3
-import sys
+import argparse
 
-from bam_manipulation.rs_bam_handling import bamTagHandling
+from bam_manipulation.rs_bam_handling import CHECKPOINT_SHARD_SIZE, bamTagHandling
 
 
 if __name__ == "__main__":
-    in_bam = sys.argv[1]
-    mapping = sys.argv[2]
-    output = sys.argv[3]
-    bamTagHandling(in_bam, mapping=mapping, output=output, unmapped=True, untagged=True)
+    parser = argparse.ArgumentParser(description="Split a BAM by cell type of its CB tag, resuming from a checkpoint if killed")
+    parser.add_argument("in_bam", help="Coordinate-sorted, indexed BAM")
+    parser.add_argument("mapping", help="Mapping file with Cluster and cell_barcode columns")
+    parser.add_argument("output", help="Output prefix; files are written to {output}_files")
+    parser.add_argument("processes", type=int, nargs="?", default=1, help="Worker processes (default: %(default)s)")
+    # e.g. "celltype/IC" to split each cell type by isoform cluster in the same pass
+    parser.add_argument("keyExpression", nargs="?", help="Composite key to split on, e.g. celltype/IC")
+    parser.add_argument("--shard-size", type=int, default=CHECKPOINT_SHARD_SIZE,
+                        help="Shard length in bp, which is also the checkpoint interval (default: %(default)s)")
+    args = parser.parse_args()
+
+    bamTagHandling(args.in_bam, mapping=args.mapping, output=args.output, unmapped=True, untagged=True,
+                   processes=args.processes, shardSize=args.shard_size, checkpoint=True, keyExpression=args.keyExpression)
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+import argparse
+
+from bam_manipulation.split_merge_by_celltype import split_merge_by_celltype
+
+
+def key_value(arg):
+    key, value = arg.split("=", 1)
+    return key, value
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Split sample BAMs by cell type and merge across samples in one pass")
+    parser.add_argument("mapping", help="Barcode mapping CSV with sample, cell_barcode and Cluster columns (e.g. cc_barcode.csv)")
+    parser.add_argument("output_dir", help="Directory for merged {celltype}.bam outputs")
+    parser.add_argument("--bam", type=key_value, action="append", required=True, metavar="SAMPLE=BAM",
+                        help="Sample name and coordinate-sorted BAM, e.g. Mira_1=Mira_1/outs/possorted_genome_bam.bam")
+    parser.add_argument("--sample-map", type=key_value, action="append", default=[], metavar="SAMPLE=MAPPING_SAMPLE",
+                        help="Value of the mapping's sample column for a sample, e.g. Mira_1=sample4")
+    parser.add_argument("--intermediates", help="Also write {sample}_files/{sample}_{celltype}.bam under this directory")
+    parser.add_argument("--threads", type=int, default=1, help="BGZF compression threads per output")
+    args = parser.parse_args()
+
+    counts = split_merge_by_celltype(dict(args.bam), args.mapping, args.output_dir, sample_map=dict(args.sample_map),
+                                     intermediate_dir=args.intermediates, threads=args.threads)
+    for celltype, n in counts.items():
+        print(f"{celltype} : {n} reads")
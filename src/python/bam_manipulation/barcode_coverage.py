@@ -0,0 +1,348 @@
+# pylint: disable=no-member
+"""
+Module: barcode_coverage
+
+Counts, per sample, how many reads carry a cell barcode from the barcode
+mapping. Each sample BAM is split into region shards that are counted in a
+shared process pool. Only the cell barcode tag is read, and barcodes are
+matched a block of reads at a time against a packed ``BarcodeIndex``. A mapping
+file is compiled once into the mapping cache (see ``mapping_registry``), and
+workers memory-map its barcode index instead of each receiving a copy.
+
+``estimate_barcode_coverage`` gives the same figures, with confidence intervals,
+from a random sample of index windows instead of every read.
+"""
+
+import math
+import os
+from collections import Counter
+from dataclasses import dataclass, field
+from itertools import islice
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+import pysam
+
+from bam_manipulation.barcodes import BarcodeIndex, read_blocks
+from bam_manipulation.checkpoint import ShardCheckpoint, digest, file_fingerprint, map_shards_checkpointed
+from bam_manipulation.instrumentation import instrumented
+from bam_manipulation.sharding import region_shards, fetch_shard, map_shards, UNPLACED
+from bam_manipulation.mapping_registry import CompiledMapping, load_mapping
+
+
+@dataclass
+class CoverageResult:
+    """
+    Barcode coverage of one sample.
+
+    Attributes:
+        sample (str): Sample name.
+        total_reads (int): All records in the BAM, including unmapped reads.
+        matched_reads (int): Reads whose barcode is in the sample's mapping.
+        untagged_reads (int): Reads without a barcode tag.
+        barcode_counts (Counter): Matched reads per barcode.
+    """
+    sample: str
+    total_reads: int = 0
+    matched_reads: int = 0
+    untagged_reads: int = 0
+    barcode_counts: Counter = field(default_factory=Counter)
+
+    @property
+    def unmapped_reads(self):
+        """Reads with a barcode tag that is not in the mapping."""
+        return self.total_reads - self.matched_reads - self.untagged_reads
+
+    @property
+    def coverage_pct(self):
+        return (self.matched_reads / self.total_reads * 100) if self.total_reads > 0 else 0
+
+    def update(self, other):
+        """Add the counts of a partial result for the same sample."""
+        self.total_reads += other.total_reads
+        self.matched_reads += other.matched_reads
+        self.untagged_reads += other.untagged_reads
+        self.barcode_counts.update(other.barcode_counts)
+
+    def to_row(self):
+        """Summary row in the layout of ``barcode_coverage_parallel_results.csv``."""
+        return {
+            "Sample": self.sample,
+            "Total Reads": self.total_reads,
+            "Matched Barcodes": self.matched_reads,
+            "Coverage (%)": round(self.coverage_pct, 2),
+        }
+
+
+@dataclass
+class CoverageEstimate(CoverageResult):
+    """
+    Barcode coverage of one sample estimated from sampled reads (see ``estimate_barcode_coverage``).
+
+    ``total_reads`` is exact, taken from the BAM index; ``matched_reads`` and ``untagged_reads`` (and so
+    ``unmapped_reads``) are estimates for the whole BAM. ``barcode_counts`` holds the sampled reads only.
+
+    Attributes:
+        sampled_reads (int): Reads counted.
+        confidence (float): Confidence level of the intervals, e.g. 0.95.
+        matched_ci, untagged_ci, unmapped_ci (tuple): (low, high) bounds of the read counts.
+    """
+    sampled_reads: int = 0
+    confidence: float = 0.95
+    matched_ci: tuple = (0, 0)
+    untagged_ci: tuple = (0, 0)
+    unmapped_ci: tuple = (0, 0)
+
+    @property
+    def sampled_fraction(self):
+        return self.sampled_reads / self.total_reads if self.total_reads > 0 else 0
+
+    def to_row(self):
+        """Summary row of a full scan, followed by the coverage interval and the sampled fraction."""
+        row = super().to_row()
+        low, high = (n / self.total_reads * 100 if self.total_reads > 0 else 0 for n in self.matched_ci)
+        row.update({
+            "Coverage CI Low (%)": round(low, 2),
+            "Coverage CI High (%)": round(high, 2),
+            "Sampled (%)": round(self.sampled_fraction * 100, 2),
+        })
+        return row
+
+
+def _barcode_index(mapping, mapping_sample):
+    if isinstance(mapping, CompiledMapping):
+        return mapping.index(mapping_sample)[0]
+    return BarcodeIndex(mapping.get(mapping_sample, {}))
+
+
+def _count_shard(task):
+    sample, bam_path, shard, barcode_index, sort_target, max_reads = task
+    result = CoverageResult(sample)
+    hits = np.zeros(len(barcode_index), dtype=np.int64)
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        for block, barcodes in read_blocks(islice(fetch_shard(bam, shard), max_reads), sort_target):
+            result.total_reads += len(block)
+            result.untagged_reads += barcodes.count(None)
+            pos = barcode_index.find(barcodes)
+            hits += np.bincount(pos[pos >= 0], minlength=len(hits))
+    result.matched_reads = int(hits.sum())
+    keys = barcode_index.keys()
+    result.barcode_counts.update({keys[i]: int(hits[i]) for i in np.flatnonzero(hits)})
+    return result
+
+
+def _encode_result(result):
+    return [result.sample, result.total_reads, result.matched_reads, result.untagged_reads, dict(result.barcode_counts)]
+
+
+def _decode_result(record):
+    sample, total_reads, matched_reads, untagged_reads, barcode_counts = record
+    return CoverageResult(sample, total_reads, matched_reads, untagged_reads, Counter(barcode_counts))
+
+
+@instrumented("barcode_coverage")
+def barcode_coverage(sample_bams, mapping, sample_map=None, processes=1, shard_size=None, sort_target="CB",
+                     checkpoint=None, instrument=None, **mapping_kwargs):
+    """
+    Count reads matching each sample's barcodes across all samples.
+
+    Args:
+        sample_bams (dict): Mapping {sample_name: bam_path}; BAMs must be coordinate-sorted and indexed.
+        mapping (str, dict or CompiledMapping): Path to a mapping file with a sample column (e.g. ``cc_barcode.csv``)
+            or its compiled directory, a ``CompiledMapping``, or {mapping_sample: {barcode: celltype}}.
+        sample_map (dict, optional): Mapping {sample_name: mapping_sample}, e.g. {"Mira_1": "sample4"}.
+        processes (int): Worker processes shared by the shards of all samples.
+        shard_size (int, optional): Maximum shard length in bp (default: one shard per contig).
+        sort_target (str): Tag holding the cell barcode (default CB).
+        checkpoint (str, optional): Record the counts of each finished shard in this file, so a rerun after the
+            job is killed only counts the missing shards. Removed once all shards are counted.
+        instrument (Instrumentation, optional): Records throughput, stage timings and memory (default: configured
+            from the environment, see ``bam_manipulation.instrumentation``).
+        **mapping_kwargs: Column names and delimiter passed to ``mapping_registry.compile_mapping``.
+
+    Returns:
+        list: One ``CoverageResult`` per sample, in the order of ``sample_bams``.
+    """
+    with instrument.stage("load_mapping"):
+        if not isinstance(mapping, dict):
+            mapping = load_mapping(mapping, **mapping_kwargs)
+    sample_map = sample_map or {}
+    instrument.add_input(*sample_bams.values())
+
+    tasks, shards = [], []
+    for sample, bam_path in sample_bams.items():
+        barcode_index = _barcode_index(mapping, sample_map.get(sample, sample))
+        for shard in region_shards(str(bam_path), shard_size):
+            tasks.append((sample, str(bam_path), shard, barcode_index, sort_target, None))
+            shards.append(shard)
+
+    if checkpoint is not None:
+        checkpoint = ShardCheckpoint(checkpoint, {
+            "bams": {sample: file_fingerprint(bam_path) for sample, bam_path in sample_bams.items()},
+            "mapping": (mapping.digest if isinstance(mapping, CompiledMapping)
+                        else digest({sample: digest(barcodes) for sample, barcodes in mapping.items()})),
+            "sample_map": sample_map, "shard_size": shard_size, "sort_target": sort_target})
+
+    results = {sample: CoverageResult(sample) for sample in sample_bams}
+    with instrument.stage("count"), instrument.profiled():
+        partials = map_shards_checkpointed(
+            _count_shard, tasks, shards, processes, checkpoint, encode=_encode_result, decode=_decode_result,
+            on_result=lambda partial: instrument.progress(reads=partial.total_reads))
+    for partial in partials:
+        results[partial.sample].update(partial)
+    if checkpoint is not None:
+        checkpoint.remove()
+    return list(results.values())
+
+
+def _window_ratio(y, t, n_windows):
+    """
+    Ratio estimate sum(y) / sum(t) over sampled windows, and its variance (cluster sampling).
+
+    Both are nan if fewer than two sampled windows hold reads, too few to estimate the variance from,
+    unless every window was sampled.
+    """
+    if len(t) == n_windows:
+        return (y.sum() / t.sum() if t.sum() else 0.0), 0.0
+    if np.count_nonzero(t) < 2:
+        return math.nan, math.nan
+    ratio = y.sum() / t.sum()
+    residual_var = ((y - ratio * t) ** 2).sum() / (len(t) - 1)
+    return ratio, (1 - len(t) / n_windows) * residual_var / (len(t) * t.mean() ** 2)
+
+
+def _read_ratio(y, k, n_reads):
+    """Proportion y / k among k of n_reads reads, and its variance."""
+    if k == 0:
+        return 0.0, 0.0
+    ratio = y / k
+    if k < 2:
+        return ratio, 0.0
+    return ratio, (1 - k / n_reads) * ratio * (1 - ratio) / (k - 1)
+
+
+@instrumented("estimate_barcode_coverage")
+def estimate_barcode_coverage(sample_bams, mapping, sample_map=None, fraction=0.01, window_size=100_000,
+                              min_windows=30, min_unplaced=10_000, confidence=0.95, seed=0, processes=1, sort_target="CB",
+                              instrument=None, **mapping_kwargs):
+    """
+    Estimate ``barcode_coverage`` from a random sample of index windows instead of every read.
+
+    Read totals come from the BAM index. Reads with a position are sampled as whole windows of
+    ``window_size`` bp, chosen at random across the sample's contigs, and the matched and untagged
+    proportions are ratio estimates over the windows. Reads without a position (the unplaced section
+    at the end of the BAM) cannot be reached through the index. They are estimated separately from the
+    first reads of that section, or counted in full if there are no more than ``min_unplaced``.
+    Intervals use the normal approximation and are clipped to the possible counts.
+
+    Args:
+        sample_bams (dict): Mapping {sample_name: bam_path}; BAMs must be coordinate-sorted and indexed.
+        mapping (str, dict or CompiledMapping): As for ``barcode_coverage``.
+        sample_map (dict, optional): Mapping {sample_name: mapping_sample}, e.g. {"Mira_1": "sample4"}.
+        fraction (float): Fraction of windows, and of unplaced reads, to count (0 < fraction <= 1).
+        window_size (int): Window length in bp.
+        min_windows (int): Windows counted at least (all of them if fewer), as the intervals assume
+            enough windows for the normal approximation.
+        min_unplaced (int): Unplaced reads counted at least (all of them if fewer).
+        confidence (float): Confidence level of the intervals.
+        seed (int): Seed of the window choice, so estimates can be repeated.
+        processes (int): Worker processes shared by the windows of all samples.
+        sort_target (str): Tag holding the cell barcode (default CB).
+        instrument (Instrumentation, optional): As for ``barcode_coverage``.
+        **mapping_kwargs: Column names and delimiter passed to ``mapping_registry.compile_mapping``.
+
+    Returns:
+        list: One ``CoverageEstimate`` per sample, in the order of ``sample_bams``.
+    """
+    if not 0 < fraction <= 1:
+        raise ValueError("fraction must be greater than 0 and at most 1.")
+    with instrument.stage("load_mapping"):
+        if not isinstance(mapping, dict):
+            mapping = load_mapping(mapping, **mapping_kwargs)
+    sample_map = sample_map or {}
+    instrument.add_input(*sample_bams.values())
+    rng = np.random.default_rng(seed)
+
+    tasks, shards, strata = [], [], {}
+    for sample, bam_path in sample_bams.items():
+        barcode_index = _barcode_index(mapping, sample_map.get(sample, sample))
+        with pysam.AlignmentFile(str(bam_path), "rb") as bam:
+            placed = sum(stat.total for stat in bam.get_index_statistics())
+            unplaced = bam.nocoordinate
+        windows = [shard for shard in region_shards(str(bam_path), window_size) if shard[0] != UNPLACED]
+        n = min(len(windows), max(min_windows, math.ceil(fraction * len(windows))))
+        chosen = [windows[i] for i in np.sort(rng.choice(len(windows), n, replace=False))]
+        head = min(unplaced, max(min_unplaced, math.ceil(fraction * unplaced)))
+        strata[sample] = (placed, len(windows), len(chosen), unplaced, head)
+        for shard in chosen:
+            tasks.append((sample, str(bam_path), shard, barcode_index, sort_target, None))
+            shards.append(shard)
+        if head:
+            tasks.append((sample, str(bam_path), (UNPLACED, None, None), barcode_index, sort_target, head))
+            shards.append((UNPLACED, None, None))
+
+    with instrument.stage("count"):
+        partials = map_shards(_count_shard, tasks, shards, processes,
+                              on_result=lambda partial: instrument.progress(reads=partial.total_reads))
+
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    results, i = [], 0
+    for sample, (placed, n_windows, n_chosen, unplaced, head) in strata.items():
+        sample_partials = partials[i:i + n_chosen + bool(head)]
+        i += len(sample_partials)
+        windows, tail = sample_partials[:n_chosen], sample_partials[n_chosen:]
+        result = CoverageEstimate(sample, total_reads=placed + unplaced, confidence=confidence)
+        for partial in sample_partials:
+            result.barcode_counts.update(partial.barcode_counts)
+            result.sampled_reads += partial.total_reads
+
+        t = np.array([w.total_reads for w in windows], dtype=np.float64)
+        counts = {
+            "matched": (np.array([w.matched_reads for w in windows], dtype=np.float64),
+                        sum(p.matched_reads for p in tail)),
+            "untagged": (np.array([w.untagged_reads for w in windows], dtype=np.float64),
+                         sum(p.untagged_reads for p in tail)),
+            "unmapped": (np.array([w.unmapped_reads for w in windows], dtype=np.float64),
+                         sum(p.unmapped_reads for p in tail)),
+        }
+        estimates = {}
+        for name, (y, y_unplaced) in counts.items():
+            ratio, var = _window_ratio(y, t, n_windows) if placed else (0.0, 0.0)
+            ratio_unplaced, var_unplaced = _read_ratio(y_unplaced, head, unplaced)
+            unknown = math.isnan(ratio)
+            if unknown:
+                # Too few sampled windows held reads, so the placed reads may add anything from none to all of them
+                ratio, var = (ratio_unplaced if head else 0.0), 0.0
+            estimate = placed * ratio + unplaced * ratio_unplaced
+            half_width = z * math.sqrt(placed ** 2 * var + unplaced ** 2 * var_unplaced)
+            low, high = estimate - half_width, estimate + half_width
+            if unknown:
+                low, high = low - placed * ratio, high + placed * (1 - ratio)
+            estimates[name] = estimate
+            setattr(result, f"{name}_ci", (max(0, math.floor(low)), min(result.total_reads, math.ceil(high))))
+        result.matched_reads = round(estimates["matched"])
+        result.untagged_reads = round(estimates["untagged"])
+        results.append(result)
+    return results
+
+
+def _atomic_to_csv(df, path):
+    tmp_path = f"{path}.tmp"
+    df.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def write_coverage_results(results, output_file, barcode_counts_file=None):
+    """
+    Write coverage results, replacing any previous files atomically.
+
+    Args:
+        results (list): ``CoverageResult`` objects.
+        output_file (str): Summary CSV with one row per sample.
+        barcode_counts_file (str, optional): CSV of matched reads per sample and barcode.
+    """
+    _atomic_to_csv(pd.DataFrame([r.to_row() for r in results]), output_file)
+    if barcode_counts_file is not None:
+        rows = [(r.sample, barcode, n) for r in results for barcode, n in sorted(r.barcode_counts.items())]
+        _atomic_to_csv(pd.DataFrame(rows, columns=["Sample", "cell_barcode", "Reads"]), barcode_counts_file)
@@ -0,0 +1,214 @@
+"""
+Module: barcodes
+
+Compact encoding of cell barcodes such as ``AAACCCAAGATACGAT-1`` into 64-bit
+integers, and a sorted-array index for resolving many barcodes at once.
+
+Layout of a code (most significant bits first)::
+
+    | suffix + 1 (11 bits) | sequence length (5 bits) | 2-bit bases (48 bits) |
+
+The suffix field is 0 for barcodes without a ``-N`` suffix. Sequences of up to
+24 A/C/G/T bases and suffixes up to 2046 are encodable; anything else encodes
+to ``INVALID``, which never matches an index entry.
+"""
+
+from itertools import islice
+
+import numpy as np
+
+MAX_LENGTH = 24
+MAX_SUFFIX = 2046
+INVALID = np.uint64(0xFFFFFFFFFFFFFFFF)
+BASES = "ACGT"
+
+_SEQ_BITS = 2 * MAX_LENGTH
+_LEN_SHIFT = np.uint64(_SEQ_BITS)
+_SUFFIX_SHIFT = np.uint64(_SEQ_BITS + 5)
+_BASE_CODES = np.full(256, 255, dtype=np.uint8)
+for _i, _base in enumerate(BASES):
+    _BASE_CODES[ord(_base)] = _i
+
+
+def encode_barcodes(barcodes):
+    """
+    Encode barcodes into 64-bit codes.
+
+    Args:
+        barcodes (iterable): Barcode strings; None (e.g. a missing tag) encodes to ``INVALID``.
+
+    Returns:
+        numpy.ndarray: uint64 codes, one per barcode.
+    """
+    raw = np.array([b if isinstance(b, str) and b.isascii() else "" for b in barcodes], dtype="S")
+    n = len(raw)
+    if n == 0 or raw.itemsize == 0:
+        return np.full(n, INVALID, dtype=np.uint64)
+    chars = raw.view(np.uint8).reshape(n, raw.itemsize)
+
+    is_dash = chars == ord("-")
+    has_dash = is_dash.any(axis=1)
+    # Sequence ends at the dash, or at the NUL padding of shorter strings
+    seq_end = np.where(has_dash, is_dash.argmax(axis=1), (chars != 0).sum(axis=1))
+    valid = (seq_end >= 1) & (seq_end <= MAX_LENGTH)
+
+    seq = np.zeros(n, dtype=np.uint64)
+    suffix = np.zeros(n, dtype=np.uint64)
+    suffix_digits = np.zeros(n, dtype=np.int64)
+    for col in range(chars.shape[1]):
+        c = chars[:, col]
+        in_seq = col < seq_end
+        base = _BASE_CODES[c]
+        valid &= ~in_seq | (base != 255)
+        seq = np.where(in_seq, (seq << np.uint64(2)) | (base & 3).astype(np.uint64), seq)
+        in_suffix = has_dash & (col > seq_end) & (c != 0)
+        is_digit = (c >= ord("0")) & (c <= ord("9"))
+        valid &= ~in_suffix | is_digit
+        suffix = np.where(in_suffix & is_digit, suffix * np.uint64(10) + (c - ord("0")).astype(np.uint64), suffix)
+        suffix_digits += in_suffix
+    valid &= ~has_dash | ((suffix_digits >= 1) & (suffix_digits <= 4) & (suffix <= MAX_SUFFIX))
+
+    suffix_field = np.where(has_dash, suffix + np.uint64(1), np.uint64(0))
+    codes = (suffix_field << _SUFFIX_SHIFT) | (seq_end.astype(np.uint64) << _LEN_SHIFT) | seq
+    codes[~valid] = INVALID
+    return codes
+
+
+def encode_barcode(barcode):
+    """Encode a single barcode; returns a Python int (``int(INVALID)`` if not encodable)."""
+    return int(encode_barcodes([barcode])[0])
+
+
+def decode_barcode(code):
+    """
+    Decode a code produced by ``encode_barcode`` back to its string.
+
+    Raises:
+        ValueError: If ``code`` is ``INVALID``.
+    """
+    code = int(code)
+    if code == int(INVALID):
+        raise ValueError("Cannot decode an invalid barcode code.")
+    length = (code >> _SEQ_BITS) & 0x1F
+    suffix_field = code >> (_SEQ_BITS + 5)
+    seq = "".join(BASES[(code >> (2 * (length - 1 - i))) & 3] for i in range(length))
+    return seq if suffix_field == 0 else f"{seq}-{suffix_field - 1}"
+
+
+class BarcodeIndex:
+    """
+    Sorted array index from barcodes to integer values (e.g. cell-type indices).
+
+    Barcodes that cannot be encoded (e.g. values of a non-barcode tag) are kept in a
+    small dictionary and resolved individually, so any set of tag values is supported.
+
+    Args:
+        barcodes (iterable): Barcode strings. Later duplicates replace earlier ones.
+        values (iterable, optional): Integer value for each barcode. Defaults to 0 for all.
+    """
+
+    def __init__(self, barcodes, values=None):
+        barcodes = list(barcodes)
+        values = np.zeros(len(barcodes), dtype=np.int32) if values is None else np.asarray(values, dtype=np.int32)
+        if len(values) != len(barcodes):
+            raise ValueError("barcodes and values must have the same length.")
+        codes = encode_barcodes(barcodes)
+        encodable = codes != INVALID
+        # Keep the last occurrence of duplicated codes, as a dict built from the same pairs would
+        order = np.argsort(codes[encodable], kind="stable")[::-1]
+        codes_desc = codes[encodable][order]
+        _, first = np.unique(codes_desc, return_index=True)
+        keep = order[first]
+        self.codes = codes[encodable][keep]
+        self.values = values[encodable][keep]
+        extra = {}
+        for barcode, value in zip(np.asarray(barcodes, dtype=object)[~encodable], values[~encodable]):
+            extra[barcode] = int(value)
+        # Unencodable barcodes are numbered after the encoded ones
+        self._extra = {barcode: len(self.codes) + i for i, barcode in enumerate(extra)}
+        self._all_values = np.concatenate([self.values, np.array(list(extra.values()), dtype=np.int32)])
+
+    @classmethod
+    def from_mapping(cls, tag_to_value):
+        """
+        Build an index from {barcode: label}.
+
+        Returns:
+            tuple: (``BarcodeIndex`` whose values index into labels, list of labels in first-seen order).
+        """
+        labels = list(dict.fromkeys(tag_to_value.values()))
+        label_idx = {label: i for i, label in enumerate(labels)}
+        return cls(tag_to_value.keys(), [label_idx[v] for v in tag_to_value.values()]), labels
+
+    @classmethod
+    def from_arrays(cls, codes, values, extra=None):
+        """
+        Index over arrays that are already encoded, sorted and unique, e.g. memory-mapped from disk.
+
+        The arrays are used as they are, without copying.
+
+        Args:
+            codes (numpy.ndarray): Sorted, unique uint64 codes from ``encode_barcodes``.
+            values (numpy.ndarray): int32 value of each code.
+            extra (dict, optional): {barcode: value} for barcodes that cannot be encoded.
+        """
+        index = cls.__new__(cls)
+        index.codes = codes
+        index.values = values
+        extra = extra or {}
+        index._extra = {barcode: len(codes) + i for i, barcode in enumerate(extra)}
+        index._all_values = (np.concatenate([values, np.array(list(extra.values()), dtype=np.int32)])
+                             if extra else values)
+        return index
+
+    def __len__(self):
+        return len(self.codes) + len(self._extra)
+
+    def find(self, barcodes):
+        """
+        Resolve a block of barcodes to entry positions.
+
+        Args:
+            barcodes (list): Barcode strings, or None for reads without a barcode.
+
+        Returns:
+            numpy.ndarray: Position of each barcode in the index (``0 <= pos < len(self)``), or -1 if absent.
+        """
+        codes = encode_barcodes(barcodes)
+        pos = np.searchsorted(self.codes, codes)
+        pos[pos == len(self.codes)] = 0
+        found = (self.codes[pos] == codes) if len(self.codes) else np.zeros(len(codes), dtype=bool)
+        pos = np.where(found & (codes != INVALID), pos, -1)
+        if self._extra:
+            for i in np.flatnonzero(codes == INVALID):
+                pos[i] = self._extra.get(barcodes[i], -1)
+        return pos
+
+    def values_at(self, pos, default=-1):
+        """Values at positions returned by ``find``, ``default`` where the position is -1."""
+        if not len(self):
+            return np.full(len(pos), default)
+        return np.where(pos >= 0, self._all_values[pos], default)
+
+    def lookup(self, barcodes, default=-1):
+        """Resolve a block of barcodes to their values, ``default`` where absent."""
+        return self.values_at(self.find(barcodes), default)
+
+    def keys(self):
+        """Barcode strings in position order."""
+        return [decode_barcode(c) for c in self.codes] + list(self._extra)
+
+
+def read_blocks(reads, tag, block_size=10_000):
+    """
+    Group reads into blocks for batched barcode lookups.
+
+    Yields:
+        tuple: (list of reads, list of tag values with None for reads lacking the tag).
+    """
+    reads = iter(reads)
+    while True:
+        block = list(islice(reads, block_size))
+        if not block:
+            return
+        yield block, [read.get_tag(tag) if read.has_tag(tag) else None for read in block]
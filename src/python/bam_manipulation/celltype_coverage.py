@@ -0,0 +1,326 @@
+# pylint: disable=no-member
+"""
+Module: celltype_coverage
+
+Per-cell-type (pseudobulk) read coverage straight from unsplit sample BAMs
+such as cellranger's ``possorted_genome_bam.bam``, without splitting by cell
+type and running a coverage tool on each merged BAM.
+
+Work is divided into one task per contig, shared by a process pool. A task
+reads its contig from every sample, resolves each read's ``CB`` tag to a cell
+type through a packed ``BarcodeIndex``, and adds the read's aligned blocks
+(``M``/``=``/``X``; deletions and ``N`` skips are not covered) to per-cell-type
+depth in bins of ``bin_size`` bp. It holds the bins of one contig only: about
+``12 * n_celltypes * contig_length / bin_size`` bytes.
+
+Output, in ``output_dir``:
+
+    coverage.json                  manifest: bin size, contig lengths, cell types, reads per cell type
+    {celltype}.bedgraph            mean depth per bin, runs of equal depth merged, zero runs left out
+    {celltype}.bw                  the same as bigWig, with ``bigwig=True`` (needs pyBigWig)
+    arrays/{celltype}/{contig}.npy float32 mean depth per bin, for slicing with ``CoverageTracks``
+"""
+
+import json
+import os
+import shutil
+
+import numpy as np
+import pysam
+
+from bam_manipulation.barcodes import BarcodeIndex, read_blocks
+from bam_manipulation.junctions import EXCLUDE_FLAGS
+from bam_manipulation.mapping_registry import CompiledMapping, load_mapping
+from bam_manipulation.sharding import map_shards, region_shards, UNPLACED
+
+MANIFEST_FILE = "coverage.json"
+ARRAYS_DIR = "arrays"
+
+
+def track_name(celltype):
+    """File name stem of a cell type's tracks, as used for split BAMs (spaces replaced)."""
+    return str(celltype).replace(" ", "_").replace("/", "_")
+
+
+def _add_intervals(sums, full, starts, ends, rows, n_bins, bin_size):
+    """
+    Add half-open intervals to binned base counts.
+
+    ``sums`` (flat ``rows x n_bins``) receives the bases of each interval in its first and last bin, and
+    ``full`` (flat ``rows x (n_bins + 1)``) a +1/-1 difference marking the bins it covers completely.
+    """
+    first = starts // bin_size
+    last = (ends - 1) // bin_size
+    same = first == last
+    np.add.at(sums, rows[same] * n_bins + first[same], ends[same] - starts[same])
+    split = ~same
+    first, last, starts, ends, rows = first[split], last[split], starts[split], ends[split], rows[split]
+    np.add.at(sums, rows * n_bins + first, (first + 1) * bin_size - starts)
+    np.add.at(sums, rows * n_bins + last, ends - last * bin_size)
+    np.add.at(full, rows * (n_bins + 1) + first + 1, 1)
+    np.add.at(full, rows * (n_bins + 1) + last, -1)
+
+
+def binned_depth(intervals, length, bin_size=1):
+    """
+    Mean depth per bin of a set of intervals on one contig.
+
+    Args:
+        intervals (iterable): ``(start, end)`` pairs, 0-based half-open.
+        length (int): Contig length.
+        bin_size (int): Bin width in bp; the last bin may be shorter.
+
+    Returns:
+        numpy.ndarray: float32 mean depth of each bin.
+    """
+    intervals = np.array(list(intervals), dtype=np.int64).reshape(-1, 2)
+    n_bins = -(-length // bin_size)
+    sums = np.zeros(n_bins, dtype=np.int64)
+    full = np.zeros(n_bins + 1, dtype=np.int64)
+    _add_intervals(sums, full, intervals[:, 0], intervals[:, 1], np.zeros(len(intervals), dtype=np.int64),
+                   n_bins, bin_size)
+    return _mean_depth(sums.reshape(1, -1), full.reshape(1, -1), length, bin_size)[0]
+
+
+def _mean_depth(sums, full, length, bin_size):
+    n_bins = sums.shape[1]
+    widths = np.full(n_bins, bin_size, dtype=np.float64)
+    widths[-1] = length - (n_bins - 1) * bin_size
+    covered = sums + np.cumsum(full, axis=1)[:, :n_bins] * bin_size
+    return (covered / widths).astype(np.float32)
+
+
+def depth_runs(depth, length, bin_size):
+    """
+    Runs of equal, non-zero depth as bedGraph intervals.
+
+    Returns:
+        tuple: (starts, ends, values) arrays; coordinates 0-based half-open, clipped to ``length``.
+    """
+    if len(depth) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+    change = np.flatnonzero(depth[1:] != depth[:-1]) + 1
+    first = np.concatenate([[0], change])
+    last = np.concatenate([change, [len(depth)]])
+    values = depth[first]
+    keep = values != 0
+    return first[keep] * bin_size, np.minimum(last[keep] * bin_size, length), values[keep]
+
+
+def _contig_coverage(task):
+    contig, length, sources, n_celltypes, names, bin_size, sort_target, exclude_flags, min_mapq, output_dir = task
+    n_bins = -(-length // bin_size)
+    sums = np.zeros(n_celltypes * n_bins, dtype=np.int64)
+    full = np.zeros(n_celltypes * (n_bins + 1), dtype=np.int32)
+    reads = np.zeros(n_celltypes, dtype=np.int64)
+    for bam_path, barcode_index in sources:
+        with pysam.AlignmentFile(bam_path, "rb") as bam:
+            if contig not in bam.references:
+                continue
+            kept = (read for read in bam.fetch(contig)
+                    if not read.flag & exclude_flags and read.mapping_quality >= min_mapq)
+            for block, barcodes in read_blocks(kept, sort_target):
+                starts, ends, rows = [], [], []
+                for read, ct in zip(block, barcode_index.lookup(barcodes).tolist()):
+                    if ct < 0:
+                        continue
+                    reads[ct] += 1
+                    for start, end in read.get_blocks():
+                        starts.append(start)
+                        ends.append(end)
+                        rows.append(ct)
+                if starts:
+                    _add_intervals(sums, full, np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64),
+                                   np.array(rows, dtype=np.int64), n_bins, bin_size)
+
+    depth = _mean_depth(sums.reshape(n_celltypes, n_bins), full.reshape(n_celltypes, n_bins + 1), length, bin_size)
+    for ct, name in enumerate(names):
+        if not reads[ct]:
+            continue
+        array_dir = os.path.join(output_dir, ARRAYS_DIR, name)
+        os.makedirs(array_dir, exist_ok=True)
+        np.save(os.path.join(array_dir, f"{contig}.npy"), depth[ct])
+        with open(os.path.join(output_dir, ".parts", name, f"{contig}.bedgraph"), "w") as out:
+            for start, end, value in zip(*depth_runs(depth[ct], length, bin_size)):
+                out.write(f"{contig}\t{start}\t{end}\t{value:.6g}\n")
+    return contig, reads.tolist()
+
+
+def celltype_coverage(sample_bams, mapping, output_dir, sample_map=None, bin_size=10, processes=1, sort_target="CB",
+                      exclude_flags=EXCLUDE_FLAGS, min_mapq=0, bigwig=False, **mapping_kwargs):
+    """
+    Write per-cell-type coverage tracks from sample BAMs in one pass over each contig.
+
+    Args:
+        sample_bams (dict): Mapping {sample_name: bam_path}; BAMs must be coordinate-sorted, indexed and share
+            reference sequences. Reads of all samples add to the same cell-type tracks.
+        mapping (str, dict or CompiledMapping): Barcode mapping as accepted by ``barcode_coverage``.
+        output_dir (str): Directory for the tracks (see the module docstring).
+        sample_map (dict, optional): Mapping {sample_name: mapping_sample}, e.g. {"Mira_1": "sample4"}.
+        bin_size (int): Bin width in bp (1 for per-base depth).
+        processes (int): Worker processes, each handling one contig at a time.
+        sort_target (str): Tag holding the cell barcode (default CB).
+        exclude_flags (int): Reads with any of these flags are not counted (default: unmapped, secondary,
+            QC-fail and duplicate).
+        min_mapq (int): Minimum mapping quality of counted reads.
+        bigwig (bool): Also write ``{celltype}.bw`` files (requires pyBigWig).
+        **mapping_kwargs: Column names and delimiter passed to ``mapping_registry.compile_mapping``.
+
+    Returns:
+        CoverageTracks: The written tracks.
+    """
+    if bin_size < 1:
+        raise ValueError("bin_size must be 1 or greater.")
+    if not isinstance(mapping, dict):
+        mapping = load_mapping(mapping, **mapping_kwargs)
+    sample_map = sample_map or {}
+
+    if isinstance(mapping, CompiledMapping):
+        celltypes = list(mapping.celltypes)
+        indexes = [mapping.index(sample_map.get(sample, sample))[0] for sample in sample_bams]
+    else:
+        tag_maps = [mapping.get(sample_map.get(sample, sample), {}) for sample in sample_bams]
+        celltypes = list(dict.fromkeys(ct for tag_map in tag_maps for ct in tag_map.values()))
+        label_idx = {ct: i for i, ct in enumerate(celltypes)}
+        indexes = [BarcodeIndex(tag_map.keys(), [label_idx[ct] for ct in tag_map.values()]) for tag_map in tag_maps]
+    names = [track_name(ct) for ct in celltypes]
+    if len(set(names)) != len(names):
+        raise ValueError(f"Cell types {celltypes} do not have distinct file names.")
+
+    lengths, occupied = {}, set()
+    for bam_path in sample_bams.values():
+        with pysam.AlignmentFile(str(bam_path), "rb") as bam:
+            for contig, length in zip(bam.references, bam.lengths):
+                if lengths.setdefault(contig, length) != length:
+                    raise ValueError(f"Contig '{contig}' has different lengths across sample BAMs.")
+        occupied.update(shard[0] for shard in region_shards(str(bam_path)) if shard[0] != UNPLACED)
+    sources = [(str(bam_path), index) for bam_path, index in zip(sample_bams.values(), indexes)]
+
+    shutil.rmtree(os.path.join(output_dir, ARRAYS_DIR), ignore_errors=True)
+    parts_dir = os.path.join(output_dir, ".parts")
+    shutil.rmtree(parts_dir, ignore_errors=True)
+    for name in names:
+        os.makedirs(os.path.join(parts_dir, name))
+    shards = [(contig, 0, length) for contig, length in lengths.items() if contig in occupied]
+    tasks = [(contig, end, sources, len(celltypes), names, bin_size, sort_target, exclude_flags, min_mapq, output_dir)
+             for contig, _, end in shards]
+    reads = np.zeros(len(celltypes), dtype=np.int64)
+    computed = []
+    for contig, contig_reads in map_shards(_contig_coverage, tasks, shards, processes):
+        reads += np.array(contig_reads, dtype=np.int64)
+        computed.append(contig)
+
+    # Contig pieces are concatenated in header order, as bedGraph-to-bigWig tools expect
+    for name in names:
+        path = os.path.join(output_dir, f"{name}.bedgraph")
+        with open(f"{path}.tmp", "wb") as out:
+            for contig in computed:
+                part = os.path.join(parts_dir, name, f"{contig}.bedgraph")
+                if os.path.exists(part):
+                    with open(part, "rb") as fh:
+                        shutil.copyfileobj(fh, out)
+        os.replace(f"{path}.tmp", path)
+    shutil.rmtree(parts_dir, ignore_errors=True)
+
+    manifest = {
+        "bin_size": bin_size,
+        "contigs": lengths,
+        "computed": computed,
+        "celltypes": celltypes,
+        "files": dict(zip(celltypes, names)),
+        "reads": dict(zip(celltypes, reads.tolist())),
+        "samples": {sample: str(bam_path) for sample, bam_path in sample_bams.items()},
+    }
+    with open(os.path.join(output_dir, f"{MANIFEST_FILE}.tmp"), "w") as fh:
+        json.dump(manifest, fh, indent=2)
+    os.replace(os.path.join(output_dir, f"{MANIFEST_FILE}.tmp"), os.path.join(output_dir, MANIFEST_FILE))
+
+    tracks = CoverageTracks(output_dir)
+    if bigwig:
+        for celltype in celltypes:
+            tracks.write_bigwig(celltype, os.path.join(output_dir, f"{track_name(celltype)}.bw"))
+    return tracks
+
+
+class CoverageTracks:
+    """
+    Reader for the output of ``celltype_coverage``; arrays are memory-mapped and sliced on demand.
+
+    Args:
+        coverage_dir (str): Output directory of ``celltype_coverage``.
+    """
+
+    def __init__(self, coverage_dir):
+        self.coverage_dir = str(coverage_dir)
+        with open(os.path.join(self.coverage_dir, MANIFEST_FILE)) as fh:
+            manifest = json.load(fh)
+        self.bin_size = manifest["bin_size"]
+        self.contigs = manifest["contigs"]
+        self.celltypes = manifest["celltypes"]
+        self.reads = manifest["reads"]
+        self._files = manifest["files"]
+
+    def bedgraph(self, celltype):
+        """Path of a cell type's genome-wide bedGraph."""
+        return os.path.join(self.coverage_dir, f"{self._files[celltype]}.bedgraph")
+
+    def depth(self, celltype, contig):
+        """Mean depth per bin over a whole contig (memory-mapped; zeros where no reads were counted)."""
+        if celltype not in self._files:
+            raise KeyError(f"No coverage track for cell type '{celltype}'.")
+        path = os.path.join(self.coverage_dir, ARRAYS_DIR, self._files[celltype], f"{contig}.npy")
+        if os.path.exists(path):
+            return np.load(path, mmap_mode="r")
+        return np.zeros(-(-self.contigs[contig] // self.bin_size), dtype=np.float32)
+
+    def slice(self, celltype, contig, start, end):
+        """
+        Depth of the bins overlapping ``[start, end)`` (0-based).
+
+        Returns:
+            tuple: (bin start positions, float32 mean depth of each bin).
+        """
+        first = max(start, 0) // self.bin_size
+        last = -(-min(end, self.contigs[contig]) // self.bin_size)
+        values = np.array(self.depth(celltype, contig)[first:last])
+        return np.arange(first, first + len(values), dtype=np.int64) * self.bin_size, values
+
+    def write_bedgraph(self, celltype, contig, start, end, path):
+        """
+        Write the bins of a region as a bedGraph (runs merged, zeros left out), e.g. for pyGenomeTracks.
+
+        Returns:
+            int: Number of intervals written.
+        """
+        positions, values = self.slice(celltype, contig, start, end)
+        n = 0
+        with open(path, "w") as out:
+            if len(values):
+                length = min(self.contigs[contig], positions[-1] + self.bin_size)
+                starts, ends, depths = depth_runs(values, length - positions[0], self.bin_size)
+                for s, e, value in zip(starts + positions[0], ends + positions[0], depths):
+                    out.write(f"{contig}\t{s}\t{e}\t{value:.6g}\n")
+                    n += 1
+        return n
+
+    def write_bigwig(self, celltype, path):
+        """
+        Write a cell type's genome-wide track as bigWig.
+
+        Raises:
+            ImportError: If pyBigWig is not installed.
+        """
+        try:
+            import pyBigWig  # pylint: disable=import-outside-toplevel
+        except ImportError as e:
+            raise ImportError("bigWig output requires pyBigWig; the bedGraph and .npy tracks are always written.") from e
+        bw = pyBigWig.open(str(path), "w")
+        try:
+            bw.addHeader(list(self.contigs.items()))
+            for contig, length in self.contigs.items():
+                starts, ends, values = depth_runs(np.asarray(self.depth(celltype, contig)), length, self.bin_size)
+                if len(starts):
+                    bw.addEntries([contig] * len(starts), starts.tolist(), ends=ends.tolist(),
+                                  values=values.astype(float).tolist())
+        finally:
+            bw.close()
@@ -0,0 +1,141 @@
+"""
+Module: checkpoint
+
+Shard-level checkpoints for long BAM passes, so a job killed part way (e.g. at
+a Slurm time limit) resumes where it stopped instead of starting over.
+
+A pass over region shards (see ``bam_manipulation.sharding``) records each
+completed shard, together with its result (counters, names of finished output
+segments), in a JSON checkpoint file. The file is rewritten atomically after
+every shard. A restarted pass reuses the recorded results, processes only the
+missing shards, and then gathers exactly as an uninterrupted run would, so the
+outputs are identical. The checkpoint also holds a fingerprint of the inputs
+and parameters, and is ignored (and the pass started afresh) if they changed.
+Shard size sets the checkpoint interval: smaller shards lose less work.
+"""
+
+import hashlib
+import json
+import os
+
+from bam_manipulation.sharding import map_shards, shard_label
+
+
+def file_fingerprint(path):
+    """Identity of a file for checkpoint validation: absolute path, size and mtime."""
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def digest(obj):
+    """SHA-256 of a JSON-serialisable object (dict keys sorted), e.g. a barcode or cluster mapping."""
+    h = hashlib.sha256()
+    if isinstance(obj, dict):
+        # Streamed item by item, as mappings can hold millions of entries
+        for key in sorted(obj, key=str):
+            h.update(json.dumps([key, obj[key]], default=str).encode())
+    else:
+        h.update(json.dumps(obj, sort_keys=True, default=str).encode())
+    return h.hexdigest()
+
+
+class ShardCheckpoint:
+    """
+    Completed shards of one pass, persisted as JSON.
+
+    Args:
+        path (str): Checkpoint file.
+        fingerprint (dict): JSON-serialisable description of the inputs and parameters of the pass.
+            An existing checkpoint with a different fingerprint is discarded.
+    """
+
+    def __init__(self, path, fingerprint):
+        self.path = str(path)
+        self.fingerprint = json.loads(json.dumps(fingerprint))
+        self.completed = {}
+        self.resumed = False
+        if os.path.exists(self.path):
+            with open(self.path) as fh:
+                saved = json.load(fh)
+            if saved.get("fingerprint") == self.fingerprint:
+                self.completed = saved.get("completed", {})
+                self.resumed = True
+
+    def __contains__(self, key):
+        return key in self.completed
+
+    def __len__(self):
+        return len(self.completed)
+
+    def get(self, key, default=None):
+        return self.completed.get(key, default)
+
+    def record(self, key, result):
+        """Mark a shard complete with its JSON-serialisable result and save the checkpoint."""
+        self.completed[key] = result
+        self.save()
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as fh:
+            json.dump({"fingerprint": self.fingerprint, "completed": self.completed}, fh)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp_path, self.path)
+
+    def remove(self):
+        """Delete the checkpoint once the pass has finished."""
+        for path in (self.path, f"{self.path}.tmp"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def shard_key(i, shard):
+    """Checkpoint key of the ``i``-th shard, e.g. ``00003_SM_V10_1_0_1000000``."""
+    return f"{i:05d}_{shard_label(shard)}"
+
+
+def _call_keyed(args):
+    key, func, task = args
+    return key, func(task)
+
+
+def map_shards_checkpointed(func, tasks, shards, processes=1, checkpoint=None, encode=None, decode=None,
+                            on_result=None, on_pending=None):
+    """
+    ``map_shards`` that skips shards already recorded in a checkpoint and records the others as they finish.
+
+    Args:
+        func, tasks, shards, processes: As for ``sharding.map_shards``.
+        checkpoint (ShardCheckpoint, optional): Without one this is plain ``map_shards``.
+        encode (callable, optional): Converts a result to JSON-serialisable form for the checkpoint.
+        decode (callable, optional): Converts a recorded result back.
+        on_result (callable, optional): Called with each newly computed result.
+        on_pending (callable, optional): Called with the key of each shard about to be (re)computed, before any
+            work starts, e.g. to remove partial outputs left by a killed run.
+
+    Returns:
+        list: Results in the order of ``tasks``, recorded and new alike.
+    """
+    if checkpoint is None:
+        return map_shards(func, tasks, shards, processes, on_result)
+    encode = encode or (lambda result: result)
+    decode = decode or (lambda result: result)
+    keys = [shard_key(i, shard) for i, shard in enumerate(shards)]
+    results = {key: decode(checkpoint.get(key)) for key in keys if key in checkpoint}
+    pending = [i for i, key in enumerate(keys) if key not in checkpoint]
+    if on_pending is not None:
+        for i in pending:
+            on_pending(keys[i])
+
+    def record(keyed):
+        key, result = keyed
+        checkpoint.record(key, encode(result))
+        if on_result is not None:
+            on_result(result)
+
+    done = map_shards(_call_keyed, [(keys[i], func, tasks[i]) for i in pending], [shards[i] for i in pending],
+                      processes, record)
+    results.update(done)
+    return [results[key] for key in keys]
@@ -0,0 +1,337 @@
+"""
+Module: instrumentation
+
+Throughput, resource and profiling instrumentation for the long-running BAM tools.
+
+An ``Instrumentation`` records reads processed, input and output bytes, wall
+and CPU time per named stage, and peak memory (``ru_maxrss`` of the process and
+of its finished worker processes). While a tool runs it appends JSON-lines
+events: stage start and end, and a progress event at most every ``interval``
+seconds. When it is closed, it writes a JSON summary. A hot loop can be wrapped
+in ``profiled()`` to capture a cProfile ``.pstats`` file, or a sampled profile
+in folded-stack format (one ``frame;frame;... count`` line per stack, as read by
+flamegraph tools).
+
+Tools decorated with ``instrumented`` take an ``instrument`` argument. Without
+one, they read their settings from the environment, so Slurm jobs can be
+instrumented without changing the command line:
+
+    BAM_METRICS_DIR=metrics/ BAM_PROFILE=sample python scripts/split_bam_by_CB.py ...
+
+writes ``metrics/bamTagHandling.<job>.events.jsonl``, ``.summary.json`` and
+``.folded``, where ``<job>`` is the Slurm job (and array task) ID or the PID,
+followed by ``.2``, ``.3``, ... for later runs of the same tool in the job.
+With ``BAM_METRICS_DIR`` unset nothing is written.
+"""
+
+import cProfile
+import functools
+import inspect
+import json
+import os
+import resource
+import socket
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+METRICS_ENV = "BAM_METRICS_DIR"
+PROFILE_ENV = "BAM_PROFILE"
+INTERVAL_ENV = "BAM_METRICS_INTERVAL"
+PROFILERS = ("cprofile", "sample")
+
+_runs = Counter()
+
+
+def _cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process or any of its finished children, in MiB."""
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _file_stats(path):
+    # {file: (size, mtime_ns)} of a file, or of every file under a directory
+    if os.path.isdir(path):
+        files = [os.path.join(root, f) for root, _, names in os.walk(path) for f in names]
+    else:
+        files = [path]
+    stats = {}
+    for f in files:
+        try:
+            st = os.stat(f)
+        except FileNotFoundError:
+            continue
+        stats[f] = (st.st_size, st.st_mtime_ns)
+    return stats
+
+
+def _path_bytes(path, before=None):
+    # Files already there with the same size and mtime as in ``before`` were not written by this run
+    before = before or {}
+    return sum(size for f, (size, mtime) in _file_stats(path).items() if before.get(f) != (size, mtime))
+
+
+def job_id():
+    """Slurm job ID (with array task ID), or the process ID outside Slurm."""
+    job = os.environ.get("SLURM_JOB_ID")
+    if not job:
+        return str(os.getpid())
+    task = os.environ.get("SLURM_ARRAY_TASK_ID")
+    return f"{job}_{task}" if task else job
+
+
+class Instrumentation:
+    """
+    Metrics collector for one run of a tool.
+
+    Args:
+        name (str): Tool name, recorded in every event.
+        events_path (str, optional): JSON-lines file events are appended to.
+        summary_path (str, optional): JSON file the summary is written to on ``close()``.
+        interval (float): Minimum seconds between progress events.
+        profile (str, optional): "cprofile" or "sample" to profile blocks wrapped in ``profiled()``.
+        profile_path (str, optional): Profile output (``.pstats`` or ``.folded``).
+        sample_interval (float): Seconds between samples of the "sample" profiler.
+
+    Use as a context manager, or call ``close()`` when the run ends.
+    """
+
+    def __init__(self, name, events_path=None, summary_path=None, interval=30.0, profile=None, profile_path=None,
+                 sample_interval=0.005):
+        if profile is not None and profile not in PROFILERS:
+            raise ValueError(f"profile must be one of {PROFILERS}, not '{profile}'.")
+        self.name = name
+        self.events_path = events_path
+        self.summary_path = summary_path
+        self.interval = interval
+        self.profile = profile
+        self.profile_path = profile_path or (f"{name}.pstats" if profile == "cprofile" else f"{name}.folded")
+        self.sample_interval = sample_interval
+        self.reads = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.stages = []
+        self._inputs = []
+        self._outputs = {}
+        self._stage_stack = []
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._cpu_start = _cpu_seconds()
+        self._last_event = self._start
+        self._last_reads = 0
+        self._closed = False
+        self._events = None
+        if events_path:
+            os.makedirs(os.path.dirname(os.path.abspath(events_path)), exist_ok=True)
+            self._events = open(events_path, "a", buffering=1)
+        self.event("start", argv=sys.argv, host=socket.gethostname(), pid=os.getpid())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close(error=None if exc is None else repr(exc))
+
+    def event(self, kind, **fields):
+        """Append one event line (if an events file is set)."""
+        if self._events is None:
+            return
+        record = {"time": datetime.now(timezone.utc).isoformat(timespec="milliseconds"), "tool": self.name,
+                  "event": kind, "elapsed_s": round(time.perf_counter() - self._start, 3), **fields}
+        with self._lock:
+            self._events.write(json.dumps(record, default=str) + "\n")
+
+    def progress(self, reads=0, bytes_read=0, bytes_written=0):
+        """Add to the running totals, emitting a progress event if ``interval`` has passed since the last one."""
+        self.reads += reads
+        self.bytes_read += bytes_read
+        self.bytes_written += bytes_written
+        now = time.perf_counter()
+        if now - self._last_event >= self.interval:
+            window = now - self._last_event
+            self.event("progress", stage=self._stage_stack[-1] if self._stage_stack else None, reads=self.reads,
+                       reads_per_s=round(self.reads / (now - self._start), 1),
+                       window_reads_per_s=round((self.reads - self._last_reads) / window, 1),
+                       bytes_read=self.bytes_read, bytes_written=self.bytes_written, peak_rss_mb=round(peak_rss_mb(), 1))
+            self._last_event = now
+            self._last_reads = self.reads
+
+    def add_input(self, *paths):
+        """Count the size of input files or directories (measured on ``close()``) as bytes read."""
+        self._inputs.extend(str(p) for p in paths)
+
+    def add_output(self, *paths):
+        """
+        Count the size of output files or directories (measured on ``close()``) as bytes written.
+
+        Only files created or changed after this call are counted, not what an earlier run left there.
+        """
+        for p in paths:
+            self._outputs.setdefault(str(p), _file_stats(str(p)))
+
+    @contextmanager
+    def stage(self, name):
+        """Time a stage: wall and CPU seconds (including finished workers), reads and peak memory."""
+        start, cpu, reads = time.perf_counter(), _cpu_seconds(), self.reads
+        self._stage_stack.append(name)
+        self.event("stage_start", stage=name)
+        try:
+            yield self
+        finally:
+            self._stage_stack.pop()
+            record = {
+                "stage": name,
+                "wall_s": round(time.perf_counter() - start, 3),
+                "cpu_s": round(_cpu_seconds() - cpu, 3),
+                "reads": self.reads - reads,
+                "peak_rss_mb": round(peak_rss_mb(), 1),
+            }
+            self.stages.append(record)
+            self.event("stage_end", **record)
+
+    @contextmanager
+    def profiled(self):
+        """Profile the wrapped block if a profiler was requested; otherwise do nothing."""
+        if self.profile == "cprofile":
+            profiler = cProfile.Profile()
+            profiler.enable()
+            try:
+                yield self
+            finally:
+                profiler.disable()
+                profiler.dump_stats(self.profile_path)
+                self.event("profile", profiler=self.profile, path=self.profile_path)
+        elif self.profile == "sample":
+            sampler = _StackSampler(threading.get_ident(), self.sample_interval)
+            sampler.start()
+            try:
+                yield self
+            finally:
+                sampler.stop()
+                sampler.write(self.profile_path)
+                self.event("profile", profiler=self.profile, path=self.profile_path, samples=sampler.samples)
+        else:
+            yield self
+
+    def summary(self):
+        """Totals for the run so far."""
+        wall = time.perf_counter() - self._start
+        return {
+            "tool": self.name,
+            "job": job_id(),
+            "wall_s": round(wall, 3),
+            "cpu_s": round(_cpu_seconds() - self._cpu_start, 3),
+            "reads": self.reads,
+            "reads_per_s": round(self.reads / wall, 1) if wall else None,
+            "bytes_read": self.bytes_read + sum(_path_bytes(p) for p in self._inputs),
+            "bytes_written": self.bytes_written + sum(_path_bytes(p, before) for p, before in self._outputs.items()),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "stages": self.stages,
+        }
+
+    def close(self, error=None):
+        """Emit the end event and write the summary file; later calls do nothing."""
+        if self._closed:
+            return None
+        self._closed = True
+        summary = self.summary()
+        if error:
+            summary["error"] = error
+        self.event("end", **{k: v for k, v in summary.items() if k != "stages"})
+        if self.summary_path:
+            tmp_path = f"{self.summary_path}.tmp"
+            with open(tmp_path, "w") as fh:
+                json.dump(summary, fh, indent=2)
+            os.replace(tmp_path, self.summary_path)
+        if self._events is not None:
+            self._events.close()
+        return summary
+
+
+class _StackSampler(threading.Thread):
+    """Samples the stack of one thread at a fixed interval into folded-stack counts."""
+
+    def __init__(self, thread_id, interval):
+        super().__init__(daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.counts = Counter()
+        self.samples = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)  # pylint: disable=protected-access
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            if stack:
+                self.counts[";".join(reversed(stack))] += 1
+                self.samples += 1
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def write(self, path):
+        with open(path, "w") as fh:
+            for stack, count in self.counts.most_common():
+                fh.write(f"{stack} {count}\n")
+
+
+def from_env(name, metrics_dir=None, profile=None, interval=None):
+    """
+    Instrumentation configured from arguments, falling back to the environment.
+
+    Args:
+        name (str): Tool name; output files are ``{metrics_dir}/{name}.{job}.*``.
+        metrics_dir (str, optional): Output directory (default: ``$BAM_METRICS_DIR``; no files if unset).
+        profile (str, optional): "cprofile" or "sample" (default: ``$BAM_PROFILE``).
+        interval (float, optional): Seconds between progress events (default: ``$BAM_METRICS_INTERVAL`` or 30).
+    """
+    metrics_dir = metrics_dir or os.environ.get(METRICS_ENV)
+    profile = profile or os.environ.get(PROFILE_ENV) or None
+    interval = interval if interval is not None else float(os.environ.get(INTERVAL_ENV, 30))
+    if not metrics_dir:
+        return Instrumentation(name, interval=interval, profile=profile)
+    os.makedirs(metrics_dir, exist_ok=True)
+    # Later runs of the same tool in one job get their own files
+    _runs[name] += 1
+    run = f".{_runs[name]}" if _runs[name] > 1 else ""
+    prefix = os.path.join(metrics_dir, f"{name}.{job_id()}{run}")
+    return Instrumentation(name, events_path=f"{prefix}.events.jsonl", summary_path=f"{prefix}.summary.json",
+                           interval=interval, profile=profile,
+                           profile_path=f"{prefix}.pstats" if profile == "cprofile" else f"{prefix}.folded")
+
+
+def instrumented(name):
+    """
+    Decorator giving a function an ``instrument`` keyword argument.
+
+    If the caller passes no ``Instrumentation``, one is created with ``from_env(name)`` for the call and
+    closed (writing its summary) when the call returns or raises.
+    """
+    def decorator(func):
+        if "instrument" not in inspect.signature(func).parameters:
+            raise TypeError(f"{func.__name__} must take an 'instrument' argument to be instrumented.")
+
+        @functools.wraps(func)
+        def wrapper(*args, instrument=None, **kwargs):
+            if instrument is not None:
+                return func(*args, instrument=instrument, **kwargs)
+            with from_env(name) as instrument:
+                return func(*args, instrument=instrument, **kwargs)
+        return wrapper
+    return decorator
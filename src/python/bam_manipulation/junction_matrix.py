@@ -0,0 +1,228 @@
+# pylint: disable=no-member
+"""
+Module: junction_matrix
+
+Counts splice junctions per cell type (or per cell barcode) straight from
+unsplit sample BAMs such as cellranger's ``possorted_genome_bam.bam``, without
+splitting by barcode and merging per cell type first.
+
+Each sample is read once, in region shards shared by a process pool. Spliced
+reads are resolved from their ``CB`` tag to a column through a packed
+``BarcodeIndex``, and counts are kept as a sparse junction x column matrix.
+The matrix is saved as a compressed ``.npz`` holding the COO entries together
+with the junction coordinate table.
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+import pysam
+
+from bam_manipulation.barcodes import BarcodeIndex, read_blocks
+from bam_manipulation.junctions import EXCLUDE_FLAGS, MIN_ANCHOR, MIN_INTRON, MAX_INTRON, read_junctions, read_strand
+from bam_manipulation.sharding import region_shards, fetch_shard, map_shards, UNPLACED
+from bam_manipulation.mapping_registry import CompiledMapping, load_mapping
+
+
+@dataclass
+class JunctionMatrix:
+    """
+    Sparse junction x column read counts.
+
+    Junction coordinates follow ``bam_manipulation.junctions``: introns are 0-based half-open
+    ``[start, end)``, and ``thick_start``/``thick_end`` extend them by the longest anchors seen.
+
+    Attributes:
+        contig, strand (numpy.ndarray): str arrays, one entry per junction.
+        start, end, thick_start, thick_end (numpy.ndarray): int64 arrays, one entry per junction.
+        columns (numpy.ndarray): Column labels (cell types, or ``sample:barcode``).
+        row, col, data (numpy.ndarray): COO entries; each (row, col) pair occurs once.
+    """
+    contig: np.ndarray
+    start: np.ndarray
+    end: np.ndarray
+    strand: np.ndarray
+    thick_start: np.ndarray
+    thick_end: np.ndarray
+    columns: np.ndarray
+    row: np.ndarray
+    col: np.ndarray
+    data: np.ndarray
+
+    @property
+    def shape(self):
+        return len(self.start), len(self.columns)
+
+    def to_dense(self):
+        """Counts as a dense int64 array of ``shape``."""
+        dense = np.zeros(self.shape, dtype=np.int64)
+        dense[self.row, self.col] = self.data
+        return dense
+
+    def to_scipy(self):
+        """
+        Counts as a ``scipy.sparse.csr_matrix``.
+
+        Raises:
+            ImportError: If scipy is not installed.
+        """
+        try:
+            from scipy.sparse import coo_matrix
+        except ImportError as e:
+            raise ImportError("JunctionMatrix.to_scipy requires scipy; use to_dense() or the COO arrays instead.") from e
+        return coo_matrix((self.data, (self.row, self.col)), shape=self.shape).tocsr()
+
+    def save(self, path):
+        """Save as a compressed ``.npz``."""
+        np.savez_compressed(path, **{name: getattr(self, name) for name in self.__dataclass_fields__})
+
+
+def load_junction_matrix(path):
+    """Load a ``JunctionMatrix`` saved with ``JunctionMatrix.save``."""
+    with np.load(path, allow_pickle=False) as npz:
+        return JunctionMatrix(**{name: npz[name] for name in JunctionMatrix.__dataclass_fields__})
+
+
+def _count_shard(task):
+    bam_path, shard, barcode_index, to_column, by_position, sort_target, exclude_flags, min_intron, max_intron = task
+    # Columns of the index's values (or positions, for by="barcode"); the trailing -1 is for unknown barcodes
+    to_column = np.append(to_column, -1)
+    junction_idx = {}  # (start, end, strand) -> local row
+    thick = []
+    rows, cols = [], []
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        spliced = (read for read in fetch_shard(bam, shard)
+                   if not read.flag & exclude_flags and "N" in (read.cigarstring or ""))
+        for block, barcodes in read_blocks(spliced, sort_target):
+            pos = barcode_index.find(barcodes)
+            columns = to_column[pos if by_position else barcode_index.values_at(pos)]
+            for read, column in zip(block, columns.tolist()):
+                if column < 0:
+                    continue
+                strand = read_strand(read)
+                for start, end, left, right in read_junctions(read):
+                    if not min_intron <= end - start <= max_intron:
+                        continue
+                    i = junction_idx.setdefault((start, end, strand), len(junction_idx))
+                    if i == len(thick):
+                        thick.append([start - left, end + right])
+                    else:
+                        thick[i][0] = min(thick[i][0], start - left)
+                        thick[i][1] = max(thick[i][1], end + right)
+                    rows.append(i)
+                    cols.append(column)
+    # Only the shard's non-zero (row, column) counts are sent back, not one pair per read
+    rows, cols = np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)
+    n_cols = int(cols.max()) + 1 if len(cols) else 1
+    linear, counts = np.unique(rows * n_cols + cols, return_counts=True)
+    return shard[0], list(junction_idx), thick, linear // n_cols, linear % n_cols, counts.astype(np.int64)
+
+
+def junction_matrix(sample_bams, mapping, sample_map=None, by="celltype", processes=1, shard_size=None,
+                    sort_target="CB", min_anchor=MIN_ANCHOR, min_intron=MIN_INTRON, max_intron=MAX_INTRON,
+                    exclude_flags=EXCLUDE_FLAGS, **mapping_kwargs):
+    """
+    Count junction-supporting reads per cell type or per barcode across samples.
+
+    Columns are pooled across samples when ``by="celltype"``, as merging the per-sample cell-type BAMs
+    would. Reads whose barcode is not in their sample's mapping are not counted. Junctions are filtered
+    on the pooled counts as ``junctions.junction_beds`` does for a merged BAM.
+
+    Args:
+        sample_bams (dict): Mapping {sample_name: bam_path}; BAMs must be coordinate-sorted and indexed.
+        mapping (str, dict or CompiledMapping): Path to a mapping file with a sample column (e.g. ``cc_barcode.csv``),
+            compiled once into the mapping cache (see ``mapping_registry``), a compiled mapping,
+            or {mapping_sample: {barcode: celltype}}.
+        sample_map (dict, optional): Mapping {sample_name: mapping_sample}, e.g. {"Mira_1": "sample4"}.
+        by (str): "celltype" or "barcode" (columns ``{sample}:{barcode}``).
+        processes (int): Worker processes shared by the shards of all samples.
+        shard_size (int, optional): Maximum shard length in bp (default: one shard per contig).
+        sort_target (str): Tag holding the cell barcode (default CB).
+        min_anchor, min_intron, max_intron (int): Junction filters as in ``bam_manipulation.junctions``.
+        exclude_flags (int): Reads with any of these SAM flags are ignored.
+        **mapping_kwargs: Column names and delimiter passed to ``mapping_registry.compile_mapping``.
+
+    Returns:
+        JunctionMatrix: Junctions sorted by contig (in order of the first BAM's header) and position.
+    """
+    if by not in ("celltype", "barcode"):
+        raise ValueError(f"by must be 'celltype' or 'barcode', not '{by}'.")
+    if not isinstance(mapping, dict):
+        mapping = load_mapping(mapping, **mapping_kwargs)
+    sample_map = sample_map or {}
+
+    column_idx, contig_order = {}, {}
+    tasks, shards = [], []
+    for sample, bam_path in sample_bams.items():
+        if isinstance(mapping, CompiledMapping):
+            barcode_index, labels = mapping.index(sample_map.get(sample, sample))
+        else:
+            barcode_index, labels = BarcodeIndex.from_mapping(mapping.get(sample_map.get(sample, sample), {}))
+        if by == "celltype":
+            # Only the cell types this sample's barcodes map to are given columns
+            present = np.zeros(len(labels), dtype=bool)
+            present[barcode_index.values_at(np.arange(len(barcode_index)))] = True
+            to_column = np.full(len(labels), -1, dtype=np.int64)
+            for label in np.flatnonzero(present):
+                to_column[label] = column_idx.setdefault(labels[label], len(column_idx))
+        else:
+            to_column = np.array([column_idx.setdefault(f"{sample}:{barcode}", len(column_idx))
+                                  for barcode in barcode_index.keys()], dtype=np.int64)
+        with pysam.AlignmentFile(str(bam_path), "rb") as bam:
+            for contig in bam.references:
+                contig_order.setdefault(contig, len(contig_order))
+        for shard in region_shards(str(bam_path), shard_size):
+            if shard[0] == UNPLACED:
+                continue
+            tasks.append((str(bam_path), shard, barcode_index, to_column, by == "barcode", sort_target, exclude_flags,
+                          min_intron, max_intron))
+            shards.append(shard)
+    columns = list(column_idx)
+
+    # Junctions seen in several shards or samples are given one global row
+    global_idx, thick = {}, []
+    row_chunks, col_chunks, count_chunks = [], [], []
+    for contig, keys, shard_thick, rows, cols, counts in map_shards(_count_shard, tasks, shards, processes):
+        remap = np.empty(len(keys), dtype=np.int64)
+        for i, ((start, end, strand), (ts, te)) in enumerate(zip(keys, shard_thick)):
+            g = global_idx.setdefault((contig, start, end, strand), len(global_idx))
+            if g == len(thick):
+                thick.append([ts, te])
+            else:
+                thick[g][0] = min(thick[g][0], ts)
+                thick[g][1] = max(thick[g][1], te)
+            remap[i] = g
+        row_chunks.append(remap[rows])
+        col_chunks.append(cols)
+        count_chunks.append(counts)
+
+    keys = list(global_idx)
+    thick = np.array(thick, dtype=np.int64).reshape(-1, 2)
+    start = np.array([k[1] for k in keys], dtype=np.int64)
+    end = np.array([k[2] for k in keys], dtype=np.int64)
+    keep = (start - thick[:, 0] >= min_anchor) & (thick[:, 1] - end >= min_anchor)
+    order = sorted(np.flatnonzero(keep), key=lambda i: (contig_order[keys[i][0]], keys[i][1], keys[i][2], keys[i][3]))
+    new_row = np.full(len(keys), -1, dtype=np.int64)
+    new_row[order] = np.arange(len(order))
+
+    rows = new_row[np.concatenate(row_chunks)] if row_chunks else np.zeros(0, dtype=np.int64)
+    cols = np.concatenate(col_chunks) if col_chunks else np.zeros(0, dtype=np.int64)
+    counts = np.concatenate(count_chunks) if count_chunks else np.zeros(0, dtype=np.int64)
+    kept = rows >= 0
+    # Entries of the same junction and column from different shards or samples are summed
+    linear, inverse = np.unique(rows[kept] * max(len(columns), 1) + cols[kept], return_inverse=True)
+    data = np.zeros(len(linear), dtype=np.int64)
+    np.add.at(data, inverse.ravel(), counts[kept])
+
+    return JunctionMatrix(
+        contig=np.array([keys[i][0] for i in order], dtype=str),
+        start=start[order],
+        end=end[order],
+        strand=np.array([keys[i][3] for i in order], dtype=str),
+        thick_start=thick[order, 0],
+        thick_end=thick[order, 1],
+        columns=np.array(columns, dtype=str),
+        row=linear // max(len(columns), 1),
+        col=linear % max(len(columns), 1),
+        data=data.astype(np.int64),
+    )
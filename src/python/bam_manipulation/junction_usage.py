@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Module: junction_usage
+
+Differential splice junction usage between cell types, genome-wide.
+
+Junction counts are loaded into a junction x cell type array from either a
+combined cell-type junction BED (``all_celltypes.junctions.bed.gz``, with
+names prefixed ``{celltype}_``) or a ``junction_matrix`` ``.npz``. Junctions
+sharing a splice donor (or acceptor) form a group, and a junction's usage in a
+cell type is its share of the group's reads there. For every pair of cell
+types, usage is compared with a two-proportion z-test, all in array
+operations. Results are ranked by Benjamini-Hochberg q-value, and per-cell-type
+BEDs of the differentially used junctions are written for plotting.
+
+Includes a CLI interface.
+"""
+
+import argparse
+import os
+import sys
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+
+from bam_manipulation.junction_matrix import JunctionMatrix, load_junction_matrix
+from bam_manipulation.junctions import bed12_fields, celltype_colors, write_bed
+
+SITES = ("donor", "acceptor")
+
+
+def load_junction_bed(path):
+    """
+    Load a concatenated cell-type junction BED12 into a ``JunctionMatrix``.
+
+    Cell types are taken from the name prefix (``Stem_C_JUNC00000001`` -> ``Stem_C``) and junctions are
+    matched across cell types by intron and strand.
+
+    Returns:
+        tuple: (``JunctionMatrix`` with one column per cell type, {celltype: "r,g,b"} from the BED).
+    """
+    df = pd.read_csv(path, sep="\t", header=None, usecols=range(12), dtype={0: str, 3: str, 5: str, 8: str},
+                     comment="#")
+    celltype = df[3].str.rsplit("_", n=1).str[0]
+    block_sizes = df[10].str.split(",", expand=True)
+    block_starts = df[11].str.split(",", expand=True)
+    start = df[1].to_numpy(np.int64) + block_sizes[0].astype(np.int64).to_numpy()
+    end = df[1].to_numpy(np.int64) + block_starts[1].astype(np.int64).to_numpy()
+
+    keys = pd.DataFrame({"contig": df[0], "start": start, "end": end, "strand": df[5]})
+    row, uniques = pd.factorize(pd.MultiIndex.from_frame(keys), sort=False)
+    col, columns = pd.factorize(celltype, sort=False)
+    thick_start = np.full(len(uniques), np.iinfo(np.int64).max)
+    thick_end = np.full(len(uniques), np.iinfo(np.int64).min)
+    np.minimum.at(thick_start, row, df[1].to_numpy(np.int64))
+    np.maximum.at(thick_end, row, df[2].to_numpy(np.int64))
+
+    linear, inverse = np.unique(row * len(columns) + col, return_inverse=True)
+    data = np.bincount(inverse, weights=df[4].to_numpy(np.int64)).astype(np.int64)
+    matrix = JunctionMatrix(
+        contig=uniques.get_level_values(0).to_numpy(str),
+        start=uniques.get_level_values(1).to_numpy(np.int64),
+        end=uniques.get_level_values(2).to_numpy(np.int64),
+        strand=uniques.get_level_values(3).to_numpy(str),
+        thick_start=thick_start,
+        thick_end=thick_end,
+        columns=np.asarray(columns, dtype=str),
+        row=linear // len(columns),
+        col=linear % len(columns),
+        data=data,
+    )
+    colors = dict(zip(celltype, df[8]))
+    return matrix, colors
+
+
+def load_junctions(path):
+    """Load a junction BED or ``.npz`` matrix; returns (``JunctionMatrix``, {celltype: "r,g,b"})."""
+    if str(path).endswith(".npz"):
+        matrix = load_junction_matrix(path)
+        return matrix, celltype_colors(list(matrix.columns))
+    return load_junction_bed(path)
+
+
+def site_groups(matrix, site="donor"):
+    """
+    Group junctions by shared splice site.
+
+    Donors are intron starts on the + strand and intron ends on the - strand (and the reverse for
+    acceptors). Junctions of unknown strand ("?") are treated as + strand.
+
+    Returns:
+        numpy.ndarray: Group index of each junction.
+    """
+    if site not in SITES:
+        raise ValueError(f"site must be one of {SITES}, not '{site}'.")
+    minus = matrix.strand == "-"
+    five_prime = np.where(minus, matrix.end, matrix.start)
+    three_prime = np.where(minus, matrix.start, matrix.end)
+    pos = five_prime if site == "donor" else three_prime
+    _, contig_idx = np.unique(matrix.contig, return_inverse=True)
+    keys = np.rec.fromarrays([contig_idx, minus, pos])
+    _, groups = np.unique(keys, return_inverse=True)
+    return groups.ravel()
+
+
+def usage_fractions(counts, groups):
+    """
+    Usage of each junction within its group, per column.
+
+    Args:
+        counts (numpy.ndarray): Junction x cell type counts.
+        groups (numpy.ndarray): Group index of each junction.
+
+    Returns:
+        tuple: (group totals per junction and column, usage fractions; NaN where the total is 0).
+    """
+    group_totals = np.zeros((groups.max() + 1 if len(groups) else 0, counts.shape[1]), dtype=np.int64)
+    np.add.at(group_totals, groups, counts)
+    totals = group_totals[groups]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        usage = counts / totals
+    return totals, usage
+
+
+def erfc(x):
+    """Complementary error function, element-wise, with fractional error below 1.2e-7."""
+    z = np.abs(x)
+    t = 1.0 / (1.0 + 0.5 * z)
+    poly = -z * z - 1.26551223 + t * (1.00002368 + t * (0.37409196 + t * (0.09678418 + t * (
+        -0.18628806 + t * (0.27886807 + t * (-1.13520398 + t * (1.48851587 + t * (-0.82215223 + t * 0.17087277))))))))
+    ans = t * np.exp(poly)
+    return np.where(x >= 0, ans, 2.0 - ans)
+
+
+def bh_qvalues(pvalues):
+    """Benjamini-Hochberg adjusted p-values."""
+    pvalues = np.asarray(pvalues, dtype=float)
+    n = len(pvalues)
+    if n == 0:
+        return pvalues
+    order = np.argsort(pvalues)
+    ranked = pvalues[order] * n / np.arange(1, n + 1)
+    ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+    qvalues = np.empty(n)
+    qvalues[order] = np.minimum(ranked, 1.0)
+    return qvalues
+
+
+def differential_usage(matrix, sites=SITES, pairs=None, min_total=10):
+    """
+    Test every junction for differential usage between pairs of cell types.
+
+    Args:
+        matrix (JunctionMatrix): Junction x cell type counts.
+        sites (tuple): Splice sites to group junctions by ("donor", "acceptor").
+        pairs (list, optional): (celltype_a, celltype_b) pairs; default all pairs of columns.
+        min_total (int): Minimum group total in both cell types for a junction to be tested.
+
+    Returns:
+        pandas.DataFrame: One row per tested (site, junction, pair), ranked by q-value then effect size.
+            Junctions alone at their site are not tested.
+    """
+    counts = matrix.to_dense()
+    column_idx = {c: i for i, c in enumerate(matrix.columns)}
+    if pairs is None:
+        pairs = list(combinations(matrix.columns, 2))
+    frames = []
+    for site in sites:
+        groups = site_groups(matrix, site)
+        alternative = np.bincount(groups)[groups] > 1
+        totals, usage = usage_fractions(counts, groups)
+        site_pos = np.where((matrix.strand == "-") == (site == "donor"), matrix.end, matrix.start)
+        for a, b in pairs:
+            i, j = column_idx[a], column_idx[b]
+            tested = np.flatnonzero(alternative & (totals[:, i] >= min_total) & (totals[:, j] >= min_total))
+            n_a, n_b = counts[tested, i], counts[tested, j]
+            t_a, t_b = totals[tested, i], totals[tested, j]
+            u_a, u_b = usage[tested, i], usage[tested, j]
+            with np.errstate(invalid="ignore", divide="ignore"):
+                pooled = (n_a + n_b) / (t_a + t_b)
+                se = np.sqrt(pooled * (1 - pooled) * (1 / t_a + 1 / t_b))
+                z = np.where(se > 0, (u_a - u_b) / se, 0.0)
+            frames.append(pd.DataFrame({
+                "contig": matrix.contig[tested],
+                "start": matrix.start[tested],
+                "end": matrix.end[tested],
+                "strand": matrix.strand[tested],
+                "site": site,
+                "site_pos": site_pos[tested],
+                "junction": tested,
+                "celltype_a": a,
+                "celltype_b": b,
+                "count_a": n_a,
+                "total_a": t_a,
+                "usage_a": u_a,
+                "count_b": n_b,
+                "total_b": t_b,
+                "usage_b": u_b,
+                "delta": u_a - u_b,
+                "z": z,
+                "pvalue": erfc(np.abs(z) / np.sqrt(2)),
+            }))
+    results = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    if results.empty:
+        return results
+    results["qvalue"] = bh_qvalues(results["pvalue"].to_numpy())
+    results["abs_delta"] = results["delta"].abs()
+    results = results.sort_values(["qvalue", "abs_delta"], ascending=[True, False], kind="stable")
+    return results.drop(columns="abs_delta").reset_index(drop=True)
+
+
+def write_filtered_beds(matrix, results, output_dir, colors=None, max_q=0.05, min_delta=0.1):
+    """
+    Write ``{celltype}.filtered.bed`` with the differentially used junctions supported in each cell type.
+
+    A junction is kept for a cell type if it passes ``max_q`` and ``min_delta`` in any pair involving
+    that cell type and has reads there. Records follow ``junctions.bed12_fields``.
+
+    Returns:
+        dict: Mapping {celltype: bed_path}.
+    """
+    colors = colors or celltype_colors(list(matrix.columns))
+    counts = matrix.to_dense()
+    significant = results[(results["qvalue"] <= max_q) & (results["delta"].abs() >= min_delta)]
+    os.makedirs(output_dir, exist_ok=True)
+    paths = {}
+    for c, celltype in enumerate(matrix.columns):
+        involved = significant[(significant["celltype_a"] == celltype) | (significant["celltype_b"] == celltype)]
+        rows = np.unique(involved["junction"].to_numpy(np.int64))
+        rows = rows[counts[rows, c] > 0]
+        records = [
+            bed12_fields(matrix.contig[r], (int(matrix.start[r]), int(matrix.end[r]), matrix.strand[r]),
+                         (int(counts[r, c]), int(matrix.thick_start[r]), int(matrix.thick_end[r])),
+                         f"{celltype}_JUNC{r + 1:08d}", colors.get(celltype, "0,0,0"))
+            for r in rows
+        ]
+        paths[celltype] = os.path.join(output_dir, f"{celltype.replace(' ', '_')}.filtered.bed")
+        write_bed(records, paths[celltype])
+    return paths
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Differential splice junction usage between cell types")
+    parser.add_argument("junctions",
+                        help="Cell-type junction BED (e.g. all_celltypes.junctions.bed.gz) or a junction_matrix .npz")
+    parser.add_argument("-o", "--output_dir", default=".", help="Directory for results and filtered BEDs (default: .)")
+    parser.add_argument("--min_total", type=int, default=10,
+                        help="Minimum reads at a splice site in both cell types to test it (default: 10)")
+    parser.add_argument("--max_q", type=float, default=0.05, help="q-value cutoff for filtered BEDs (default: 0.05)")
+    parser.add_argument("--min_delta", type=float, default=0.1,
+                        help="Minimum usage difference for filtered BEDs (default: 0.1)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    matrix, colors = load_junctions(args.junctions)
+    results = differential_usage(matrix, min_total=args.min_total)
+    os.makedirs(args.output_dir, exist_ok=True)
+    results_path = os.path.join(args.output_dir, "differential_junction_usage.tsv")
+    results.to_csv(results_path, sep="\t", index=False)
+    write_filtered_beds(matrix, results, args.output_dir, colors, max_q=args.max_q, min_delta=args.min_delta)
+    print(f"Tested {len(results)} junction/cell type pairs: {results_path}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
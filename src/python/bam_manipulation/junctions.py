@@ -0,0 +1,236 @@
+# pylint: disable=no-member
+"""
+Module: junctions
+
+Splice junction extraction from CIGAR ``N`` operations, producing the same
+BED12 records as ``regtools junctions extract -s XS``.
+
+Each junction record spans the intron plus the longest anchors seen on either
+side (chromStart/chromEnd and thickStart/thickEnd), the score is the number of
+supporting reads, strand is taken from the ``XS`` tag ("?" without one), and
+the two blocks are the anchors. Junctions are kept if the longest anchors on
+both sides are at least ``min_anchor`` and the intron length is within
+``[min_intron, max_intron]``, as with regtools' ``-a``, ``-m`` and ``-M``.
+
+Cell-type BAMs are split into (BAM, contig) shards counted in a process pool,
+and cell-type colours and name prefixes are applied as records are formatted.
+Per-cell-type BEDs can be k-way merged into one sorted, bgzipped and
+tabix-indexed track for region queries in JBrowse or pyGenomeTracks.
+"""
+
+import colorsys
+import heapq
+
+import pysam
+
+from bam_manipulation.sharding import region_shards, fetch_shard, map_shards, UNPLACED
+
+MIN_ANCHOR = 8
+MIN_INTRON = 70
+MAX_INTRON = 500000
+DEFAULT_RGB = "255,0,0"
+# Unmapped, secondary, QC-fail and duplicate reads do not support junctions
+EXCLUDE_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+
+# CIGAR operations consuming the reference: M, D, N, =, X
+_REF_OPS = {0, 2, 3, 7, 8}
+_REF_SKIP = 3
+
+
+def read_strand(read):
+    """Junction strand of a read from its ``XS`` tag, "?" if it has none."""
+    try:
+        return read.get_tag("XS")
+    except KeyError:
+        return "?"
+
+
+def read_junctions(read):
+    """
+    Introns of a read with the reference span of the aligned blocks either side.
+
+    Returns:
+        list: ``(intron_start, intron_end, left_anchor, right_anchor)`` tuples, 0-based half-open.
+    """
+    blocks, introns = [], []
+    pos = block_start = read.reference_start
+    for op, length in read.cigartuples:
+        if op == _REF_SKIP:
+            blocks.append(pos - block_start)
+            introns.append((pos, pos + length))
+            block_start = pos + length
+        if op in _REF_OPS:
+            pos += length
+    if not introns:
+        return []
+    blocks.append(pos - block_start)
+    return [(start, end, blocks[i], blocks[i + 1]) for i, (start, end) in enumerate(introns)]
+
+
+def count_junctions(reads, exclude_flags=EXCLUDE_FLAGS):
+    """
+    Tally junctions over reads of one contig.
+
+    Returns:
+        dict: Mapping {(intron_start, intron_end, strand): [reads, thick_start, thick_end]}.
+    """
+    counts = {}
+    for read in reads:
+        if read.flag & exclude_flags or "N" not in (read.cigarstring or ""):
+            continue
+        strand = None
+        for start, end, left, right in read_junctions(read):
+            if strand is None:
+                strand = read_strand(read)
+            entry = counts.get((start, end, strand))
+            if entry is None:
+                counts[(start, end, strand)] = [1, start - left, end + right]
+            else:
+                entry[0] += 1
+                entry[1] = min(entry[1], start - left)
+                entry[2] = max(entry[2], end + right)
+    return counts
+
+
+def merge_junction_counts(into, other):
+    """Add the counts of ``other`` to ``into``, as returned by ``count_junctions``."""
+    for key, (n, thick_start, thick_end) in other.items():
+        entry = into.get(key)
+        if entry is None:
+            into[key] = [n, thick_start, thick_end]
+        else:
+            entry[0] += n
+            entry[1] = min(entry[1], thick_start)
+            entry[2] = max(entry[2], thick_end)
+    return into
+
+
+def filter_junctions(counts, min_anchor=MIN_ANCHOR, min_intron=MIN_INTRON, max_intron=MAX_INTRON):
+    """Junctions passing the anchor and intron length filters, sorted by position."""
+    passed = [(key, entry) for key, entry in counts.items()
+              if min_intron <= key[1] - key[0] <= max_intron
+              and key[0] - entry[1] >= min_anchor and entry[2] - key[1] >= min_anchor]
+    return sorted(passed, key=lambda kv: (kv[1][1], kv[1][2], kv[0]))
+
+
+def bed12_fields(contig, key, entry, name, rgb=DEFAULT_RGB):
+    """BED12 fields of a junction, as strings, in the layout of regtools."""
+    start, end, strand = key
+    n, thick_start, thick_end = entry
+    return [contig, str(thick_start), str(thick_end), name, str(n), strand, str(thick_start), str(thick_end), rgb,
+            "2", f"{start - thick_start},{thick_end - end}", f"0,{end - thick_start}"]
+
+
+def celltype_colors(celltypes):
+    """Evenly spaced colours, as "r,g,b" strings, for cell types in the given order."""
+    n = len(celltypes)
+    colors = {}
+    for i, celltype in enumerate(celltypes):
+        r, g, b = colorsys.hsv_to_rgb(i / n, 0.7, 0.9)
+        colors[celltype] = f"{int(r * 255)},{int(g * 255)},{int(b * 255)}"
+    return colors
+
+
+def _count_shard(task):
+    bam_path, shard, exclude_flags = task
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        return count_junctions(fetch_shard(bam, shard), exclude_flags)
+
+
+def junction_beds(bams, processes=1, shard_size=None, colors=None, name_prefix=True, min_anchor=MIN_ANCHOR,
+                  min_intron=MIN_INTRON, max_intron=MAX_INTRON, exclude_flags=EXCLUDE_FLAGS):
+    """
+    Extract junction BED12 records from several BAMs in one parallel pass.
+
+    Args:
+        bams (dict): Mapping {label: bam_path}, e.g. {celltype: merged cell-type BAM}. BAMs must be
+            coordinate-sorted and indexed.
+        processes (int): Worker processes shared by the (BAM, contig) shards of all BAMs.
+        shard_size (int, optional): Maximum shard length in bp (default: one shard per contig).
+        colors (dict, optional): Mapping {label: "r,g,b"} for itemRgb; labels not in it keep regtools' colour.
+        name_prefix (bool): Prefix junction names with ``{label}_``.
+        min_anchor, min_intron, max_intron (int): Filters as regtools ``-a``, ``-m`` and ``-M``.
+        exclude_flags (int): Reads with any of these SAM flags are ignored.
+
+    Returns:
+        dict: Mapping {label: list of BED12 field lists}. Names are ``JUNC%08d``, numbered per BAM in
+        output order as regtools does.
+    """
+    colors = colors or {}
+    tasks, shards, owners = [], [], []
+    for label, bam_path in bams.items():
+        for shard in region_shards(str(bam_path), shard_size):
+            if shard[0] == UNPLACED:
+                continue
+            tasks.append((str(bam_path), shard, exclude_flags))
+            shards.append(shard)
+            owners.append(label)
+
+    # Shards of one contig are merged before filtering, as anchors of a junction can come from reads in either
+    per_contig = {label: {} for label in bams}
+    for label, shard, counts in zip(owners, shards, map_shards(_count_shard, tasks, shards, processes)):
+        merge_junction_counts(per_contig[label].setdefault(shard[0], {}), counts)
+
+    beds = {}
+    for label, contigs in per_contig.items():
+        rgb = colors.get(label, DEFAULT_RGB)
+        rows = []
+        for contig, counts in contigs.items():
+            for key, entry in filter_junctions(counts, min_anchor, min_intron, max_intron):
+                name = f"JUNC{len(rows) + 1:08d}"
+                if name_prefix:
+                    name = f"{label}_{name}"
+                rows.append(bed12_fields(contig, key, entry, name, rgb))
+        beds[label] = rows
+    return beds
+
+
+def write_bed(rows, path):
+    """Write BED field lists to ``path``."""
+    with open(path, "w") as fh:
+        fh.writelines("\t".join(fields) + "\n" for fields in rows)
+
+
+def _read_bed(path):
+    with open(path) as fh:
+        for line in fh:
+            if line.strip() and not line.startswith(("#", "track", "browser")):
+                yield line.rstrip("\n").split("\t")
+
+
+def _bed_contigs(paths):
+    contigs = {}
+    for path in paths:
+        for fields in _read_bed(path):
+            contigs.setdefault(fields[0], None)
+    return list(contigs)
+
+
+def merge_bed_track(bed_paths, output, contig_order=None, csi=False):
+    """
+    K-way merge coordinate-sorted BEDs into one bgzipped, tabix-indexed track.
+
+    Records are streamed in (contig, start, end) order into BGZF, so memory use does not grow with the
+    number of cell types or samples merged.
+
+    Args:
+        bed_paths (list): BED files, each sorted by position within contigs in ``contig_order``
+            (as written by ``junction_beds`` and ``write_bed``).
+        output (str): Output path, e.g. ``all_celltypes.junctions.bed.gz``.
+        contig_order (list, optional): Contig names in sort order, e.g. a BAM's ``references``. Defaults to
+            the order in which contigs first appear in the inputs.
+        csi (bool): Write a CSI index (``.csi``, needed for contigs over 512 Mbp) instead of ``.tbi``.
+
+    Returns:
+        str: Path of the index.
+    """
+    bed_paths = [str(p) for p in bed_paths]
+    if contig_order is None:
+        contig_order = _bed_contigs(bed_paths)
+    rank = {contig: i for i, contig in enumerate(contig_order)}
+    merged = heapq.merge(*[_read_bed(p) for p in bed_paths], key=lambda f: (rank[f[0]], int(f[1]), int(f[2])))
+    with pysam.BGZFile(str(output), "wb") as out:
+        for fields in merged:
+            out.write(("\t".join(fields) + "\n").encode())
+    pysam.tabix_index(str(output), preset="bed", force=True, csi=csi)
+    return f"{output}.csi" if csi else f"{output}.tbi"
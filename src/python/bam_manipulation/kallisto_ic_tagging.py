@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Module: kallisto_ic_tagging
+
+Single-stage replacement for ``read_to_transcripts_tsv`` -> ``tx_name_to_id``
+-> ``add_ic_tag``: streams a kallisto pseudobam, numbers transcripts per gene
+as ``wp3_add_custom_tags.load_cluster_map`` does, and tags the genome BAM with
+the resulting isoform cluster IDs.
+
+Read names are kept only as 64-bit hashes in a memory-mapped ``ClusterIndex``,
+so no intermediate table is written or parsed unless requested for debugging.
+Hashes are spilled to disk in sorted runs while the pseudobam is read, so memory
+stays bounded whatever the number of reads.
+
+Includes a CLI interface.
+"""
+
+import argparse
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+from collections import defaultdict
+from contextlib import ExitStack
+
+import numpy as np
+
+from bam_manipulation.read_cluster_index import ClusterIndexWriter, hash_read_names
+from bam_manipulation.read_to_transcripts_tsv import HEADER, format_rows, iter_read_transcripts
+from bam_manipulation.wp3_add_custom_tags import add_isoform_tags
+
+
+def build_index_from_pseudobam(pseudobam, gtf, index_dir, prob_assignment=0.8, threads=1, best_per_read=False,
+                               read_transcripts_tsv=None, clusters_tsv=None, chunk_size=1_000_000):
+    """
+    Build a read-to-cluster index straight from a pseudobam.
+
+    Cluster IDs equal those of ``load_cluster_map`` on the ``read_to_transcripts_tsv`` table (with
+    ``gene_col=3, transcript_col=2``): transcripts are numbered from 1 within each gene in order of
+    first appearance, and the last passing alignment of a read wins.
+
+    Args:
+        pseudobam (str): kallisto --pseudobam output.
+        gtf (str): GTF the kallisto index was built from, typically from StringTie.
+        index_dir (str): Directory to write the index to.
+        prob_assignment (float): Minimum ZW for an alignment to be used.
+        threads (int): BGZF decompression threads.
+        best_per_read (bool): Use only the highest-ZW passing alignment of each read.
+        read_transcripts_tsv (str, optional): Debug output; the table ``read_to_transcripts_tsv`` writes (gzipped).
+        clusters_tsv (str, optional): Debug output; read name and cluster ID of every passing alignment.
+        chunk_size (int): Alignments per sorted run (see ``read_cluster_index.ClusterIndexWriter``).
+
+    Returns:
+        ClusterIndex: The opened index.
+    """
+    next_idx = defaultdict(lambda: 1)
+    cluster_ids = {}
+    writer = ClusterIndexWriter(index_dir, chunk_size)
+
+    with ExitStack() as stack:
+        rt_out = cl_out = None
+        if read_transcripts_tsv:
+            rt_out = stack.enter_context(gzip.open(read_transcripts_tsv, "wt", compresslevel=6))
+            rt_out.write("\t".join(HEADER) + "\n")
+        if clusters_tsv:
+            cl_out = stack.enter_context(open(clusters_tsv, "w"))
+
+        for names, transcripts, genes, zw in iter_read_transcripts(pseudobam, gtf, prob_assignment, threads,
+                                                                   best_per_read):
+            # Same numbering as number_transcripts, assigned as pairs are first seen
+            cids = np.empty(len(names), dtype=np.int32)
+            for i, pair in enumerate(zip(genes, transcripts)):
+                cid = cluster_ids.get(pair)
+                if cid is None:
+                    cid = cluster_ids[pair] = next_idx[pair[0]]
+                    next_idx[pair[0]] += 1
+                cids[i] = cid
+            writer.add(hash_read_names(names), cids)
+            if rt_out is not None:
+                rt_out.writelines(format_rows(names, transcripts, genes, zw))
+            if cl_out is not None:
+                cl_out.writelines(f"{name}\t{cid}\n" for name, cid in zip(names, cids.tolist()))
+
+    return writer.finish(os.path.abspath(pseudobam))
+
+
+def kallisto_ic_tagging(pseudobam, gtf, input_bam, output_bam, prob_assignment=0.8, best_per_read=False,
+                        processes=1, threads=1, index_dir=None, read_transcripts_tsv=None, clusters_tsv=None):
+    """
+    Tag a genome BAM with isoform cluster IDs from a kallisto pseudobam.
+
+    Args:
+        pseudobam (str): kallisto --pseudobam output.
+        gtf (str): GTF the kallisto index was built from.
+        input_bam (str): Coordinate-sorted, indexed genome BAM to tag.
+        output_bam (str): Path to output BAM to write; it is indexed as well.
+        prob_assignment (float): Minimum ZW for an alignment to be used.
+        best_per_read (bool): Use only the highest-ZW passing alignment of each read.
+        processes (int): Worker processes for tagging (see ``add_isoform_tags``).
+        threads (int): BGZF threads per process.
+        index_dir (str, optional): Keep the read-to-cluster index here; by default it is temporary.
+        read_transcripts_tsv, clusters_tsv (str, optional): Debug tables, see ``build_index_from_pseudobam``.
+
+    Returns:
+        int: Number of reads with a cluster ID in the index.
+    """
+    work_dir = None
+    if index_dir is None:
+        work_dir = tempfile.mkdtemp(prefix=".ic_index.", dir=os.path.dirname(os.path.abspath(output_bam)))
+        index_dir = work_dir
+    try:
+        index = build_index_from_pseudobam(pseudobam, gtf, index_dir, prob_assignment=prob_assignment,
+                                           threads=threads, best_per_read=best_per_read,
+                                           read_transcripts_tsv=read_transcripts_tsv, clusters_tsv=clusters_tsv)
+        add_isoform_tags(input_bam, output_bam, cluster_map=index, processes=processes, threads=threads)
+        return len(index)
+    finally:
+        if work_dir is not None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Tag a genome BAM with per-gene isoform cluster IDs from a kallisto pseudobam"
+    )
+    parser.add_argument("--pseudobam", required=True, help="kallisto --pseudobam output")
+    parser.add_argument("--gtf", "-g", required=True, help="GTF file, typically from stringtie")
+    parser.add_argument("-i", "--input", help="Input genome BAM (coordinate-sorted, indexed)")
+    parser.add_argument("-o", "--output", help="Output BAM with IC tag")
+    parser.add_argument(
+        "--prob-assignment", "-p", type=float, default=0.8,
+        help="Use alignments where the ZW tag (posterior probability of assignment) is at least this much [%(default)s]",
+    )
+    parser.add_argument(
+        "--best-per-read", action="store_true",
+        help="Use only the highest-ZW passing alignment of each multimapped read",
+    )
+    parser.add_argument("--processes", type=int, default=1, help="Worker processes for tagging [%(default)s]")
+    parser.add_argument("--threads", type=int, default=1, help="BGZF threads per process [%(default)s]")
+    parser.add_argument(
+        "--index-dir",
+        help="Keep the read to cluster ID index in this directory; without -i/-o, only build the index "
+             "(e.g. for tagging shards separately with wp3_add_custom_tags --index)",
+    )
+    parser.add_argument("--read-transcripts", help="Debug: also write the read/transcript/gene table (.tsv.gz)")
+    parser.add_argument("--clusters", help="Debug: also write read name and cluster ID per alignment (.tsv)")
+    args = parser.parse_args(argv)
+    if (args.input is None) != (args.output is None):
+        parser.error("-i/--input and -o/--output must be given together")
+    if args.input is None and args.index_dir is None:
+        parser.error("--index-dir is required when not tagging a BAM")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.input is None:
+        index = build_index_from_pseudobam(args.pseudobam, args.gtf, args.index_dir,
+                                           prob_assignment=args.prob_assignment, threads=args.threads,
+                                           best_per_read=args.best_per_read,
+                                           read_transcripts_tsv=args.read_transcripts, clusters_tsv=args.clusters)
+        print(f"Indexed {len(index)} reads: {args.index_dir}")
+        return
+    n_reads = kallisto_ic_tagging(args.pseudobam, args.gtf, args.input, args.output,
+                                  prob_assignment=args.prob_assignment, best_per_read=args.best_per_read,
+                                  processes=args.processes, threads=args.threads, index_dir=args.index_dir,
+                                  read_transcripts_tsv=args.read_transcripts, clusters_tsv=args.clusters)
+    print(f"Assigned clusters to {n_reads} reads. Written and indexed: {args.output}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,89 @@
+"""
+Module: key_expression
+
+Composite grouping keys for splitting a BAM on several tags at once.
+
+A key expression names the values a read is grouped by. Levels separated by
+``/`` become nested output directories, the last level naming the BAM file;
+within a level, ``+`` joins several values into one name. Each value is either
+a SAM tag (e.g. ``IC``, ``UB``) or ``celltype``, the group the barcode tag
+(``CB`` by default) is assigned in the barcode mapping. For example:
+
+    celltype/IC   ->  Muscle/IC_1.bam, Muscle/IC_2.bam, Stem_A/IC_1.bam, ...
+    CB+UB         ->  CB_AAACCTG-1_UB_GGTTAC.bam, ...
+"""
+
+import re
+
+MAPPED = "celltype"
+_TAG = re.compile(r"^[A-Za-z][A-Za-z0-9]$")
+
+
+class KeyExpression:
+    """
+    A parsed key expression.
+
+    Args:
+        expression (str): Levels separated by "/", values within a level by "+", e.g. "celltype/IC".
+        mapped_tag (str): Tag whose mapped group ``celltype`` refers to (default CB).
+
+    Raises:
+        ValueError: If a value is neither ``celltype`` nor a two-character SAM tag, or a level is empty.
+    """
+
+    def __init__(self, expression, mapped_tag="CB"):
+        self.expression = expression
+        self.mapped_tag = mapped_tag
+        self.levels = []
+        for level in expression.split("/"):
+            components = [c.strip() for c in level.split("+")]
+            for component in components:
+                if component != MAPPED and not _TAG.match(component):
+                    raise ValueError(f"Invalid key '{component}' in '{expression}': expected '{MAPPED}' or a SAM tag.")
+            self.levels.append(components)
+        self.components = [c for level in self.levels for c in level]
+        if len(set(self.components)) != len(self.components):
+            raise ValueError(f"Repeated key in '{expression}'.")
+
+    def __repr__(self):
+        return f"KeyExpression({self.expression!r}, mapped_tag={self.mapped_tag!r})"
+
+    @property
+    def uses_mapping(self):
+        """Whether the expression needs the barcode mapping."""
+        return MAPPED in self.components
+
+    def values(self, read, mapped_value=None):
+        """
+        Group of a read: one string per component, in expression order.
+
+        Args:
+            read (pysam.AlignedSegment): Read to group.
+            mapped_value (str, optional): The read's ``celltype``, resolved by the caller.
+
+        Returns:
+            tuple: Component values, or None if the read lacks one of the tags.
+        """
+        group = []
+        for component in self.components:
+            if component == MAPPED:
+                group.append(mapped_value)
+                continue
+            try:
+                group.append(str(read.get_tag(component)))
+            except KeyError:
+                return None
+        return tuple(group)
+
+    def output_name(self, group, output=False):
+        """Path of a group's BAM relative to the output directory, e.g. ``Muscle/IC_3.bam``."""
+        names = iter(_value_name(c, v) for c, v in zip(self.components, group))
+        parts = ["_".join(next(names) for _ in level) for level in self.levels]
+        if output:
+            parts[-1] = output + "_" + parts[-1]
+        return "/".join(parts) + ".bam"
+
+
+def _value_name(component, value):
+    value = str(value).replace(" ", "_").replace("/", "_")
+    return value if component == MAPPED else f"{component}_{value}"
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Module: mapping_registry
+
+Compiled barcode mappings, shared by every tool that reads ``cc_barcode.csv``.
+
+A mapping CSV (sample, cell barcode, cell type) is parsed once into a directory
+of NumPy arrays holding, per entry, the sample, the 2-bit packed barcode (see
+``bam_manipulation.barcodes``) and the cell type, sorted by sample and then
+barcode. The directory is named after a SHA-256 of the CSV contents and the
+column settings, under a cache directory (``$BAM_MAPPING_CACHE``, or
+``bam_manipulation/mappings`` in the user cache directory, ``$XDG_CACHE_HOME``
+or ``~/.cache``). Any later load of the same CSV, by any tool, opens the
+cached arrays instead of parsing the CSV again. The arrays are memory-mapped
+read-only, and the per-sample ``BarcodeIndex`` built on them pickles by path,
+so worker processes map the same pages rather than each receiving a copy.
+
+Includes a CLI interface for compiling a mapping ahead of a batch of jobs.
+"""
+
+import argparse
+import errno
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from bam_manipulation.barcodes import INVALID, BarcodeIndex, decode_barcode, encode_barcodes
+
+CACHE_ENV = "BAM_MAPPING_CACHE"
+CACHE_SUBDIR = os.path.join("bam_manipulation", "mappings")
+SAMPLES_FILE = "samples.npy"
+CODES_FILE = "codes.npy"
+CELLTYPES_FILE = "celltypes.npy"
+META_FILE = "meta.json"
+FORMAT_VERSION = 1
+
+
+def default_cache_dir():
+    """``$BAM_MAPPING_CACHE``, or the mapping cache in the user cache directory (``$XDG_CACHE_HOME`` or ``~/.cache``)."""
+    if os.environ.get(CACHE_ENV):
+        return os.environ[CACHE_ENV]
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), CACHE_SUBDIR)
+
+
+def mapping_digest(mapping_file, sample_col="sample", barcode_col="cell_barcode", celltype_col="Cluster", delim=","):
+    """SHA-256 of a mapping file's contents together with the settings it is parsed with."""
+    h = hashlib.sha256(json.dumps([FORMAT_VERSION, sample_col, barcode_col, celltype_col, delim]).encode())
+    with open(mapping_file, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def compile_mapping(mapping_file, cache_dir=None, sample_col="sample", barcode_col="cell_barcode",
+                    celltype_col="Cluster", delim=","):
+    """
+    Compile a mapping CSV into the cache, unless an artifact for the same contents is already there.
+
+    As with ``split_merge_by_celltype.load_sample_mapping``, the last row for a sample and barcode wins.
+
+    Args:
+        mapping_file (str): Delimited file with sample, barcode and cell type columns.
+        cache_dir (str, optional): Cache directory (default: ``default_cache_dir()``).
+        sample_col (str, optional): Column telling samples apart; None for a single-sample file such as
+            the ``Cluster``/``cell_barcode`` mappings read by ``bamTagHandling``.
+        barcode_col (str): Column of cell barcodes (CB tag values).
+        celltype_col (str): Column of cell type names.
+        delim (str): Column delimiter (default comma).
+
+    Returns:
+        CompiledMapping: The opened artifact.
+    """
+    cache_dir = cache_dir or default_cache_dir()
+    digest = mapping_digest(mapping_file, sample_col, barcode_col, celltype_col, delim)
+    path = os.path.join(cache_dir, digest[:24])
+    if _is_current(path, digest):
+        return CompiledMapping(path)
+
+    columns = [c for c in (sample_col, barcode_col, celltype_col) if c is not None]
+    df = pd.read_csv(mapping_file, sep=delim, usecols=columns, dtype=str, keep_default_na=False)
+    samples, sample_names = pd.factorize(df[sample_col]) if sample_col else (np.zeros(len(df), dtype=np.int64), [""])
+    celltypes, celltype_names = pd.factorize(df[celltype_col])
+    barcodes = df[barcode_col].tolist()
+    codes = encode_barcodes(barcodes)
+
+    # Barcodes that cannot be packed (not A/C/G/T) are kept in the metadata, last row winning
+    extra = {}
+    for i in np.flatnonzero(codes == INVALID):
+        extra.setdefault(str(sample_names[samples[i]]), {})[barcodes[i]] = int(celltypes[i])
+    keep = codes != INVALID
+    samples, codes, celltypes = samples[keep], codes[keep], celltypes[keep]
+    # Last entry per (sample, barcode): stable-sort the reversed rows and take the first of each run
+    samples, codes, celltypes = samples[::-1], codes[::-1], celltypes[::-1]
+    order = np.lexsort((codes, samples))
+    samples, codes, celltypes = samples[order], codes[order], celltypes[order]
+    first = np.ones(len(codes), dtype=bool)
+    first[1:] = (codes[1:] != codes[:-1]) | (samples[1:] != samples[:-1])
+    samples, codes, celltypes = samples[first].astype(np.int32), codes[first], celltypes[first].astype(np.int32)
+    offsets = np.searchsorted(samples, np.arange(len(sample_names) + 1)).tolist()
+
+    # Written to a temporary directory and renamed, so concurrent jobs never see a partial artifact
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = tempfile.mkdtemp(prefix=".tmp.", dir=cache_dir)
+    np.save(os.path.join(tmp_path, SAMPLES_FILE), samples)
+    np.save(os.path.join(tmp_path, CODES_FILE), codes)
+    np.save(os.path.join(tmp_path, CELLTYPES_FILE), celltypes)
+    meta = {
+        "version": FORMAT_VERSION,
+        "source": os.path.abspath(mapping_file),
+        "digest": digest,
+        "columns": {"sample": sample_col, "barcode": barcode_col, "celltype": celltype_col, "delim": delim},
+        "samples": [str(s) for s in sample_names],
+        "celltypes": [str(c) for c in celltype_names],
+        "offsets": offsets,
+        "extra": extra,
+    }
+    with open(os.path.join(tmp_path, META_FILE), "w") as fh:
+        json.dump(meta, fh)
+    while True:
+        try:
+            os.rename(tmp_path, path)
+            break
+        except OSError as e:
+            if e.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                raise
+        if _is_current(path, digest):
+            # Another job compiled the same mapping first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            break
+        # An incomplete or outdated entry (e.g. from a crashed job or an older format) is moved aside and replaced
+        stale_path = tempfile.mkdtemp(prefix=".stale.", dir=cache_dir)
+        try:
+            os.rename(path, os.path.join(stale_path, "entry"))
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(stale_path, ignore_errors=True)
+    return CompiledMapping(path)
+
+
+def _is_current(path, digest):
+    """Return True if ``path`` holds a complete artifact of ``digest`` in the current format."""
+    if not is_compiled_mapping(path):
+        return False
+    try:
+        with open(os.path.join(path, META_FILE)) as fh:
+            meta = json.load(fh)
+    except (OSError, ValueError):
+        return False
+    return meta.get("version") == FORMAT_VERSION and meta.get("digest") == digest
+
+
+class MappedBarcodeIndex(BarcodeIndex):
+    """``BarcodeIndex`` over one sample of a compiled mapping; pickles by path and re-maps the arrays."""
+
+    def __reduce__(self):
+        return (_open_sample_index, (self.mapping_path, self.sample))
+
+
+def _open_sample_index(path, sample):
+    return CompiledMapping(path).index(sample)[0]
+
+
+class CompiledMapping:
+    """
+    Read-only, memory-mapped barcode mapping.
+
+    Stands in for the {sample: {barcode: celltype}} dict of ``load_sample_mapping``: ``get(sample)``
+    returns that sample's dict, and ``index(sample)`` a ``BarcodeIndex`` backed by the mapped arrays.
+
+    Args:
+        path (str): Artifact directory written by ``compile_mapping``.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        with open(os.path.join(self.path, META_FILE)) as fh:
+            meta = json.load(fh)
+        self.digest = meta["digest"]
+        self.source = meta["source"]
+        self.samples = meta["samples"]
+        self.celltypes = meta["celltypes"]
+        self._offsets = meta["offsets"]
+        self._extra = meta["extra"]
+        self._sample_idx = {sample: i for i, sample in enumerate(self.samples)}
+        self.sample_array = np.load(os.path.join(self.path, SAMPLES_FILE), mmap_mode="r")
+        self.codes = np.load(os.path.join(self.path, CODES_FILE), mmap_mode="r")
+        self.celltype_array = np.load(os.path.join(self.path, CELLTYPES_FILE), mmap_mode="r")
+
+    def __reduce__(self):
+        return (CompiledMapping, (self.path,))
+
+    def __repr__(self):
+        return f"CompiledMapping({self.path!r})"
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __iter__(self):
+        return iter(self.samples)
+
+    def __contains__(self, sample):
+        return sample in self._sample_idx
+
+    def _sample(self, sample):
+        if sample is None:
+            if len(self.samples) != 1:
+                raise ValueError(f"Mapping has {len(self.samples)} samples; name one of {self.samples}.")
+            return self.samples[0]
+        return sample
+
+    def index(self, sample=None):
+        """
+        Barcode index of one sample, without copying the mapped arrays.
+
+        Args:
+            sample (str, optional): Sample name; may be omitted for a single-sample mapping.
+
+        Returns:
+            tuple: (``BarcodeIndex`` whose values index into the labels, list of cell type labels).
+                A sample not in the mapping gets an empty index.
+        """
+        sample = self._sample(sample)
+        i = self._sample_idx.get(sample)
+        if i is None:
+            index = MappedBarcodeIndex.from_arrays(np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=np.int32))
+        else:
+            start, end = self._offsets[i], self._offsets[i + 1]
+            index = MappedBarcodeIndex.from_arrays(self.codes[start:end], self.celltype_array[start:end],
+                                                   self._extra.get(sample))
+        index.mapping_path, index.sample = self.path, sample
+        return index, self.celltypes
+
+    def get(self, sample, default=None):
+        """{barcode: celltype} of one sample, or ``default`` if it is not in the mapping."""
+        i = self._sample_idx.get(sample)
+        if i is None:
+            return default
+        start, end = self._offsets[i], self._offsets[i + 1]
+        tags = {decode_barcode(code): self.celltypes[ct]
+                for code, ct in zip(self.codes[start:end].tolist(), self.celltype_array[start:end].tolist())}
+        tags.update((barcode, self.celltypes[ct]) for barcode, ct in self._extra.get(sample, {}).items())
+        return tags
+
+    def items(self):
+        return ((sample, self.get(sample)) for sample in self.samples)
+
+
+def is_compiled_mapping(path):
+    """Return True if ``path`` is a directory holding a compiled mapping."""
+    return all(os.path.isfile(os.path.join(path, name)) for name in (CODES_FILE, CELLTYPES_FILE, META_FILE))
+
+
+def load_mapping(mapping, cache_dir=None, **mapping_kwargs):
+    """
+    Open a mapping given in any of the forms the tools accept.
+
+    Args:
+        mapping (str or CompiledMapping): A ``CompiledMapping``, a compiled artifact directory, or a mapping
+            CSV, which is compiled into the cache (or found there) first.
+        cache_dir (str, optional): Cache directory for compiling.
+        **mapping_kwargs: Column names and delimiter passed to ``compile_mapping``.
+
+    Returns:
+        CompiledMapping: The opened mapping.
+    """
+    if isinstance(mapping, CompiledMapping):
+        return mapping
+    if os.path.isdir(mapping) and is_compiled_mapping(mapping):
+        return CompiledMapping(mapping)
+    return compile_mapping(mapping, cache_dir, **mapping_kwargs)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compile a barcode mapping CSV into the shared mapping cache")
+    parser.add_argument("mapping", help="Mapping CSV, e.g. cc_barcode.csv")
+    parser.add_argument("--cache-dir", help=f"Cache directory (default: ${CACHE_ENV} or $XDG_CACHE_HOME/{CACHE_SUBDIR})")
+    parser.add_argument("--sample-col", default="sample", help="Sample column; 'none' for a single-sample file (default: sample)")
+    parser.add_argument("--barcode-col", default="cell_barcode", help="Barcode column (default: cell_barcode)")
+    parser.add_argument("--celltype-col", default="Cluster", help="Cell type column (default: Cluster)")
+    parser.add_argument("--delim", default=",", help="Column delimiter (default: comma)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    compiled = compile_mapping(args.mapping, args.cache_dir,
+                               sample_col=None if args.sample_col.lower() == "none" else args.sample_col,
+                               barcode_col=args.barcode_col, celltype_col=args.celltype_col, delim=args.delim)
+    print(f"Compiled {len(compiled.codes)} barcodes of {len(compiled)} samples: {compiled.path}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
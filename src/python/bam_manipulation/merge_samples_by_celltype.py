@@ -1,17 +1,150 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import get_context
 from pathlib import Path
 
 import pysam
 
+MANIFEST_NAME = "merge_manifest.json"
 
-def merge_samples_by_celltype(input_dir, output_dir, samples=["Mira_1", "Mira_2", "Mira_3", "Mira_4"], threads=1):
-    celltypes = set()
+
+def find_celltype_inputs(input_dir, samples):
+    """
+    Find the per-sample cell-type BAMs written by ``bamTagHandling``.
+
+    Only files named exactly ``{sample}_files/{sample}_{celltype}.bam`` are matched, so
+    e.g. ``Stem_C`` inputs are never picked up when merging ``Stem_C_2``.
+
+    Returns:
+        dict: Mapping {celltype: [bam_path, ...]} with inputs sorted by sample.
+    """
+    inputs = {}
     for sample in samples:
         p = Path(input_dir) / f"{sample}_files"
-        for child in p.glob(f"{sample}_*.bam"):
-            celltypes.add(child.name.split(sample + "_")[1].split(".bam")[0])
+        for child in sorted(p.glob(f"{sample}_*.bam")):
+            ct = child.name[len(sample) + 1:-len(".bam")]
+            inputs.setdefault(ct, []).append(child)
+    return inputs
+
+
+def file_checksum(path, chunk_size=1 << 20):
+    """Return the BLAKE2b hex digest of a file's contents."""
+    digest = hashlib.blake2b()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _file_record(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def _inputs_unchanged(bam_files, previous):
+    """
+    Compare inputs with their manifest records, falling back to checksums when only mtimes differ.
+    Records of inputs that were touched but not modified are refreshed in place.
+    """
+    if previous is None or set(previous) != {str(b) for b in bam_files}:
+        return False
+    for b in bam_files:
+        record = previous[str(b)]
+        current = _file_record(b)
+        if current["size"] != record["size"]:
+            return False
+        if current["mtime"] != record["mtime"]:
+            if file_checksum(b) != record.get("checksum"):
+                return False
+            record["mtime"] = current["mtime"]
+    return True
+
+
+def _merge_celltype(task):
+    out_path, bam_files, threads = task
+    pysam.merge("-f", "-o", out_path, "-@", str(threads), *[str(b) for b in bam_files])
+    pysam.index(out_path, "-@", str(threads))
+    return {str(b): dict(_file_record(b), checksum=file_checksum(b)) for b in bam_files}
+
+
+def _save_manifest(manifest_path, manifest, celltypes):
+    manifest = {ct: manifest[ct] for ct in celltypes if ct in manifest}
+    tmp_path = manifest_path.with_suffix(".json.tmp")
+    with open(tmp_path, "w") as fh:
+        json.dump(manifest, fh, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def merge_samples_by_celltype(input_dir, output_dir, samples=["Mira_1", "Mira_2", "Mira_3", "Mira_4"], threads=1, force=False):
+    """
+    Merge per-sample cell-type BAMs into one indexed BAM per cell type.
+
+    Cell types are merged concurrently within a global budget of ``threads``, largest
+    (by total input size) first. A manifest of input sizes, mtimes and checksums is kept in
+    ``output_dir`` so that a rerun only rebuilds cell types whose inputs changed. It is saved as
+    each merge finishes; if a merge fails, the others still run and the first error is raised
+    once they are done.
+
+    Args:
+        input_dir (str): Directory holding ``{sample}_files`` directories.
+        output_dir (str): Directory for ``{celltype}.bam`` and ``{celltype}.bam.bai`` outputs.
+        samples (list): Sample names to merge.
+        threads (int): Total threads shared between concurrent merges.
+        force (bool): Rebuild every cell type regardless of the manifest.
+
+    Returns:
+        list: Cell types that were (re)built.
+    """
+    inputs = find_celltype_inputs(input_dir, samples)
 
     output_dir = Path(output_dir)
     output_dir.mkdir(parents=True, exist_ok=True)
-    for ct in celltypes:
-        bam_files = Path(input_dir).glob(f"**/*{ct}*.bam")
-        pysam.merge("-f", "-o", str(output_dir / f"{ct}.bam"), "-@", str(threads), *[str(b) for b in bam_files])
+    manifest_path = output_dir / MANIFEST_NAME
+    manifest = {}
+    if manifest_path.exists() and not force:
+        with open(manifest_path) as fh:
+            manifest = json.load(fh)
+
+    todo = []
+    for ct, bam_files in inputs.items():
+        out_path = output_dir / f"{ct}.bam"
+        up_to_date = out_path.exists() and Path(f"{out_path}.bai").exists()
+        if up_to_date and _inputs_unchanged(bam_files, manifest.get(ct)):
+            continue
+        todo.append(ct)
+    # Biggest jobs first so the longest merge is not left running alone at the end
+    todo.sort(key=lambda ct: sum(os.path.getsize(b) for b in inputs[ct]), reverse=True)
+
+    # Outputs being rebuilt are not up to date until their merge succeeds
+    for ct in todo:
+        manifest.pop(ct, None)
+    errors = []
+
+    def finished(ct, merge):
+        try:
+            manifest[ct] = merge()
+        except Exception as e:  # pylint: disable=broad-except
+            errors.append(e)
+            return
+        _save_manifest(manifest_path, manifest, inputs)
+
+    if todo:
+        workers = min(len(todo), max(1, threads))
+        job_threads = max(1, threads // workers)
+        tasks = {ct: (str(output_dir / f"{ct}.bam"), inputs[ct], job_threads) for ct in todo}
+        if workers == 1:
+            for ct, task in tasks.items():
+                finished(ct, lambda task=task: _merge_celltype(task))
+        else:
+            # samtools dispatch in pysam is not thread-safe, so merges run in separate processes
+            with ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn")) as pool:
+                futures = {pool.submit(_merge_celltype, task): ct for ct, task in tasks.items()}
+                for future in as_completed(futures):
+                    finished(futures[future], future.result)
+
+    _save_manifest(manifest_path, manifest, inputs)
+    if errors:
+        raise errors[0]
+    return todo
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+"""
+Module: read_cluster_index
+
+Persistent, memory-mapped index from read names to isoform cluster IDs.
+
+The index is built once from a clusters TSV and stored as a directory of two
+NumPy arrays: sorted 64-bit hashes of the read names, and the cluster ID of
+each. Opening it maps the arrays read-only, so several worker processes share
+the same pages instead of each holding a dict of every read name. Lookups are
+binary searches; with 64-bit hashes, the chance of any collision among a
+billion reads is about 3%, and a collision only affects the cluster ID of the
+reads involved.
+
+Building takes bounded memory: names are hashed a chunk at a time, each chunk
+is sorted and spilled to disk as a run, and the runs are merged block by block
+into the index files, as ``sort_merge_tagging`` does for its tables.
+
+Includes a CLI interface for building an index.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+from itertools import islice
+
+import numpy as np
+
+from bam_manipulation.wp3_add_custom_tags import iter_cluster_rows, number_transcripts
+
+KEYS_FILE = "keys.npy"
+CLUSTERS_FILE = "clusters.npy"
+META_FILE = "meta.json"
+HASH_NAME = "mix64-v1"
+
+_SEED = np.uint64(0x9E3779B97F4A7C15)
+_M1 = np.uint64(0xBF58476D1CE4E5B9)
+_M2 = np.uint64(0x94D049BB133111EB)
+
+
+def _mix64(h):
+    # splitmix64 finaliser; uint64 arithmetic wraps around
+    h = (h ^ (h >> np.uint64(30))) * _M1
+    h = (h ^ (h >> np.uint64(27))) * _M2
+    return h ^ (h >> np.uint64(31))
+
+
+def hash_read_names(read_names):
+    """
+    Hash read names to 64-bit keys, a whole batch at a time.
+
+    Names are read as little-endian 8-byte words (zero-padded), each mixed into the hash in turn,
+    followed by the name's length, so a name's key does not depend on the other names in the batch.
+
+    Args:
+        read_names (iterable): Read names (str).
+
+    Returns:
+        numpy.ndarray: uint64 keys, one per name.
+    """
+    names = read_names if isinstance(read_names, list) else list(read_names)
+    try:
+        encoded = np.array(names, dtype=np.bytes_)
+    except UnicodeEncodeError:
+        encoded = np.array([name.encode() for name in names], dtype=np.bytes_)
+    if len(encoded) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    width = encoded.dtype.itemsize
+    n_words = max(1, -(-width // 8))
+    padded = np.zeros((len(encoded), n_words * 8), dtype=np.uint8)
+    padded[:, :width] = encoded.view(np.uint8).reshape(len(encoded), width)
+    words = padded.view("<u8")
+    lengths = np.char.str_len(encoded).astype(np.uint64)
+    h = np.full(len(encoded), _SEED, dtype=np.uint64)
+    for j in range(n_words):
+        active = lengths > np.uint64(8 * j)
+        h = np.where(active, _mix64(h ^ words[:, j]), h)
+    return _mix64(h ^ lengths)
+
+
+def _save_streamed(path, raw_path, dtype, n):
+    """Write ``n`` values of ``dtype`` from a raw binary file as a .npy file."""
+    with open(path, "wb") as out, open(raw_path, "rb") as raw:
+        np.lib.format.write_array_header_1_0(out, {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+                                                   "fortran_order": False, "shape": (n,)})
+        shutil.copyfileobj(raw, out)
+
+
+class ClusterIndexWriter:
+    """
+    Bounded-memory writer of a read-to-cluster index.
+
+    Batches of (key, value) pairs are added in input order; where a key repeats, the last entry wins.
+    Every ``chunk_size`` entries are sorted and spilled as a run, and ``finish`` merges the runs into
+    the index, holding about ``chunk_size`` entries in memory at any point.
+
+    Args:
+        index_dir (str): Directory to write the index to.
+        chunk_size (int): Entries per sorted run.
+        tmp_dir (str, optional): Directory for the runs (default: inside ``index_dir``).
+    """
+
+    def __init__(self, index_dir, chunk_size=1_000_000, tmp_dir=None):
+        self.index_dir = str(index_dir)
+        self.chunk_size = chunk_size
+        os.makedirs(self.index_dir, exist_ok=True)
+        self._run_dir = tempfile.mkdtemp(prefix=".runs.", dir=tmp_dir or self.index_dir)
+        self._keys, self._values = [], []
+        self._buffered = 0
+        self._runs = []
+
+    def add(self, keys, values):
+        """Add keys from ``hash_read_names`` and the value of each."""
+        self._keys.append(np.asarray(keys, dtype=np.uint64))
+        self._values.append(np.asarray(values, dtype=np.int64))
+        self._buffered += len(keys)
+        if self._buffered >= self.chunk_size:
+            self._spill()
+
+    def _spill(self):
+        if not self._buffered:
+            return
+        keys, values = np.concatenate(self._keys), np.concatenate(self._values)
+        self._keys, self._values, self._buffered = [], [], 0
+        # Keep the last entry per key: stable-sort the reversed arrays and take the first of each run
+        keys, values = keys[::-1], values[::-1]
+        order = np.argsort(keys, kind="stable")
+        keys, values = keys[order], values[order]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = keys[1:] != keys[:-1]
+        path = os.path.join(self._run_dir, f"{len(self._runs):05d}")
+        np.save(f"{path}.keys.npy", keys[first])
+        np.save(f"{path}.values.npy", values[first])
+        self._runs.append(path)
+
+    def finish(self, source=None, value_map=None):
+        """
+        Merge the runs into the index.
+
+        Args:
+            source (str, optional): Input recorded in the index metadata.
+            value_map (numpy.ndarray, optional): Cluster ID of each added value (e.g. of transcript indices);
+                by default the values are the cluster IDs.
+
+        Returns:
+            ClusterIndex: The opened index.
+        """
+        self._spill()
+        runs = [(np.load(f"{p}.keys.npy", mmap_mode="r"), np.load(f"{p}.values.npy", mmap_mode="r"))
+                for p in self._runs]
+        cursors = [0] * len(runs)
+        block = max(1024, self.chunk_size // max(len(runs), 1))
+        keys_raw = os.path.join(self._run_dir, "keys.raw")
+        clusters_raw = os.path.join(self._run_dir, "clusters.raw")
+        n = 0
+        with open(keys_raw, "wb") as keys_out, open(clusters_raw, "wb") as clusters_out:
+            while True:
+                active = [i for i, (keys, _) in enumerate(runs) if cursors[i] < len(keys)]
+                if not active:
+                    break
+                ends = {i: min(cursors[i] + block, len(runs[i][0])) for i in active}
+                # Keys are unique within a run, so everything up to the smallest block end is final
+                threshold = min(runs[i][0][ends[i] - 1] for i in active)
+                parts_k, parts_v, parts_r = [], [], []
+                for i in active:
+                    keys = runs[i][0][cursors[i]:ends[i]]
+                    take = int(np.searchsorted(keys, threshold, side="right"))
+                    parts_k.append(np.array(keys[:take]))
+                    parts_v.append(np.array(runs[i][1][cursors[i]:cursors[i] + take]))
+                    parts_r.append(np.full(take, i, dtype=np.int64))
+                    cursors[i] += take
+                keys, values, run = np.concatenate(parts_k), np.concatenate(parts_v), np.concatenate(parts_r)
+                # Later runs hold later input, so the last run of each key wins
+                order = np.lexsort((run, keys))
+                keys, values = keys[order], values[order]
+                last = np.ones(len(keys), dtype=bool)
+                last[:-1] = keys[1:] != keys[:-1]
+                keys, values = keys[last], values[last]
+                clusters = (value_map[values] if value_map is not None else values).astype(np.int32)
+                keys_out.write(keys.tobytes())
+                clusters_out.write(clusters.tobytes())
+                n += len(keys)
+        del runs
+        _save_streamed(os.path.join(self.index_dir, KEYS_FILE), keys_raw, np.uint64, n)
+        _save_streamed(os.path.join(self.index_dir, CLUSTERS_FILE), clusters_raw, np.int32, n)
+        shutil.rmtree(self._run_dir, ignore_errors=True)
+        with open(os.path.join(self.index_dir, META_FILE), "w") as fh:
+            json.dump({"source": source, "reads": n, "hash": HASH_NAME}, fh)
+        return ClusterIndex(self.index_dir)
+
+
+def build_cluster_index(cluster_file, index_dir, read_col=1, gene_col=2, transcript_col=3, cluster_col=None,
+                        delimiter='\t', chunk_size=1_000_000):
+    """
+    Build an on-disk read-to-cluster index from a TSV.
+
+    With ``cluster_col`` unset, rows are (read, gene, transcript) and cluster IDs are numbered per gene
+    exactly as ``wp3_add_custom_tags.load_cluster_map`` does. With ``cluster_col`` set, rows are
+    (read, cluster_id) as read by ``wp3_add_ic_tag.load_cluster_map``. As with those loaders, the last
+    row for a read wins.
+
+    Args:
+        cluster_file (str): Path to TSV file.
+        index_dir (str): Directory to write the index to.
+        read_col, gene_col, transcript_col (int): 1-based columns for per-gene numbering.
+        cluster_col (int, optional): 1-based column of precomputed cluster IDs.
+        delimiter (str): Column delimiter (default tab).
+        chunk_size (int): Rows hashed per batch.
+
+    Returns:
+        ClusterIndex: The opened index.
+    """
+    if cluster_col is not None:
+        # Reuse the row parser with the cluster column standing in for both gene and transcript
+        rows = ((r, c, c) for r, c, _ in iter_cluster_rows(cluster_file, read_col, cluster_col, cluster_col, delimiter))
+    else:
+        rows = iter_cluster_rows(cluster_file, read_col, gene_col, transcript_col, delimiter)
+
+    tx_idx = {}  # (gene, transcript) -> index in order of first appearance
+    writer = ClusterIndexWriter(index_dir, chunk_size)
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            break
+        writer.add(hash_read_names([read for read, _, _ in chunk]),
+                   np.fromiter((tx_idx.setdefault((g, t), len(tx_idx)) for _, g, t in chunk),
+                               dtype=np.int64, count=len(chunk)))
+
+    if cluster_col is not None:
+        tx_cluster = np.array([int(c) for _, c in tx_idx], dtype=np.int32)
+    else:
+        numbered = number_transcripts(tx_idx)
+        tx_cluster = np.array([numbered[pair] for pair in tx_idx], dtype=np.int32)
+
+    return writer.finish(os.path.abspath(cluster_file), value_map=tx_cluster)
+
+
+def index_from_mapping(cluster_map, index_dir):
+    """
+    Write an index from an in-memory {read_name: cluster_id} mapping, e.g. from ``load_cluster_map``.
+
+    Returns:
+        ClusterIndex: The opened index.
+    """
+    keys = hash_read_names(cluster_map.keys())
+    clusters = np.fromiter(cluster_map.values(), dtype=np.int32, count=len(cluster_map))
+    return write_cluster_index(keys, clusters, index_dir)
+
+
+def write_cluster_index(keys, clusters, index_dir, source=None):
+    """
+    Write an index from parallel arrays of read-name hashes and cluster IDs.
+
+    Args:
+        keys (numpy.ndarray): uint64 read-name hashes from ``hash_read_names``, in input order.
+        clusters (numpy.ndarray): Cluster ID of each key. Where a key repeats, the last entry wins.
+        index_dir (str): Directory to write the index to.
+        source (str, optional): Input recorded in the index metadata.
+
+    Returns:
+        ClusterIndex: The opened index.
+    """
+    writer = ClusterIndexWriter(index_dir, chunk_size=max(len(keys), 1))
+    writer.add(keys, clusters)
+    return writer.finish(source)
+
+
+class ClusterIndex:
+    """
+    Read-only, memory-mapped read-to-cluster index.
+
+    Stands in for the dict returned by ``load_cluster_map`` in ``wp3_add_custom_tags.add_isoform_tags``,
+    which resolves reads a block at a time with ``lookup``; ``get`` hashes and searches for a single
+    name and is meant for one-off queries. Pickles by path, so worker processes re-map the same files
+    instead of copying the arrays.
+
+    Args:
+        index_dir (str): Directory written by ``build_cluster_index``.
+
+    Raises:
+        ValueError: If the index was built with a different read-name hash.
+    """
+
+    def __init__(self, index_dir):
+        self.index_dir = str(index_dir)
+        with open(os.path.join(self.index_dir, META_FILE)) as fh:
+            hash_name = json.load(fh).get("hash")
+        if hash_name != HASH_NAME:
+            raise ValueError(f"Index {self.index_dir} uses read-name hash '{hash_name}', not '{HASH_NAME}'; rebuild it.")
+        self.keys = np.load(os.path.join(self.index_dir, KEYS_FILE), mmap_mode="r")
+        self.clusters = np.load(os.path.join(self.index_dir, CLUSTERS_FILE), mmap_mode="r")
+
+    def __reduce__(self):
+        return (ClusterIndex, (self.index_dir,))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __contains__(self, read_name):
+        return self.get(read_name) is not None
+
+    def get(self, read_name, default=None):
+        """Return the cluster ID of ``read_name``, or ``default`` if it is not in the index; use ``lookup`` for many."""
+        key = hash_read_names([read_name])[0]
+        i = int(np.searchsorted(self.keys, key))
+        if i < len(self.keys) and self.keys[i] == key:
+            return int(self.clusters[i])
+        return default
+
+    def lookup(self, read_names, default=0):
+        """
+        Resolve a batch of read names.
+
+        Returns:
+            numpy.ndarray: int32 cluster IDs, ``default`` for names not in the index.
+        """
+        keys = hash_read_names(read_names)
+        if len(self.keys) == 0:
+            return np.full(len(keys), default, dtype=np.int32)
+        pos = np.searchsorted(self.keys, keys)
+        pos[pos == len(self.keys)] = 0
+        return np.where(self.keys[pos] == keys, self.clusters[pos], default).astype(np.int32)
+
+
+def is_cluster_index(path):
+    """Return True if ``path`` is a directory holding a built index."""
+    return all(os.path.isfile(os.path.join(path, name)) for name in (KEYS_FILE, CLUSTERS_FILE, META_FILE))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Build a memory-mapped read name to isoform cluster ID index")
+    parser.add_argument("cluster_file", help="TSV mapping read name, gene ID, transcript ID per line")
+    parser.add_argument("index_dir", help="Output index directory")
+    parser.add_argument("--read_col", type=int, default=1, help="1-based column number for read names (default: 1)")
+    parser.add_argument("--gene_col", type=int, default=2, help="1-based column number for gene IDs (default: 2)")
+    parser.add_argument("--transcript_col", type=int, default=3, help="1-based column number for transcript IDs (default: 3)")
+    parser.add_argument("--cluster_col", type=int,
+                        help="1-based column number of precomputed cluster IDs; replaces per-gene numbering")
+    parser.add_argument("--delimiter", default="\t", help="Column delimiter in TSV (default: tab)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    index = build_cluster_index(args.cluster_file, args.index_dir, read_col=args.read_col, gene_col=args.gene_col,
+                                transcript_col=args.transcript_col, cluster_col=args.cluster_col, delimiter=args.delimiter)
+    print(f"Indexed {len(index)} reads: {args.index_dir}")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
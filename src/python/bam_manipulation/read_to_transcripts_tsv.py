@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# pylint: disable=no-member
+"""
+Module: read_to_transcripts_tsv
+
+Turns a kallisto ``--pseudobam`` into a table of read name, transcript ID,
+gene ID and ZW (posterior probability of assignment) for the alignments
+whose ZW passes a threshold.
+
+The transcript-to-gene map is resolved once into an array indexed by the
+BAM's reference IDs, and rows are written in bulk straight to a gzip file (or
+stdout). ZW tags and reference IDs are still read one alignment at a time
+through pysam, which has no batched tag access; only the threshold, the
+best-per-read selection and the gene lookup run on whole blocks as arrays.
+
+Includes a CLI interface.
+"""
+
+import argparse
+import gzip
+import re
+import sys
+from itertools import islice
+
+import numpy as np
+import pysam
+
+HEADER = ["#read_id", "transcript_id", "gene_id", "prob_assignment_zw"]
+
+# Anchored at attribute starts so that e.g. StringTie's ref_gene_id is not matched as gene_id
+_TRANSCRIPT_ID = re.compile(r'(?:^|;)\s*transcript_id "?([^";]+)"?')
+_GENE_ID = re.compile(r'(?:^|;)\s*gene_id "?([^";]+)"?')
+
+
+def load_tx2gene(gtf):
+    """
+    Read transcript to gene IDs from the ``transcript`` features of a GTF (e.g. from StringTie).
+
+    Returns:
+        dict: Mapping {transcript_id: gene_id}.
+    """
+    tx2gene = {}
+    with open(gtf) as fh:
+        for line in fh:
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\n").split("\t")
+            if len(fields) < 9 or fields[2] != "transcript":
+                continue
+            tx_id = _TRANSCRIPT_ID.search(fields[8])
+            gene_id = _GENE_ID.search(fields[8])
+            tx2gene[tx_id.group(1) if tx_id else None] = gene_id.group(1) if gene_id else None
+    return tx2gene
+
+
+def tx2gene_by_tid(references, tx2gene):
+    """
+    Resolve gene IDs for a BAM's references.
+
+    Args:
+        references (tuple): Reference (transcript) names in BAM order.
+        tx2gene (dict): Mapping {transcript_id: gene_id}.
+
+    Returns:
+        numpy.ndarray: Object array of gene IDs indexed by reference ID; None for unknown transcripts.
+    """
+    genes = np.empty(len(references), dtype=object)
+    genes[:] = [tx2gene.get(name) for name in references]
+    return genes
+
+
+def _zw(aln):
+    try:
+        return aln.get_tag("ZW")
+    except KeyError:
+        return np.nan
+
+
+def _best_per_read(names, zw):
+    """Indices keeping the highest-ZW alignment (first on ties) in each run of one read's alignments."""
+    if not names:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.flatnonzero(np.r_[True, np.array(names[1:], dtype=object) != np.array(names[:-1], dtype=object)])
+    run_id = np.repeat(np.arange(len(starts)), np.diff(np.r_[starts, len(names)]))
+    # Sort by run, then ZW descending, then position, and take the first of each run
+    order = np.lexsort((np.arange(len(names)), -zw, run_id))
+    return np.sort(order[np.r_[0, np.flatnonzero(np.diff(run_id[order])) + 1]])
+
+
+def iter_read_transcripts(bam, tx2gene, prob_assignment=0.8, threads=1, best_per_read=False, block_size=100_000):
+    """
+    Stream passing alignments of a pseudobam in blocks.
+
+    Args:
+        bam (str): Input BAM, typically from kallisto --pseudobam.
+        tx2gene (dict or str): Mapping {transcript_id: gene_id}, or a GTF path to read it from.
+        prob_assignment (float): Minimum ZW for an alignment to be kept.
+        threads (int): BGZF decompression threads.
+        best_per_read (bool): Keep only the highest-ZW passing alignment of each read. Relies on a read's
+            alignments being consecutive, as kallisto writes them.
+        block_size (int): Alignments per block; their ZW and reference IDs are collected into arrays
+            and filtered together.
+
+    Yields:
+        tuple: (read names, transcript IDs, gene IDs, ZW values) as equal-length lists.
+
+    Raises:
+        KeyError: If a kept alignment's transcript is not in ``tx2gene``.
+    """
+    if not isinstance(tx2gene, dict):
+        tx2gene = load_tx2gene(tx2gene)
+    with pysam.AlignmentFile(bam, threads=threads) as sam:
+        references = np.array(sam.references, dtype=object)
+        genes = tx2gene_by_tid(sam.references, tx2gene)
+        alignments = sam.fetch(until_eof=True)
+        carry = None  # last read's alignments, held back in case they continue in the next block
+        while True:
+            block = list(islice(alignments, block_size))
+            if not block:
+                break
+            # Tag access is per alignment; everything after it works on the block's arrays
+            zw = np.fromiter((_zw(aln) for aln in block), dtype=np.float64, count=len(block))
+            tid = np.fromiter((aln.reference_id for aln in block), dtype=np.int64, count=len(block))
+            keep = np.flatnonzero((zw >= prob_assignment) & (tid >= 0))
+            names = [block[i].query_name for i in keep]
+            zw, tid = zw[keep], tid[keep]
+            if best_per_read:
+                if carry is not None:
+                    names, zw, tid = carry[0] + names, np.r_[carry[1], zw], np.r_[carry[2], tid]
+                tail = len(names)
+                while tail > 0 and names[tail - 1] == names[-1]:
+                    tail -= 1
+                carry = (names[tail:], zw[tail:], tid[tail:])
+                names, zw, tid = names[:tail], zw[:tail], tid[:tail]
+                best = _best_per_read(names, zw)
+                names, zw, tid = [names[i] for i in best], zw[best], tid[best]
+            if names:
+                yield _resolve(names, zw, tid, references, genes)
+        if carry is not None and carry[0]:
+            best = _best_per_read(*carry[:2])
+            yield _resolve([carry[0][i] for i in best], carry[1][best], carry[2][best], references, genes)
+
+
+def _resolve(names, zw, tid, references, genes):
+    block_genes = genes[tid]
+    missing = np.flatnonzero(block_genes == None)  # noqa: E711 (element-wise comparison)
+    if len(missing):
+        raise KeyError(references[tid[missing[0]]])
+    return names, references[tid].tolist(), block_genes.tolist(), zw.tolist()
+
+
+def format_rows(names, transcripts, genes, zw):
+    """Format a block from ``iter_read_transcripts`` as TSV lines."""
+    return [f"{r}\t{t}\t{g}\t{z}\n" for r, t, g, z in zip(names, transcripts, genes, zw)]
+
+
+def _open_output(output, compresslevel):
+    if output is None or output == "-":
+        return sys.stdout
+    if str(output).endswith(".gz"):
+        return gzip.open(output, "wt", compresslevel=compresslevel)
+    return open(output, "w")
+
+
+def write_read_transcripts(bam, gtf, output=None, prob_assignment=0.8, threads=1, best_per_read=False,
+                           compresslevel=6):
+    """
+    Write the read to transcript table.
+
+    Args:
+        bam (str): Input BAM, typically from kallisto --pseudobam.
+        gtf (str): GTF file, typically from StringTie.
+        output (str, optional): Output path, gzip-compressed if it ends in ``.gz``; stdout if None or ``-``.
+        prob_assignment (float): Minimum ZW for an alignment to be kept.
+        threads (int): BGZF decompression threads.
+        best_per_read (bool): Keep only the highest-ZW passing alignment of each read.
+        compresslevel (int): gzip compression level.
+
+    Returns:
+        int: Number of rows written.
+    """
+    n_rows = 0
+    out = _open_output(output, compresslevel)
+    try:
+        out.write("\t".join(HEADER) + "\n")
+        for names, transcripts, genes, zw in iter_read_transcripts(bam, gtf, prob_assignment, threads, best_per_read):
+            out.writelines(format_rows(names, transcripts, genes, zw))
+            n_rows += len(names)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        else:
+            out.flush()
+    return n_rows
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Prepare a tsv file with read name, transcript_id, gene_id"
+    )
+    parser.add_argument(
+        "--bam", "-b", required=True, help="Input bam file, typically from kallisto --pseudobam"
+    )
+    parser.add_argument("--gtf", "-g", required=True, help="GTF file, typically from stringtie")
+    parser.add_argument(
+        "--prob-assignment",
+        "-p",
+        help="Keep reads where the ZW tag (posterior probability of assignment) is at least this much [%(default)s]",
+        default=0.8,
+        type=float,
+    )
+    parser.add_argument(
+        "--output", "-o",
+        help="Output file, gzip-compressed if it ends in .gz [stdout]",
+    )
+    parser.add_argument(
+        "--threads", "-@", type=int, default=1, help="BAM decompression threads [%(default)s]"
+    )
+    parser.add_argument(
+        "--best-per-read", action="store_true",
+        help="Keep only the highest-ZW passing alignment of each multimapped read",
+    )
+    parser.add_argument('--version', '-v', action='version',
+                        version='%(prog)s 0.3.0')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    write_read_transcripts(args.bam, args.gtf, output=args.output, prob_assignment=args.prob_assignment,
+                           threads=args.threads, best_per_read=args.best_per_read)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -4,12 +4,26 @@ import pysam.samtools
 import os
 import os.path
 from pathlib import Path
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from collections import defaultdict
+import shutil
 
+from bam_manipulation.barcodes import BarcodeIndex, read_blocks
+from bam_manipulation.checkpoint import ShardCheckpoint, digest, file_fingerprint, map_shards_checkpointed, shard_key
+from bam_manipulation.instrumentation import instrumented
+from bam_manipulation.key_expression import KeyExpression
+from bam_manipulation.mapping_registry import load_mapping
+from bam_manipulation.writer_pool import BamWriterPool
+from bam_manipulation.sharding import region_shards, fetch_shard
 
-def bamTagHandling(bamFile, threadNumber = 7, output = False, sortTarget = "CB", mapping = False, delim = ",", mappingColumns = ["Cluster", "cell_barcode"], untagged = False, unmapped = False ):
+# Shard size used when checkpointing without a shardSize, so no checkpoint interval covers a whole chromosome
+CHECKPOINT_SHARD_SIZE = 5_000_000
+
+
+@instrumented("bamTagHandling")
+def bamTagHandling(bamFile, threadNumber = 7, output = False, sortTarget = "CB", mapping = False, delim = ",", mappingColumns = ["Cluster", "cell_barcode"], untagged = False, unmapped = False, processes = 1, shardSize = None, native = False, maxOpenFiles = 64, checkpoint = False, keyExpression = None, mappingSample = None, instrument = None):
     '''
     # function takes unsorted bamFile and produces a split based upon tags
     # expected inputs:
@@ -19,6 +33,8 @@ def bamTagHandling(bamFile, threadNumber = 7, output = False, sortTarget = "CB",
     # mapping: if multiple values of target tag are to be grouped together. 
     # Accepts input as dictionary of form {grouping : [tag_value1, ..., tag_valueN]} 
     # or as a delimited file where first column is tag value and second columns are the group which the tag belongs to 
+    # or as a bam_manipulation.mapping_registry.CompiledMapping (or its directory); files are compiled once into the
+    # mapping cache and memory-mapped from there by this and later runs
     # sep is the delimiter of the file
     # output is set of files split as requested.  
     # Without mapping file split file based upon tag of form (output_) sortTarget value of tag.bam
@@ -26,6 +42,24 @@ def bamTagHandling(bamFile, threadNumber = 7, output = False, sortTarget = "CB",
     # will place results in directory named output
     # untagged: capture reads that don't contain a tag sortTarget in untagged.bam (default False)
     # unmapped: capture reads that do contain a tag sortTarget but not matched in mapping (default False)
+    # processes: with a mapping, split contig shards of a coordinate-sorted, indexed bamFile across this many
+    # worker processes and concatenate the partial outputs (default 1, a single serial pass)
+    # shardSize: with processes > 1, further split contigs into shards of at most this many bp (default: one per contig)
+    # native: without mapping, split in Python through a bounded writer pool instead of samtools split,
+    # which opens one file per tag value at once (default False)
+    # maxOpenFiles: cap on simultaneously open output BAMs; reads are buffered and least recently used outputs
+    # are closed and continued in segments merged at the end (default 64)
+    # checkpoint: with a mapping, record each completed shard (see bam_manipulation.checkpoint) so that a rerun after
+    # the job is killed resumes from the completed shards and gives identical outputs; True keeps the checkpoint in
+    # the output directory, or give a path. Needs an indexed bamFile; shardSize sets the checkpoint interval
+    # (default False; shardSize defaults to CHECKPOINT_SHARD_SIZE when checkpointing)
+    # keyExpression: group reads on several values in the same single pass, e.g. "celltype/IC" or "CB+UB"
+    # (see bam_manipulation.key_expression): "/" separates nested output directories, "+" joins values in one name,
+    # and celltype is the mapped group of sortTarget. Reads lacking a tag of the expression count as untagged.
+    # Read counts per group are written to group_counts.tsv. Works with or without mapping, processes and checkpoint (default None)
+    # mappingSample: sample to use from a compiled multi-sample mapping such as cc_barcode.csv (default: its only sample)
+    # instrument: bam_manipulation.instrumentation.Instrumentation recording throughput, stage timings and memory
+    # (default: configured from $BAM_METRICS_DIR / $BAM_PROFILE; nothing is written if unset)
     '''
     if output:
         directoryName = output+ "_files"
@@ -34,71 +68,260 @@ def bamTagHandling(bamFile, threadNumber = 7, output = False, sortTarget = "CB",
     dirPath = str(Path().resolve()) + "/" + directoryName + "/"
     if not os.path.exists(dirPath):
         os.makedirs(dirPath)
-    if mapping:
-        presentSet = set()
-        if isinstance(mapping, dict):
-            mappingDict = mapping.copy()
-        else:
-            mappingDict = {}
-            mappingDf = pd.read_csv(mapping, sep = delim)
-            clusters =  mappingDf[mappingColumns[0]].unique()
-            for cluster in clusters:
-                mappingDict[cluster] = mappingDf.loc[mappingDf[mappingColumns[0]] == cluster][mappingColumns[1]].unique()
-
-        tag_to_cellType = {tag: ct for ct, tags in mappingDict.items() for tag in tags}
+    instrument.add_input(bamFile)
+    instrument.add_output(dirPath)
+    key = KeyExpression(keyExpression, sortTarget) if keyExpression else None
+    if key is not None and key.uses_mapping and not mapping:
+        raise ValueError(f"keyExpression '{keyExpression}' uses celltype, which needs a mapping.")
+    if mapping or key is not None:
+        tagIndex, cellTypes, mappingDigest = None, [], None
+        if mapping:
+            # Barcodes are resolved a block of reads at a time against a sorted array of 2-bit packed codes
+            with instrument.stage("load_mapping"):
+                if isinstance(mapping, dict):
+                    tag_to_cellType = {tag: ct for ct, tags in mapping.items() for tag in tags}
+                    tagIndex, cellTypes = BarcodeIndex.from_mapping(tag_to_cellType)
+                    mappingDigest = digest(tag_to_cellType)
+                else:
+                    compiled = load_mapping(mapping, sample_col=None, barcode_col=mappingColumns[1],
+                                            celltype_col=mappingColumns[0], delim=delim)
+                    tagIndex, cellTypes = compiled.index(mappingSample)
+                    mappingDigest = [compiled.digest, tagIndex.sample]
         with pysam.AlignmentFile(bamFile, "rb") as in_bam:
-            total_reads = sum(total_count for _, _, _, total_count in in_bam.get_index_statistics())
-            # We will open each cell-type BAM the first time we need it
-            out_handles = {}
-            counts = defaultdict(int)
-            untagged_count = 0
-            unmapped_count = 0
-
-            if untagged:
-                untagged_bam = pysam.AlignmentFile(dirPath + "untagged.bam", "wb", header=in_bam.header)
-            if unmapped:
-                unmapped_bam = pysam.AlignmentFile(dirPath + "unmapped.bam", "wb", header=in_bam.header)
-            for read in tqdm(in_bam, total=total_reads):
-                if not read.has_tag(sortTarget):
+            total_reads = sum(total_count for _, _, _, total_count in in_bam.get_index_statistics()) + in_bam.nocoordinate
+        with instrument.stage("split"), instrument.profiled():
+            if processes > 1 or checkpoint:
+                checkpointPath = None
+                if checkpoint:
+                    checkpointPath = checkpoint if isinstance(checkpoint, (str, os.PathLike)) else dirPath + ".checkpoint.json"
+                    if shardSize is None:
+                        shardSize = CHECKPOINT_SHARD_SIZE
+                counts, untagged_count, unmapped_count, present = _split_parallel(
+                    bamFile, dirPath, output, sortTarget, tagIndex, cellTypes, untagged, unmapped, processes, shardSize, maxOpenFiles,
+                    progress=instrument.progress, checkpointPath=checkpointPath,
+                    mappingDigest=mappingDigest, key=key)
+            else:
+                with pysam.AlignmentFile(bamFile, "rb") as in_bam:
+                    counts, untagged_count, unmapped_count, present = _split_reads(
+                        tqdm(in_bam, total=total_reads), in_bam.header, dirPath, output, sortTarget, tagIndex, cellTypes, untagged, unmapped,
+                        maxOpenFiles, threadNumber, progress=instrument.progress, key=key)
+
+        for group, n in counts.items():
+            print(f"{group if key is None else key.output_name(group)[:-4]} : {n} reads")
+        if key is not None:
+            _write_group_counts(dirPath + "group_counts.tsv", key, counts, output)
+        if tagIndex is not None:
+            print(f"% of mapping tags found in BAM: {round(100 * present.sum() / len(tagIndex), 2)}")
+        untaggedTarget = f'"{sortTarget}" tag' if key is None else f'"{keyExpression}" tags'
+        print(f'% of reads without a {untaggedTarget}: {round(100 * untagged_count / total_reads, 2)}')
+        if tagIndex is not None:
+            print(f'% of tagged reads without a mapping: {round(100 * unmapped_count / (total_reads - untagged_count), 2)}')
+
+    elif native:
+        with instrument.stage("split"), instrument.profiled():
+            _split_by_tag_value(bamFile, dirPath, output, sortTarget, maxOpenFiles, threadNumber, progress=instrument.progress)
+    else:
+        # samtools split reports no progress; only the stage is timed
+        with instrument.stage("samtools_split"):
+            if output:
+                pysam.samtools.split(bamFile, "-d", sortTarget, "-@", str(threadNumber), "-u", dirPath + "untagged.bam", "--output-fmt", "BAM", "-f", dirPath + (output + "_" + sortTarget + "%!.bam").replace("-", "_"), catch_stdout=False)
+            else:
+                pysam.samtools.split(bamFile, "-d", sortTarget, "-@", str(threadNumber), "-u", dirPath + "untagged.bam", "--output-fmt", "BAM", "-f", dirPath + (sortTarget +"_" + "%!.bam").replace("-", "_"), catch_stdout=False)
+
+
+def _output_name(cellType, output):
+    outFile = cellType.replace(" ", "_") + ".bam"
+    if output:
+        outFile = output + "_" + outFile
+    return outFile
+
+
+def _write_group_counts(path, key, counts, output=False):
+    '''
+    # writes one row per group of key: its component values, the output file and the number of reads
+    '''
+    rows = [(*group, key.output_name(group, output), n) for group, n in sorted(counts.items())]
+    df = pd.DataFrame(rows, columns=[*key.components, "file", "reads"])
+    df.to_csv(path + ".tmp", sep="\t", index=False)
+    os.replace(path + ".tmp", path)
+
+
+def _split_reads(reads, header, dirPath, output, sortTarget, tagIndex, cellTypes, untagged, unmapped, maxOpenFiles=64, threads=1, progress=None,
+                 key=None):
+    '''
+    # writes each read in reads to the per-cell-type BAM in dirPath, resolving tags through tagIndex
+    # whose values index into cellTypes; progress (optional) is called with reads=<block size> after each block
+    # with a KeyExpression key, reads go to the nested BAM of their group instead, and counts are keyed by group tuple;
+    # tagIndex may then be None to group on tags alone
+    # returns (counts per cell type or group, untagged count, unmapped count, boolean array of index entries seen)
+    '''
+    present = np.zeros(0 if tagIndex is None else len(tagIndex), dtype=bool)
+    counts = defaultdict(int)
+    untagged_count = 0
+    unmapped_count = 0
+    # Output paths are resolved once per cell type; handles are opened lazily by the pool
+    outPaths = {}
+
+    with BamWriterPool(header, max_open=maxOpenFiles, threads=threads) as pool:
+        if untagged:
+            pool.touch(dirPath + "untagged.bam")
+        if unmapped:
+            pool.touch(dirPath + "unmapped.bam")
+        for block, tags in read_blocks(reads, sortTarget):
+            if tagIndex is not None:
+                positions = tagIndex.find(tags)
+                present[positions[positions >= 0]] = True
+                cellTypeIdx = tagIndex.values_at(positions).tolist()
+            else:
+                cellTypeIdx = [None] * len(block)
+            for read, tag, ct in zip(block, tags, cellTypeIdx):
+                cellType = None
+                if tagIndex is not None:
+                    if tag is None:
+                        untagged_count += 1
+                        if untagged:
+                            pool.write(dirPath + "untagged.bam", read)
+                        continue
+
+                    if ct < 0:
+                        unmapped_count += 1
+                        if unmapped:
+                            pool.write(dirPath + "unmapped.bam", read)
+                        continue
+                    cellType = cellTypes[ct]
+
+                group = cellType if key is None else key.values(read, cellType)
+                if group is None:
                     untagged_count += 1
                     if untagged:
-                        untagged_bam.write(read)
+                        pool.write(dirPath + "untagged.bam", read)
                     continue
-                tag = read.get_tag(sortTarget)
 
-                if tag not in tag_to_cellType:
-                    unmapped_count += 1
-                    if unmapped:
-                        unmapped_bam.write(read)
+                if group not in outPaths:
+                    if key is None:
+                        outPaths[group] = dirPath + _output_name(group, output)
+                    else:
+                        outPaths[group] = dirPath + key.output_name(group, output)
+                        os.makedirs(os.path.dirname(outPaths[group]), exist_ok=True)
+                pool.write(outPaths[group], read)
+                counts[group] += 1
+            if progress is not None:
+                progress(reads=len(block))
+    return counts, untagged_count, unmapped_count, present
+
+
+def _split_by_tag_value(bamFile, dirPath, output, sortTarget, maxOpenFiles, threads, progress=None):
+    '''
+    # native replacement for samtools split -d sortTarget: one BAM per tag value, untagged reads in untagged.bam
+    # file names follow the samtools split pattern used by bamTagHandling
+    # unlike samtools split, there is no cap on the number of tag values (samtools -M sends the excess to untagged)
+    '''
+    prefix = (output + "_" + sortTarget if output else sortTarget + "_").replace("-", "_")
+    outPaths = {}
+    with pysam.AlignmentFile(bamFile, "rb") as in_bam:
+        total_reads = sum(total_count for _, _, _, total_count in in_bam.get_index_statistics()) + in_bam.nocoordinate
+        with BamWriterPool(in_bam.header, max_open=maxOpenFiles, threads=threads) as pool:
+            pool.touch(dirPath + "untagged.bam")
+            n = 0
+            for n, read in enumerate(tqdm(in_bam, total=total_reads), start=1):
+                if progress is not None and n % 10_000 == 0:
+                    progress(reads=10_000)
+                if not read.has_tag(sortTarget):
+                    pool.write(dirPath + "untagged.bam", read)
                     continue
+                tag = read.get_tag(sortTarget)
+                if tag not in outPaths:
+                    outPaths[tag] = dirPath + prefix + str(tag) + ".bam"
+                pool.write(outPaths[tag], read)
+            if progress is not None:
+                progress(reads=n % 10_000)
 
-                presentSet.add(tag)
-                cellType = tag_to_cellType[tag]
-                if cellType not in out_handles:  # lazily create handle
-                    outFile = cellType.replace(" ", "_") + ".bam"
-                    if output:
-                        outFile = output + "_" + outFile
-                    out_handles[cellType] = pysam.AlignmentFile(dirPath + outFile, "wb",
-                                                        header=in_bam.header)
-                out_handles[cellType].write(read)
-                counts[cellType] += 1
-
-        # close everything and report
-        for h in out_handles.values():
-            h.close()
-        if untagged:
-            untagged_bam.close()
-        if unmapped:
-            unmapped_bam.close()
-
-        for cellType, n in counts.items():
-            print(f"{cellType} : {n} reads")
-        print(f"% of mapping tags found in BAM: {round(100 * len(presentSet) / len(mappingDf), 2)}")
-        print(f'% of reads without a "{sortTarget}" tag: {round(100 * untagged_count / total_reads, 2)}')
-        print(f'% of tagged reads without a mapping: {round(100 * unmapped_count / (total_reads - untagged_count), 2)}')
-        
+
+def _split_shard(task):
+    '''
+    # worker: splits the reads of one shard into partial BAMs in the shard's own directory
+    '''
+    bamFile, shard, shardPath, output, sortTarget, tagIndex, cellTypes, untagged, unmapped, maxOpenFiles, key = task
+    os.makedirs(shardPath, exist_ok=True)
+    with pysam.AlignmentFile(bamFile, "rb") as in_bam:
+        return _split_reads(fetch_shard(in_bam, shard), in_bam.header, shardPath, output, sortTarget,
+                            tagIndex, cellTypes, untagged, unmapped, maxOpenFiles, key=key)
+
+
+def _split_parallel(bamFile, dirPath, output, sortTarget, tagIndex, cellTypes, untagged, unmapped, processes, shardSize, maxOpenFiles, progress=None,
+                    checkpointPath=None, mappingDigest=None, key=None):
+    '''
+    # splits shards of bamFile across a process pool, then concatenates the partial BAMs
+    # of each output in shard order so outputs match a serial pass; progress (optional) is called as shards finish
+    # with checkpointPath, completed shards and their partial BAMs are kept across runs, and only missing shards are redone
+    '''
+    shards = region_shards(bamFile, shardSize)
+    workPath = dirPath + ".shards/"
+    shardPaths = [workPath + shard_key(i, shard) + "/" for i, shard in enumerate(shards)]
+    tasks = [(bamFile, shard, shardPath, output, sortTarget, tagIndex, cellTypes, untagged, unmapped, maxOpenFiles, key)
+             for shard, shardPath in zip(shards, shardPaths)]
+
+    present = np.zeros(0 if tagIndex is None else len(tagIndex), dtype=bool)
+    checkpoint = None
+    if checkpointPath:
+        checkpoint = ShardCheckpoint(checkpointPath, {
+            "input": file_fingerprint(bamFile), "mapping": mappingDigest, "sortTarget": sortTarget, "output": output,
+            "untagged": untagged, "unmapped": unmapped, "shards": shards, "key": key and key.expression})
+    if checkpoint is None or not checkpoint.resumed:
+        shutil.rmtree(workPath, ignore_errors=True)
+
+    def on_result(result):
+        if progress is not None:
+            progress(reads=sum(result[0].values()) + result[1] + result[2])
+
+    def encode(result):
+        shardCounts, shardUntagged, shardUnmapped, shardPresent = result
+        # Groups of a key expression are tuples, so counts are stored as pairs
+        return [list(shardCounts.items()), shardUntagged, shardUnmapped, np.flatnonzero(shardPresent).tolist()]
+
+    def decode(record):
+        shardPresent = np.zeros(len(present), dtype=bool)
+        shardPresent[record[3]] = True
+        shardCounts = {tuple(group) if key is not None else group: n for group, n in record[0]}
+        return shardCounts, record[1], record[2], shardPresent
+
+    # Partial BAMs of shards a killed run did not finish are discarded and redone
+    results = map_shards_checkpointed(_split_shard, tasks, shards, processes, checkpoint, encode, decode, on_result,
+                                      on_pending=lambda key: shutil.rmtree(workPath + key, ignore_errors=True))
+
+    counts = defaultdict(int)
+    untagged_count = 0
+    unmapped_count = 0
+    for shardCounts, shardUntagged, shardUnmapped, shardPresent in results:
+        for cellType, n in shardCounts.items():
+            counts[cellType] += n
+        untagged_count += shardUntagged
+        unmapped_count += shardUnmapped
+        present |= shardPresent
+
+    if key is None:
+        outFiles = [_output_name(cellType, output) for cellType in counts]
     else:
-        if output:
-            pysam.samtools.split(bamFile, "-d", sortTarget, "-@", str(threadNumber), "-u", dirPath + "untagged.bam", "--output-fmt", "BAM", "-f", dirPath + (output + "_" + sortTarget + "%!.bam").replace("-", "_"), catch_stdout=False)
+        outFiles = [key.output_name(group, output) for group in counts]
+    if untagged:
+        outFiles.append("untagged.bam")
+    if unmapped:
+        outFiles.append("unmapped.bam")
+    with pysam.AlignmentFile(bamFile, "rb") as in_bam:
+        header = in_bam.header
+    for outFile in outFiles:
+        parts = [p + outFile for p in shardPaths if os.path.exists(p + outFile)]
+        # Each output appears under its final name only once complete
+        tmpFile = dirPath + outFile + ".tmp"
+        os.makedirs(os.path.dirname(tmpFile), exist_ok=True)
+        if not parts:
+            pysam.AlignmentFile(tmpFile, "wb", header=header).close()
+        elif len(parts) == 1:
+            shutil.copyfile(parts[0], tmpFile)
         else:
-            pysam.samtools.split(bamFile, "-d", sortTarget, "-@", str(threadNumber), "-u", dirPath + "untagged.bam", "--output-fmt", "BAM", "-f", dirPath + (sortTarget +"_" + "%!.bam").replace("-", "_"), catch_stdout=False)
+            pysam.samtools.cat("-o", tmpFile, *parts, catch_stdout=False)
+        os.replace(tmpFile, dirPath + outFile)
+    shutil.rmtree(workPath, ignore_errors=True)
+    if checkpoint is not None:
+        checkpoint.remove()
+    return counts, untagged_count, unmapped_count, present
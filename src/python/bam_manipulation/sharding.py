@@ -0,0 +1,123 @@
+# pylint: disable=no-member
+"""
+Module: sharding
+
+Helpers for splitting a coordinate-sorted, indexed BAM into region shards that
+can be processed independently by a pool of worker processes, and for running
+a worker function over those shards.
+
+A shard is a ``(contig, start, end)`` tuple. Each read is assigned to exactly
+one shard by its leftmost mapping position, so concatenating per-shard outputs
+in shard order reproduces the read order of the input file. The final shard
+``("*", None, None)`` holds unplaced unmapped reads.
+"""
+
+from multiprocessing import get_context
+
+import pysam
+
+UNPLACED = "*"
+
+
+def region_shards(bam_path, shard_size=None):
+    """
+    Split an indexed BAM into region shards in file order.
+
+    Args:
+        bam_path (str): Path to coordinate-sorted, indexed BAM.
+        shard_size (int, optional): Maximum shard length in bp. If None, one shard per contig.
+
+    Returns:
+        list: ``(contig, start, end)`` tuples. Contigs with no reads in the index are skipped.
+    """
+    if shard_size is not None and shard_size < 1:
+        raise ValueError("shard_size must be 1 or greater.")
+    shards = []
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        occupied = {stat.contig for stat in bam.get_index_statistics() if stat.total > 0}
+        for contig, length in zip(bam.references, bam.lengths):
+            if contig not in occupied:
+                continue
+            step = shard_size or length
+            for start in range(0, length, step):
+                shards.append((contig, start, min(start + step, length)))
+        if bam.nocoordinate > 0:
+            shards.append((UNPLACED, None, None))
+    return shards
+
+
+def fetch_shard(bam, shard):
+    """
+    Iterate over the reads belonging to a shard.
+
+    Args:
+        bam (pysam.AlignmentFile): Open, indexed BAM.
+        shard (tuple): ``(contig, start, end)`` as returned by ``region_shards``.
+
+    Yields:
+        pysam.AlignedSegment: Reads whose leftmost position falls within the shard.
+    """
+    contig, start, end = shard
+    if contig == UNPLACED:
+        yield from bam.fetch(contig=UNPLACED)
+        return
+    for read in bam.fetch(contig, start, end):
+        # fetch() also returns reads overlapping the shard start; those belong to the previous shard
+        if read.reference_start < start:
+            continue
+        yield read
+
+
+def shard_label(shard):
+    """Return a filesystem-safe label such as ``SM_V10_1_0_1000000`` for a shard."""
+    contig, start, end = shard
+    if contig == UNPLACED:
+        return "unplaced"
+    return f"{contig}_{start}_{end}"
+
+
+def _shard_weight(shard):
+    _, start, end = shard
+    # Unplaced reads have no length to go by; schedule them early
+    return float("inf") if start is None else end - start
+
+
+def _call_indexed(args):
+    idx, func, task = args
+    return idx, func(task)
+
+
+def map_shards(func, tasks, shards, processes=1, on_result=None):
+    """
+    Run ``func`` over a list of tasks, one per shard, optionally in a process pool.
+
+    Tasks for the largest shards are submitted first so that long-running shards
+    do not end up at the back of the queue.
+
+    Args:
+        func (callable): Picklable, module-level function taking a single task.
+        tasks (list): One task per shard.
+        shards (list): Shards the tasks correspond to, used for scheduling only.
+        processes (int): Number of worker processes. 1 runs serially in this process.
+        on_result (callable, optional): Called with each result as it arrives (in completion order),
+            e.g. to report progress.
+
+    Returns:
+        list: Results of ``func`` in the same order as ``tasks``.
+    """
+    if processes <= 1 or len(tasks) <= 1:
+        results = []
+        for task in tasks:
+            results.append(func(task))
+            if on_result is not None:
+                on_result(results[-1])
+        return results
+    order = sorted(range(len(tasks)), key=lambda i: _shard_weight(shards[i]), reverse=True)
+    results = [None] * len(tasks)
+    # spawn rather than fork: safer with pysam/htslib state in Conda envs
+    with get_context("spawn").Pool(processes=min(processes, len(tasks))) as pool:
+        for idx, result in pool.imap_unordered(_call_indexed, [(i, func, tasks[i]) for i in order]):
+            results[idx] = result
+            if on_result is not None:
+                on_result(result)
+    return results
@@ -0,0 +1,148 @@
+# pylint: disable=no-member
+"""
+Module: sort_merge_tagging
+
+Bounded-memory alternative to ``wp3_add_custom_tags.add_isoform_tags`` with a
+``load_cluster_map`` dict. Instead of holding every read name in memory:
+
+1. The read-to-transcript table is externally sorted by read name in chunks.
+2. The names of taggable reads are streamed from the coordinate-sorted BAM,
+   with their record number, and externally sorted the same way (a collated view).
+3. The two sorted streams are merge-joined, writing each matched cluster ID
+   into an on-disk array indexed by record number.
+4. The BAM is streamed again in coordinate order and tagged from that array,
+   so the output needs no re-sorting.
+
+Peak memory is set by ``memory_mb``, whatever the read count.
+"""
+
+import heapq
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+from itertools import groupby
+
+import numpy as np
+import pysam
+
+from bam_manipulation.wp3_add_custom_tags import iter_cluster_rows, number_transcripts
+
+# Rough in-memory cost of one buffered (name, number, number) record, used to size sort chunks
+RECORD_BYTES = 200
+
+
+def _is_taggable(read):
+    return not (read.is_unmapped or read.is_secondary or read.is_supplementary)
+
+
+def _sorted_runs(records, run_dir, prefix, chunk_records):
+    """Sort (name, a, b) records in chunks of ``chunk_records`` and write each chunk to a run file."""
+    paths = []
+    chunk = []
+
+    def spill():
+        chunk.sort()
+        path = os.path.join(run_dir, f"{prefix}.{len(paths):05d}.tsv")
+        with open(path, "w") as fh:
+            fh.writelines(f"{name}\t{a}\t{b}\n" for name, a, b in chunk)
+        paths.append(path)
+        chunk.clear()
+
+    for record in records:
+        chunk.append(record)
+        if len(chunk) >= chunk_records:
+            spill()
+    if chunk:
+        spill()
+    return paths
+
+
+def _read_run(path):
+    with open(path) as fh:
+        for line in fh:
+            name, a, b = line.rstrip("\n").split("\t")
+            yield name, int(a), int(b)
+
+
+def _merged_runs(paths):
+    return heapq.merge(*[_read_run(p) for p in paths])
+
+
+def add_isoform_tags_streaming(input_bam, output_bam, cluster_file, memory_mb=1024, tmp_dir=None,
+                               read_col=1, gene_col=2, transcript_col=3, delimiter='\t'):
+    """
+    Add IC tags by a streaming sort-merge join of the clusters TSV and the BAM.
+
+    Tags, cluster numbering and pass-through of unmapped, secondary and supplementary reads are
+    identical to ``add_isoform_tags(input_bam, output_bam, load_cluster_map(cluster_file, ...))``.
+
+    Args:
+        input_bam (str): Path to input BAM (coordinate-sorted).
+        output_bam (str): Path to output BAM to write; it is indexed afterwards.
+        cluster_file (str): TSV mapping read name, gene ID, transcript ID per line.
+        memory_mb (float): Approximate memory budget for sort chunks, in MiB.
+        tmp_dir (str, optional): Directory for sorted runs and the record-number array.
+        read_col, gene_col, transcript_col (int): 1-based columns in the TSV.
+        delimiter (str): Column delimiter in TSV (default tab).
+    """
+    chunk_records = max(1, int(memory_mb * 2**20 / RECORD_BYTES))
+    work_dir = tempfile.mkdtemp(prefix="ic_sort_merge.", dir=tmp_dir)
+    try:
+        # 1. Sorted runs of (read name, row number, transcript index); the last row for a read wins
+        gene_transcripts = OrderedDict()
+
+        def table_records():
+            rows = iter_cluster_rows(cluster_file, read_col, gene_col, transcript_col, delimiter)
+            for row_num, (read_name, gene_id, transcript_id) in enumerate(rows):
+                tx = gene_transcripts.setdefault((gene_id, transcript_id), len(gene_transcripts))
+                yield read_name, row_num, tx
+
+        table_runs = _sorted_runs(table_records(), work_dir, "table", chunk_records)
+        numbered = number_transcripts(gene_transcripts)
+        tx_cluster = np.array([numbered[pair] for pair in gene_transcripts], dtype=np.int32)
+
+        # 2. Sorted runs of (read name, record number, 0) for taggable reads in the BAM
+        n_records = 0
+
+        def bam_records():
+            nonlocal n_records
+            with pysam.AlignmentFile(input_bam, "rb") as bam_in:
+                for record_num, read in enumerate(bam_in.fetch(until_eof=True)):
+                    n_records = record_num + 1
+                    if _is_taggable(read):
+                        yield read.query_name, record_num, 0
+
+        bam_runs = _sorted_runs(bam_records(), work_dir, "bam", chunk_records)
+
+        # 3. Merge-join into an on-disk array of cluster IDs by record number
+        cids = np.memmap(os.path.join(work_dir, "cluster_ids.i32"), dtype=np.int32, mode="w+",
+                         shape=(max(n_records, 1),))
+        table = groupby(_merged_runs(table_runs), key=lambda r: r[0])
+        current = next(table, None)
+        for name, bam_group in groupby(_merged_runs(bam_runs), key=lambda r: r[0]):
+            while current is not None and current[0] < name:
+                current = next(table, None)
+            if current is None:
+                break
+            if current[0] != name:
+                continue
+            cid = int(tx_cluster[max(current[1])[2]])
+            for _, record_num, _ in bam_group:
+                cids[record_num] = cid
+        cids.flush()
+
+        # 4. Tag in the original coordinate order
+        bam_in = pysam.AlignmentFile(input_bam, "rb")
+        header = bam_in.header.to_dict()
+        header.setdefault("CO", []).append("IC:i: Isoform cluster ID assigned by bam_isoform_tagger")
+        with pysam.AlignmentFile(output_bam, "wb", header=header) as bam_out:
+            for record_num, read in enumerate(bam_in.fetch(until_eof=True)):
+                if _is_taggable(read):
+                    read.set_tag("IC", int(cids[record_num]), value_type="i")
+                bam_out.write(read)
+        bam_in.close()
+        del cids
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    pysam.index(output_bam)
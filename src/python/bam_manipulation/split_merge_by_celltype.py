@@ -0,0 +1,161 @@
+# pylint: disable=no-member
+"""
+Module: split_merge_by_celltype
+
+Splits several coordinate-sorted sample BAMs by cell type and merges them
+across samples in a single pass. The inputs are k-way merged by position and
+each read is written straight into its cross-sample per-cell-type BAM, so the
+per-sample ``{sample}_files/{sample}_{celltype}.bam`` intermediates written by
+``bamTagHandling`` and re-read by ``merge_samples_by_celltype`` are no longer
+needed. They can still be written alongside, in the same layout.
+"""
+
+import heapq
+import sys
+from collections import defaultdict
+from pathlib import Path
+
+import pandas as pd
+import pysam
+
+from bam_manipulation.barcodes import BarcodeIndex, read_blocks
+from bam_manipulation.mapping_registry import CompiledMapping, load_mapping
+from bam_manipulation.writer_pool import BamWriterPool
+
+
+def load_sample_mapping(mapping, sample_col="sample", barcode_col="cell_barcode", celltype_col="Cluster", delim=","):
+    """
+    Load a multi-sample barcode mapping such as ``cc_barcode.csv``.
+
+    Args:
+        mapping (str): Path to delimited file with sample, barcode and cell type columns.
+        sample_col (str): Column telling samples apart.
+        barcode_col (str): Column of cell barcodes (CB tag values).
+        celltype_col (str): Column of cell type names.
+        delim (str): Column delimiter (default comma).
+
+    Returns:
+        dict: Mapping {sample: {barcode: celltype}}.
+    """
+    df = pd.read_csv(mapping, sep=delim, usecols=[sample_col, barcode_col, celltype_col])
+    sample_to_tags = defaultdict(dict)
+    for sample, barcode, celltype in zip(df[sample_col], df[barcode_col], df[celltype_col]):
+        sample_to_tags[sample][barcode] = celltype
+    return dict(sample_to_tags)
+
+
+def _position_key(read):
+    # Same order as a coordinate-sorted BAM: by reference then position, unplaced reads last
+    if read.reference_id < 0:
+        return (sys.maxsize, 0)
+    return (read.reference_id, read.reference_start)
+
+
+def _labelled_reads(sample_idx, bam, barcode_index, labels, sort_target, rg_renames):
+    # Barcodes are resolved a block at a time; reads without a known barcode are dropped here
+    for block, barcodes in read_blocks(bam.fetch(until_eof=True), sort_target):
+        for read, value in zip(block, barcode_index.lookup(barcodes).tolist()):
+            if value < 0:
+                continue
+            if rg_renames and read.has_tag("RG") and read.get_tag("RG") in rg_renames:
+                read.set_tag("RG", rg_renames[read.get_tag("RG")], value_type="Z")
+            yield sample_idx, read, labels[value]
+
+
+def _merged_header(headers, samples):
+    """
+    Header shared by the merged outputs, and the read group renames of each sample.
+
+    Read groups are pooled. As with ``samtools merge``, a read group whose ID is already used by
+    a different read group of an earlier sample is given a unique ID (``{ID}-{sample}``), and the
+    sample's reads are retagged.
+
+    Returns:
+        tuple: (header dict, list of {old_id: new_id} per sample).
+    """
+    first = headers[0]
+    for header in headers[1:]:
+        if header.references != first.references or header.lengths != first.lengths:
+            raise ValueError("All sample BAMs must be aligned to the same reference sequences.")
+    merged = first.to_dict()
+    read_groups, renames = {}, []
+    for sample, header in zip(samples, headers):
+        renamed = {}
+        for rg in header.to_dict().get("RG", []):
+            if read_groups.get(rg["ID"], rg) != rg:
+                renamed[rg["ID"]] = f"{rg['ID']}-{sample}"
+                rg = dict(rg, ID=renamed[rg["ID"]])
+            if read_groups.setdefault(rg["ID"], rg) != rg:
+                raise ValueError(f"Read group '{rg['ID']}' of sample '{sample}' conflicts with another sample's.")
+        renames.append(renamed)
+    if read_groups:
+        merged["RG"] = list(read_groups.values())
+    merged.setdefault("CO", []).append("Merged across samples by split_merge_by_celltype")
+    return merged, renames
+
+
+def split_merge_by_celltype(sample_bams, mapping, output_dir, sample_map=None, intermediate_dir=None,
+                            sort_target="CB", max_open=64, threads=1, **mapping_kwargs):
+    """
+    Split and merge sample BAMs into one BAM per cell type in a single pass.
+
+    Args:
+        sample_bams (dict): Mapping {sample_name: bam_path}, e.g. {"Mira_1": ".../possorted_genome_bam.bam"}.
+            Inputs must be coordinate-sorted and share reference sequences.
+        mapping (str, dict or CompiledMapping): Path to a mapping file (see ``load_sample_mapping``), compiled once
+            into the mapping cache (see ``mapping_registry``), a compiled mapping, or {sample: {barcode: celltype}}.
+        output_dir (str): Directory for ``{celltype}.bam`` outputs.
+        sample_map (dict, optional): Mapping {sample_name: mapping_sample}, e.g. {"Mira_1": "sample4"}, when the
+            mapping's sample column does not use the BAM sample names.
+        intermediate_dir (str, optional): If given, also write ``{sample}_files/{sample}_{celltype}.bam`` per sample here.
+        sort_target (str): Tag holding the cell barcode (default CB).
+        max_open (int): Maximum number of simultaneously open output BAMs.
+        threads (int): BGZF compression threads per open output.
+        **mapping_kwargs: Column names and delimiter passed to ``mapping_registry.compile_mapping``.
+
+    Returns:
+        dict: Mapping {celltype: reads_written} for the merged outputs.
+    """
+    if not isinstance(mapping, dict):
+        mapping = load_mapping(mapping, **mapping_kwargs)
+    sample_map = sample_map or {}
+    samples = list(sample_bams)
+    if isinstance(mapping, CompiledMapping):
+        indexes = [mapping.index(sample_map.get(sample, sample)) for sample in samples]
+    else:
+        indexes = [BarcodeIndex.from_mapping(mapping.get(sample_map.get(sample, sample), {})) for sample in samples]
+    for sample, (barcode_index, _) in zip(samples, indexes):
+        if not len(barcode_index):
+            raise ValueError(f"No barcodes in mapping for sample '{sample}'.")
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    if intermediate_dir is not None:
+        for sample in samples:
+            (Path(intermediate_dir) / f"{sample}_files").mkdir(parents=True, exist_ok=True)
+
+    bams = [pysam.AlignmentFile(str(sample_bams[sample]), "rb") for sample in samples]
+    try:
+        header, rg_renames = _merged_header([bam.header for bam in bams], samples)
+        streams = [_labelled_reads(i, bam, barcode_index, labels, sort_target, rg_renames[i])
+                   for i, (bam, (barcode_index, labels)) in enumerate(zip(bams, indexes))]
+        merged_paths = {}
+        sample_paths = defaultdict(dict)
+        counts = defaultdict(int)
+        with BamWriterPool(header, max_open=max_open, threads=threads) as pool:
+            for i, read, celltype in heapq.merge(*streams, key=lambda item: _position_key(item[1])):
+                if celltype not in merged_paths:
+                    merged_paths[celltype] = str(output_dir / (celltype.replace(" ", "_") + ".bam"))
+                pool.write(merged_paths[celltype], read)
+                counts[celltype] += 1
+                if intermediate_dir is not None:
+                    paths = sample_paths[i]
+                    if celltype not in paths:
+                        sample = samples[i]
+                        name = f"{sample}_{celltype.replace(' ', '_')}.bam"
+                        paths[celltype] = str(Path(intermediate_dir) / f"{sample}_files" / name)
+                    pool.write(paths[celltype], read)
+    finally:
+        for bam in bams:
+            bam.close()
+    return dict(counts)
@@ -11,23 +11,22 @@ Includes a CLI interface.
 import argparse
 import pysam
 import os
+import shutil
 import sys
+import tempfile
 from collections import defaultdict, OrderedDict
+from itertools import islice
 
+from bam_manipulation.checkpoint import ShardCheckpoint, digest, file_fingerprint, map_shards_checkpointed, shard_key
+from bam_manipulation.instrumentation import from_env, instrumented
+from bam_manipulation.sharding import fetch_shard, region_shards
 
-def load_cluster_map(cluster_file, read_col=1, gene_col=2, transcript_col=3, delimiter='\t'):
-    """
-    Load read-to-transcript mapping from a TSV, then assign numeric cluster IDs per gene.
 
-    Args:
-        cluster_file (str): Path to TSV file.
-        read_col (int): 1-based index of column containing read names.
-        gene_col (int): 1-based index of column containing gene IDs.
-        transcript_col (int): 1-based index of column containing transcript IDs.
-        delimiter (str): Column delimiter (default tab).
+def iter_cluster_rows(cluster_file, read_col=1, gene_col=2, transcript_col=3, delimiter='\t'):
+    """
+    Iterate over (read_id, gene_id, transcript_id) rows of a read-to-transcript TSV.
 
-    Returns:
-        dict: Mapping {read_id: cluster_id_int} where cluster IDs are assigned within each gene.
+    Blank lines and lines starting with '#' are skipped.
 
     Raises:
         FileNotFoundError: If the cluster_file does not exist.
@@ -38,98 +37,245 @@ def load_cluster_map(cluster_file, read_col=1, gene_col=2, transcript_col=3, del
     if read_col < 1 or gene_col < 1 or transcript_col < 1:
         raise ValueError("Column indices must be 1 or greater.")
 
-    # Temporary storage: for each gene, maintain an ordered set of transcripts
-    gene_transcripts = OrderedDict()  # gene -> OrderedDict of transcript->None
-    read_to_info = {}
-
+    max_idx = max(read_col, gene_col, transcript_col)
     with open(cluster_file, 'r') as fh:
         for line_num, line in enumerate(fh, start=1):
             line = line.strip()
             if not line or line.startswith('#'):
                 continue
             parts = line.split(delimiter)
-            max_idx = max(read_col, gene_col, transcript_col)
             if len(parts) < max_idx:
                 raise ValueError(
                     f"Line {line_num} in '{cluster_file}' has {len(parts)} columns, "
                     f"but read_col={read_col}, gene_col={gene_col}, transcript_col={transcript_col} require at least {max_idx} columns."
                 )
-            read_name = parts[read_col - 1]
-            gene_id = parts[gene_col - 1]
-            transcript_id = parts[transcript_col - 1]
+            yield parts[read_col - 1], parts[gene_col - 1], parts[transcript_col - 1]
+
+
+def number_transcripts(gene_transcripts):
+    """
+    Number transcripts within each gene from 1, in order of first appearance.
+
+    Args:
+        gene_transcripts (iterable): (gene_id, transcript_id) pairs in order of first appearance.
+
+    Returns:
+        dict: Mapping {(gene_id, transcript_id): cluster_id}.
+    """
+    next_idx = defaultdict(lambda: 1)
+    cluster_ids = {}
+    for gene_id, transcript_id in gene_transcripts:
+        if (gene_id, transcript_id) not in cluster_ids:
+            cluster_ids[(gene_id, transcript_id)] = next_idx[gene_id]
+            next_idx[gene_id] += 1
+    return cluster_ids
+
+
+def load_cluster_map(cluster_file, read_col=1, gene_col=2, transcript_col=3, delimiter='\t'):
+    """
+    Load read-to-transcript mapping from a TSV, then assign numeric cluster IDs per gene.
+
+    Args:
+        cluster_file (str): Path to TSV file.
+        read_col (int): 1-based index of column containing read names.
+        gene_col (int): 1-based index of column containing gene IDs.
+        transcript_col (int): 1-based index of column containing transcript IDs.
+        delimiter (str): Column delimiter (default tab).
+
+    Returns:
+        dict: Mapping {read_id: cluster_id_int} where cluster IDs are assigned within each gene.
+
+    Raises:
+        FileNotFoundError: If the cluster_file does not exist.
+        ValueError: If any line does not contain enough columns.
+    """
+    # (gene, transcript) pairs in order of first appearance, and the last pair seen for each read
+    gene_transcripts = OrderedDict()
+    read_to_info = {}
+    for read_name, gene_id, transcript_id in iter_cluster_rows(cluster_file, read_col, gene_col, transcript_col, delimiter):
+        gene_transcripts.setdefault((gene_id, transcript_id), None)
+        read_to_info[read_name] = (gene_id, transcript_id)
+
+    # Assign numeric index for each transcript per gene, then build final read->cluster_id mapping
+    cluster_ids = number_transcripts(gene_transcripts)
+    return {read_name: cluster_ids[info] for read_name, info in read_to_info.items()}
 
-            if gene_id not in gene_transcripts:
-                gene_transcripts[gene_id] = OrderedDict()
-            # Record transcript order within gene
-            if transcript_id not in gene_transcripts[gene_id]:
-                gene_transcripts[gene_id][transcript_id] = None
 
-            read_to_info[read_name] = (gene_id, transcript_id)
+def _dummy_cluster(read):
+    try:
+        chrom = read.reference_name
+        num = int(chrom.replace("chr", "")) if chrom.startswith("chr") else 0
+        return num % 10
+    except Exception:
+        return 0
+
 
-    # Assign numeric index for each transcript per gene
-    gene_cluster_idx = {}  # gene -> {transcript: index}
-    for gene_id, transcripts in gene_transcripts.items():
-        gene_cluster_idx[gene_id] = {}
-        for idx, transcript_id in enumerate(transcripts.keys(), start=1):
-            gene_cluster_idx[gene_id][transcript_id] = idx
+def _tag_reads(reads, cluster_map, block_size=10_000):
+    """
+    Set the IC tag of primary mapped reads, resolving cluster IDs a block of reads at a time.
 
-    # Build final read->cluster_id mapping
-    read_to_cluster = {}
-    for read_name, (gene_id, transcript_id) in read_to_info.items():
-        cid = gene_cluster_idx[gene_id].get(transcript_id, 0)
-        read_to_cluster[read_name] = cid
+    A ``ClusterIndex`` is queried once per block through ``lookup``; a dict is queried per read.
 
-    return read_to_cluster
+    Yields:
+        pysam.AlignedSegment: Every read, in input order; unmapped, secondary and supplementary reads untagged.
+    """
+    reads = iter(reads)
+    while True:
+        block = list(islice(reads, block_size))
+        if not block:
+            return
+        # Retain unmapped or secondary/supplementary reads without tag
+        primary = [read for read in block if not (read.is_unmapped or read.is_secondary or read.is_supplementary)]
+        if cluster_map is None:
+            cids = [_dummy_cluster(read) for read in primary]
+        elif hasattr(cluster_map, "lookup"):
+            cids = cluster_map.lookup([read.query_name for read in primary]).tolist()
+        else:
+            cids = [cluster_map.get(read.query_name, 0) for read in primary]
+        for read, cid in zip(primary, cids):
+            read.set_tag("IC", cid, value_type="i")
+        yield from block
 
 
-def add_isoform_tags(input_bam, output_bam, cluster_map=None):
+@instrumented("add_isoform_tags")
+def add_isoform_tags(input_bam, output_bam, cluster_map=None, processes=1, threads=1, shard_size=None,
+                     comment="IC:i: Isoform cluster ID assigned by bam_isoform_tagger", checkpoint=None, instrument=None):
     """
     Add isoform cluster ID tags (IC:i:<cluster_id>) to reads in a BAM file.
 
     Args:
         input_bam (str): Path to input BAM (coordinate-sorted, indexed).
         output_bam (str): Path to output BAM to write.
-        cluster_map (dict, optional): Mapping {read_name: cluster_id}. If None, uses dummy logic.
+        cluster_map (dict or ClusterIndex, optional): Mapping {read_name: cluster_id}, or an index resolving
+            blocks of read names with ``lookup`` (or, failing that, any object with a dict-like ``get``).
+            If None, uses dummy logic.
+        processes (int): Worker processes tagging contig shards in parallel. The shards are gathered
+            with ``samtools merge --write-index``, which indexes the output as it is written.
+        threads (int): BGZF threads for reading and writing, per process.
+        shard_size (int, optional): With processes > 1, maximum shard length in bp (default: one per contig).
+        comment (str): @CO header line describing the IC tag.
+        checkpoint (str or bool, optional): Record each tagged shard in this checkpoint file (True: next to the
+            output), keeping the tagged shards in ``{output_bam}.ic_shards`` until the merge succeeds, so a rerun
+            after the job is killed only tags the missing shards. Implies the sharded path, even with one process.
+        instrument (Instrumentation, optional): Records throughput, stage timings and memory (default: configured
+            from the environment, see ``bam_manipulation.instrumentation``).
     """
+    instrument.add_input(input_bam)
+    instrument.add_output(output_bam)
+
     try:
-        bam_in = pysam.AlignmentFile(input_bam, "rb")
+        bam_in = pysam.AlignmentFile(input_bam, "rb", threads=threads)
     except Exception as e:
         sys.exit(f"Error opening input BAM '{input_bam}': {e}")
 
     header = bam_in.header.to_dict()
-    header.setdefault("CO", []).append("IC:i: Isoform cluster ID assigned by bam_isoform_tagger")
+    header.setdefault("CO", []).append(comment)
+
+    if processes > 1 or checkpoint:
+        bam_in.close()
+        if checkpoint is True:
+            checkpoint = f"{output_bam}.checkpoint.json"
+        _add_isoform_tags_parallel(input_bam, output_bam, header, cluster_map, processes, threads, shard_size,
+                                   instrument, checkpoint or None)
+        return
 
     try:
-        bam_out = pysam.AlignmentFile(output_bam, "wb", header=header)
+        bam_out = pysam.AlignmentFile(output_bam, "wb", header=header, threads=threads)
     except Exception as e:
         sys.exit(f"Error creating output BAM '{output_bam}': {e}")
 
-    for read in bam_in.fetch(until_eof=True):
-        # Retain unmapped or secondary/supplementary reads without tag
-        if read.is_unmapped or read.is_secondary or read.is_supplementary:
+    with instrument.stage("tag"), instrument.profiled():
+        n = 0
+        for n, read in enumerate(_tag_reads(bam_in.fetch(until_eof=True), cluster_map), start=1):
             bam_out.write(read)
-            continue
+            if n % 10_000 == 0:
+                instrument.progress(reads=10_000)
+        instrument.progress(reads=n % 10_000)
 
-        if cluster_map is not None:
-            cid = cluster_map.get(read.query_name, 0)
-        else:
-            try:
-                chrom = read.reference_name
-                num = int(chrom.replace("chr", "")) if chrom.startswith("chr") else 0
-                cid = num % 10
-            except Exception:
-                cid = 0
+        bam_in.close()
+        bam_out.close()
+
+    with instrument.stage("index"):
+        try:
+            pysam.index(output_bam, "-@", str(threads))
+        except Exception as e:
+            sys.exit(f"Error indexing output BAM '{output_bam}': {e}")
 
-        read.set_tag("IC", cid, value_type="i")
-        bam_out.write(read)
 
-    bam_in.close()
-    bam_out.close()
+def _tag_shard(task):
+    input_bam, shard, part_path, header, cluster_map, threads = task
+    n = 0
+    with pysam.AlignmentFile(input_bam, "rb", threads=threads) as bam_in:
+        with pysam.AlignmentFile(part_path, "wb", header=header, threads=threads) as bam_out:
+            for read in _tag_reads(fetch_shard(bam_in, shard), cluster_map):
+                bam_out.write(read)
+                n += 1
+    return part_path, n
 
+
+def _cluster_map_identity(cluster_map):
+    from bam_manipulation.read_cluster_index import CLUSTERS_FILE, KEYS_FILE, ClusterIndex
+
+    if cluster_map is None:
+        return None
+    if isinstance(cluster_map, ClusterIndex):
+        return [file_fingerprint(os.path.join(cluster_map.index_dir, name)) for name in (KEYS_FILE, CLUSTERS_FILE)]
+    return digest(cluster_map)
+
+
+def _add_isoform_tags_parallel(input_bam, output_bam, header, cluster_map, processes, threads, shard_size,
+                               instrument, checkpoint_path=None):
+    """
+    Tag region shards in worker processes, then merge them in order while writing the index.
+
+    With ``checkpoint_path``, tagged shards are recorded as they finish and kept across failed runs,
+    so a rerun with the same inputs resumes at the first missing shard.
+    """
+    # Imported here: the index module builds on the loaders in this one
+    from bam_manipulation.read_cluster_index import ClusterIndex, index_from_mapping
+
+    checkpoint = None
+    if checkpoint_path:
+        work_dir = f"{output_bam}.ic_shards"
+        checkpoint = ShardCheckpoint(checkpoint_path, {
+            "input": file_fingerprint(input_bam), "output": os.path.abspath(output_bam), "comment": header["CO"][-1],
+            "shard_size": shard_size, "cluster_map": _cluster_map_identity(cluster_map)})
+        if not checkpoint.resumed:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        os.makedirs(work_dir, exist_ok=True)
+    else:
+        work_dir = tempfile.mkdtemp(prefix=".ic_shards.", dir=os.path.dirname(os.path.abspath(output_bam)))
+    finished = False
     try:
-        pysam.index(output_bam)
+        if cluster_map is not None and not isinstance(cluster_map, ClusterIndex):
+            # Workers share a memory-mapped copy rather than each unpickling the whole dict
+            cluster_map = index_from_mapping(cluster_map, os.path.join(work_dir, "cluster_index"))
+        shards = region_shards(input_bam, shard_size)
+        tasks = [(input_bam, shard, os.path.join(work_dir, f"{shard_key(i, shard)}.bam"), header, cluster_map, threads)
+                 for i, shard in enumerate(shards)]
+        def on_result(result):
+            instrument.progress(reads=result[1])
+        with instrument.stage("tag"):
+            results = map_shards_checkpointed(_tag_shard, tasks, shards, processes, checkpoint, list, tuple, on_result)
+            parts = [part for part, _ in results]
+        if not parts:
+            pysam.AlignmentFile(output_bam, "wb", header=header).close()
+            pysam.index(output_bam)
+        else:
+            # Shards cover disjoint regions in file order, so merging only interleaves at shard boundaries;
+            # -c/-p keep the shared @RG/@PG IDs as they are
+            with instrument.stage("merge"):
+                pysam.merge("-f", "-c", "-p", "--no-PG", "--write-index", "-@", str(processes * threads),
+                            "-o", f"{output_bam}##idx##{output_bam}.bai", *parts)
+        finished = True
     except Exception as e:
-        sys.exit(f"Error indexing output BAM '{output_bam}': {e}")
+        sys.exit(f"Error writing output BAM '{output_bam}': {e}")
+    finally:
+        # A checkpointed run keeps its tagged shards until the output is complete
+        if finished or checkpoint is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        if finished and checkpoint is not None:
+            checkpoint.remove()
 
 
 def parse_args(argv=None):
@@ -151,9 +297,13 @@ def parse_args(argv=None):
         help="Output BAM with IC tag"
     )
     parser.add_argument(
-        "-c", "--cluster_file", required=True,
+        "-c", "--cluster_file",
         help="TSV mapping read name, gene ID, transcript ID per line"
     )
+    parser.add_argument(
+        "--index",
+        help="Memory-mapped read-to-cluster index directory; built from --cluster_file if it does not exist yet"
+    )
     parser.add_argument(
         "--read_col", type=int, default=1,
         help="1-based column number for read names in TSV (default: 1)"
@@ -170,28 +320,111 @@ def parse_args(argv=None):
         "--delimiter", default="\t",
         help="Column delimiter in TSV (default: tab)"
     )
-    return parser.parse_args(argv)
+    parser.add_argument(
+        "--processes", type=int, default=1,
+        help="Worker processes tagging contig shards in parallel (default: 1)"
+    )
+    parser.add_argument(
+        "--threads", type=int, default=1,
+        help="BGZF compression/decompression threads per process (default: 1)"
+    )
+    parser.add_argument(
+        "--checkpoint", action="store_true",
+        help="Record tagged shards in <output>.checkpoint.json so a rerun after the job is killed resumes (default: off)"
+    )
+    parser.add_argument(
+        "--streaming", action="store_true",
+        help="Join the TSV and BAM by external sort-merge within --memory_mb instead of loading the TSV into memory"
+    )
+    parser.add_argument(
+        "--memory_mb", type=float, default=1024,
+        help="Memory budget in MiB for --streaming (default: 1024)"
+    )
+    parser.add_argument(
+        "--tmp_dir",
+        help="Directory for --streaming temporary files (default: system temp directory)"
+    )
+    parser.add_argument(
+        "--metrics_dir",
+        help="Write JSON-lines progress events and a summary here (default: $BAM_METRICS_DIR, if set)"
+    )
+    parser.add_argument(
+        "--profile", choices=["cprofile", "sample"],
+        help="Profile the tagging loop into --metrics_dir (default: $BAM_PROFILE, if set)"
+    )
+    args = parser.parse_args(argv)
+    if args.cluster_file is None and args.index is None:
+        parser.error("one of --cluster_file or --index is required")
+    if args.streaming and args.cluster_file is None:
+        parser.error("--streaming requires --cluster_file")
+    if args.streaming:
+        # The sort-merge join is single-process and writes no checkpoint or metrics
+        unsupported = [flag for flag, given in (("--processes", args.processes != 1), ("--threads", args.threads != 1),
+                                                ("--checkpoint", args.checkpoint), ("--index", args.index is not None),
+                                                ("--metrics_dir", args.metrics_dir is not None),
+                                                ("--profile", args.profile is not None)) if given]
+        if unsupported:
+            parser.error(f"--streaming cannot be combined with {', '.join(unsupported)}")
+    return args
 
 
 def main(argv=None):
     args = parse_args(argv)
 
-    try:
-        cluster_map = load_cluster_map(
+    if args.streaming:
+        from bam_manipulation.sort_merge_tagging import add_isoform_tags_streaming
+        add_isoform_tags_streaming(
+            args.input,
+            args.output,
             args.cluster_file,
+            memory_mb=args.memory_mb,
+            tmp_dir=args.tmp_dir,
             read_col=args.read_col,
             gene_col=args.gene_col,
             transcript_col=args.transcript_col,
             delimiter=args.delimiter
         )
+        print(f"Written and indexed: {args.output}")
+        return
+
+    try:
+        if args.index:
+            # Imported here: the index module builds on the loaders in this one
+            from bam_manipulation.read_cluster_index import ClusterIndex, build_cluster_index, is_cluster_index
+            if is_cluster_index(args.index):
+                cluster_map = ClusterIndex(args.index)
+            else:
+                if args.cluster_file is None:
+                    raise ValueError(f"No index at '{args.index}' and no --cluster_file to build it from")
+                cluster_map = build_cluster_index(
+                    args.cluster_file,
+                    args.index,
+                    read_col=args.read_col,
+                    gene_col=args.gene_col,
+                    transcript_col=args.transcript_col,
+                    delimiter=args.delimiter
+                )
+        else:
+            cluster_map = load_cluster_map(
+                args.cluster_file,
+                read_col=args.read_col,
+                gene_col=args.gene_col,
+                transcript_col=args.transcript_col,
+                delimiter=args.delimiter
+            )
     except Exception as e:
         sys.exit(f"Error loading cluster map: {e}")
 
-    add_isoform_tags(
-        input_bam=args.input,
-        output_bam=args.output,
-        cluster_map=cluster_map
-    )
+    with from_env("add_isoform_tags", metrics_dir=args.metrics_dir, profile=args.profile) as instrument:
+        add_isoform_tags(
+            input_bam=args.input,
+            output_bam=args.output,
+            cluster_map=cluster_map,
+            processes=args.processes,
+            threads=args.threads,
+            checkpoint=args.checkpoint,
+            instrument=instrument
+        )
 
     print(f"Written and indexed: {args.output}")
 
@@ -9,6 +9,10 @@ def parse_args(argv=None):
     parser.add_argument("-o", "--output", required=True, help="Output BAM with IC tag")
     parser.add_argument("-c", "--cluster_file", required=False,
                         help="Optional TSV mapping read name → cluster ID; else use dummy logic")
+    parser.add_argument("-p", "--processes", type=int, default=1,
+                        help="Worker processes tagging contig shards in parallel; output is indexed while it is written")
+    parser.add_argument("-@", "--threads", type=int, default=1,
+                        help="BGZF compression/decompression threads per process")
     return parser.parse_args(argv)
 
 def load_cluster_map(cluster_file):
@@ -29,17 +33,26 @@ def load_cluster_map(cluster_file):
 
 def main(argv=None):
     args = parse_args(argv)
-    bam_in = pysam.AlignmentFile(args.input, "rb")
+
+    cluster_map = {}
+    if args.cluster_file:
+        cluster_map = load_cluster_map(args.cluster_file)
+
+    if args.processes > 1:
+        # Sharded tagging lives in the package; imported here so serial runs work as a standalone script
+        from bam_manipulation.wp3_add_custom_tags import add_isoform_tags
+        add_isoform_tags(args.input, args.output, cluster_map=cluster_map or None, processes=args.processes,
+                         threads=args.threads, comment="IC:i: Isoform cluster ID assigned by WP3 script")
+        print(f"Written and indexed: {args.output}")
+        return
+
+    bam_in = pysam.AlignmentFile(args.input, "rb", threads=args.threads)
     header = bam_in.header.to_dict()
 
     # Optionally add a comment about what IC means
     header.setdefault("CO", []).append("IC:i: Isoform cluster ID assigned by WP3 script")
 
-    bam_out = pysam.AlignmentFile(args.output, "wb", header=header)
-
-    cluster_map = {}
-    if args.cluster_file:
-        cluster_map = load_cluster_map(args.cluster_file)
+    bam_out = pysam.AlignmentFile(args.output, "wb", header=header, threads=args.threads)
 
     for read in bam_in.fetch(until_eof=True):
         # 1) Skip unmapped or secondary/supplementary reads
@@ -70,7 +83,7 @@ def main(argv=None):
     bam_out.close()
 
     # 5) Index the new BAM
-    pysam.index(args.output)
+    pysam.index(args.output, "-@", str(args.threads))
     print(f"Written and indexed: {args.output}")
 
 if __name__ == "__main__":
@@ -0,0 +1,135 @@
+# pylint: disable=no-member
+"""
+Module: writer_pool
+
+Provides a pool of BAM writers for splitting one input into many outputs
+without running out of file descriptors or memory.
+
+Reads are buffered per output and written in batches. At most ``max_open``
+outputs have an open ``pysam.AlignmentFile`` at any time; when the cap is hit
+the least recently used handle is closed, and the next batch for that output
+starts a new segment file. On ``close()`` the segments of each output are
+concatenated, in write order, into the final BAM.
+"""
+
+import os
+import shutil
+from collections import OrderedDict, defaultdict
+
+import pysam
+import pysam.samtools
+
+
+class BamWriterPool:
+    """
+    Buffered writers for many BAM outputs sharing one header, with a cap on open handles.
+
+    Args:
+        header (pysam.AlignmentHeader or dict): Header written to every output.
+        max_open (int): Maximum number of simultaneously open output handles.
+        buffer_reads (int): Reads buffered per output before that output is flushed.
+        max_buffered_reads (int): Reads buffered across all outputs before the largest buffers are flushed.
+        threads (int): BGZF compression threads for each open handle.
+
+    Use as a context manager, or call ``close()`` to flush and finalise all outputs.
+    """
+
+    def __init__(self, header, max_open=64, buffer_reads=1000, max_buffered_reads=1_000_000, threads=1):
+        if max_open < 1:
+            raise ValueError("max_open must be 1 or greater.")
+        if buffer_reads < 1 or max_buffered_reads < 1:
+            raise ValueError("Buffer sizes must be 1 or greater.")
+        self.header = header
+        self.max_open = max_open
+        self.buffer_reads = buffer_reads
+        self.max_buffered_reads = max_buffered_reads
+        self.threads = threads
+        self.counts = defaultdict(int)  # path -> reads written
+        self._buffers = defaultdict(list)  # path -> buffered reads
+        self._buffered = 0
+        self._handles = OrderedDict()  # path -> open AlignmentFile, least recently used first
+        self._segments = defaultdict(list)  # path -> segment files in write order
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def touch(self, path):
+        """Register an output so that it is created on ``close()`` even if no reads are written to it."""
+        self.counts[path] += 0
+
+    def write(self, path, read):
+        """Buffer ``read`` for the output at ``path``."""
+        buffer = self._buffers[path]
+        buffer.append(read)
+        self.counts[path] += 1
+        self._buffered += 1
+        if len(buffer) >= self.buffer_reads:
+            self.flush(path)
+        elif self._buffered >= self.max_buffered_reads:
+            # Flush the largest buffers until we are back under half the budget
+            for largest in sorted(self._buffers, key=lambda p: len(self._buffers[p]), reverse=True):
+                self.flush(largest)
+                if self._buffered < self.max_buffered_reads // 2:
+                    break
+
+    def flush(self, path=None):
+        """Write buffered reads for ``path``, or for every output if None."""
+        paths = list(self._buffers) if path is None else [path]
+        for p in paths:
+            buffer = self._buffers.pop(p, None)
+            if not buffer:
+                continue
+            handle = self._handle(p)
+            for read in buffer:
+                handle.write(read)
+            self._buffered -= len(buffer)
+
+    def close(self):
+        """
+        Flush all buffers, close all handles and merge multi-segment outputs.
+
+        Returns:
+            dict: Mapping {path: reads_written} for every output.
+        """
+        if self._closed:
+            return dict(self.counts)
+        self.flush()
+        for handle in self._handles.values():
+            handle.close()
+        self._handles.clear()
+        for path in self.counts:
+            segments = self._segments.get(path)
+            if not segments:
+                pysam.AlignmentFile(path, "wb", header=self.header).close()
+            elif len(segments) > 1:
+                _concatenate(path, segments)
+        self._closed = True
+        return dict(self.counts)
+
+    def _handle(self, path):
+        if path in self._handles:
+            self._handles.move_to_end(path)
+            return self._handles[path]
+        while len(self._handles) >= self.max_open:
+            _, evicted = self._handles.popitem(last=False)
+            evicted.close()
+        segments = self._segments[path]
+        # The first segment is written in place; later segments go alongside it
+        segment = path if not segments else f"{path}.part{len(segments)}"
+        segments.append(segment)
+        handle = pysam.AlignmentFile(segment, "wb", header=self.header, threads=self.threads)
+        self._handles[path] = handle
+        return handle
+
+
+def _concatenate(path, segments):
+    first = f"{path}.part0"
+    shutil.move(segments[0], first)
+    parts = [first] + segments[1:]
+    pysam.samtools.cat("-o", path, *parts, catch_stdout=False)
+    for part in parts:
+        os.remove(part)
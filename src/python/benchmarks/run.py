@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""
+Module: run
+
+Benchmarks of the BAM pipeline entry points on synthetic data.
+
+Each benchmark runs one entry point (``bamTagHandling``, ``barcode_coverage``,
+``add_isoform_tags``, ``merge_samples_by_celltype``) on a dataset from
+``benchmarks.synthetic`` at one of several scales. Every measured run happens
+in a freshly spawned process, so its peak RSS (including any worker processes
+it starts) is its own, and reports wall and CPU time, reads/s and the bytes it
+wrote. Results are saved as JSON and can be compared against a stored baseline
+file, flagging throughput or memory regressions beyond a tolerance.
+
+Everything runs offline. Includes a CLI interface.
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from datetime import datetime, timezone
+from multiprocessing import get_context
+
+import numpy as np
+import pandas as pd
+import pysam
+
+from benchmarks.synthetic import SyntheticConfig, generate
+
+SCALES = {
+    "small": SyntheticConfig(n_reads=20_000, samples=["Mira_1", "Mira_2"], n_barcodes=500),
+    "medium": SyntheticConfig(n_reads=200_000, samples=["Mira_1", "Mira_2"]),
+    "large": SyntheticConfig(n_reads=2_000_000, samples=["Mira_1", "Mira_2"], n_barcodes=10_000),
+}
+
+
+def _bam_tag_handling(dataset, processes):
+    from bam_manipulation.rs_bam_handling import bamTagHandling
+    sample, bam = next(iter(dataset["bams"].items()))
+    bamTagHandling(os.path.abspath(bam), mapping=os.path.abspath(dataset["mappings"][sample]), output=sample,
+                   processes=processes)
+    return dataset["config"]["n_reads"]
+
+
+def _barcode_coverage(dataset, processes):
+    from bam_manipulation.barcode_coverage import barcode_coverage, write_coverage_results
+    results = barcode_coverage(dataset["bams"], dataset["mapping"], processes=processes)
+    write_coverage_results(results, "barcode_coverage.csv", "barcode_counts.csv")
+    return sum(r.total_reads for r in results)
+
+
+def _add_isoform_tags(dataset, processes):
+    from bam_manipulation.wp3_add_custom_tags import add_isoform_tags, load_cluster_map
+    sample, bam = next(iter(dataset["bams"].items()))
+    cluster_map = load_cluster_map(dataset["clusters"][sample], read_col=1, gene_col=3, transcript_col=2)
+    add_isoform_tags(bam, f"{sample}.IC.bam", cluster_map, processes=processes)
+    return dataset["config"]["n_reads"]
+
+
+def _split_samples(dataset, processes):
+    from bam_manipulation.rs_bam_handling import bamTagHandling
+    for sample, bam in dataset["bams"].items():
+        bamTagHandling(os.path.abspath(bam), mapping=os.path.abspath(dataset["mappings"][sample]), output=sample,
+                       processes=processes)
+
+
+def _merge_samples(dataset, processes):
+    from bam_manipulation.merge_samples_by_celltype import merge_samples_by_celltype
+    merge_samples_by_celltype(".", "merged", samples=list(dataset["bams"]), threads=processes, force=True)
+    return dataset["config"]["n_reads"] * len(dataset["bams"])
+
+
+# name -> (untimed setup or None, timed run); both are called as f(dataset, processes) in the work directory
+BENCHMARKS = {
+    "bamTagHandling": (None, _bam_tag_handling),
+    "barcode_coverage": (None, _barcode_coverage),
+    "add_isoform_tags": (None, _add_isoform_tags),
+    "merge_samples_by_celltype": (_split_samples, _merge_samples),
+}
+
+
+def _measure(task):
+    func, dataset, processes, work_dir = task
+    os.chdir(work_dir)
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    start = time.perf_counter()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+        reads = func(dataset, processes)
+    seconds = time.perf_counter() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = (after.ru_utime + after.ru_stime - before.ru_utime - before.ru_stime
+           + children.ru_utime + children.ru_stime)
+    # ru_maxrss is in KiB on Linux; children reports the largest worker process
+    peak_kib = max(after.ru_maxrss, children.ru_maxrss)
+    return reads, seconds, cpu, peak_kib / 1024
+
+
+def _measure_into(queue, task):
+    try:
+        queue.put((True, _measure(task)))
+    except BaseException:  # pylint: disable=broad-except
+        queue.put((False, traceback.format_exc()))
+
+
+def _isolated(func, dataset, processes, work_dir):
+    # A plain (non-daemonic) process, so the entry point can start its own worker pool
+    ctx = get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_measure_into, args=(queue, (func, dataset, processes, work_dir)))
+    proc.start()
+    ok, value = queue.get()
+    proc.join()
+    if not ok:
+        raise RuntimeError(f"Benchmark {func.__name__} failed:\n{value}")
+    return value
+
+
+def _tree_bytes(path):
+    return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+
+
+def run_benchmark(name, dataset, processes=1, repeat=1, work_root=None):
+    """
+    Run one benchmark on a generated dataset.
+
+    Args:
+        name (str): Key of ``BENCHMARKS``.
+        dataset (dict): As returned by ``synthetic.generate``; paths must be absolute.
+        processes (int): Worker processes (or threads, for merging) given to the entry point.
+        repeat (int): Measured runs; the fastest is reported.
+        work_root (str, optional): Directory for scratch work directories (default: system temp).
+
+    Returns:
+        dict: Measurements with keys benchmark, processes, reads, seconds, cpu_seconds, reads_per_s,
+            peak_rss_mb and output_bytes.
+    """
+    setup, func = BENCHMARKS[name]
+    best = None
+    for _ in range(max(repeat, 1)):
+        work_dir = tempfile.mkdtemp(prefix=f"{name}.", dir=work_root)
+        try:
+            if setup is not None:
+                _isolated(setup, dataset, processes, work_dir)
+            before = _tree_bytes(work_dir)
+            reads, seconds, cpu, peak_mb = _isolated(func, dataset, processes, work_dir)
+            output_bytes = _tree_bytes(work_dir) - before
+        finally:
+            shutil.rmtree(work_dir)
+        if best is None or seconds < best["seconds"]:
+            best = {
+                "benchmark": name,
+                "processes": processes,
+                "reads": reads,
+                "seconds": round(seconds, 4),
+                "cpu_seconds": round(cpu, 4),
+                "reads_per_s": round(reads / seconds, 1) if seconds else None,
+                "peak_rss_mb": round(peak_mb, 1),
+                "output_bytes": output_bytes,
+            }
+    return best
+
+
+def environment():
+    """Versions and machine details recorded with results."""
+    return {
+        "python": platform.python_version(),
+        "pysam": pysam.__version__,
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def run_suite(scales=("small",), benchmarks=None, processes=(1,), repeat=1, data_dir=".benchmark_data",
+              work_root=None, configs=None):
+    """
+    Run benchmarks over scales and process counts.
+
+    Datasets are generated under ``data_dir/{scale}-{config digest}`` and reused by later runs.
+
+    Args:
+        configs (dict, optional): {scale: SyntheticConfig}, overriding ``SCALES``.
+
+    Returns:
+        dict: {"created": ISO time, "environment": {...}, "results": [records with a "scale" key]}.
+    """
+    configs = configs or SCALES
+    benchmarks = benchmarks or list(BENCHMARKS)
+    results = []
+    for scale in scales:
+        config = configs[scale]
+        dataset = generate(config, os.path.abspath(os.path.join(data_dir, f"{scale}-{config.digest()}")))
+        for name in benchmarks:
+            for n in processes:
+                record = run_benchmark(name, dataset, processes=n, repeat=repeat, work_root=work_root)
+                results.append({"scale": scale, **record})
+    return {"created": datetime.now(timezone.utc).isoformat(timespec="seconds"), "environment": environment(),
+            "results": results}
+
+
+def save_results(results, path):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as fh:
+        json.dump(results, fh, indent=2)
+    os.replace(tmp_path, path)
+
+
+def load_results(path):
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def compare(results, baseline, tolerance=0.1):
+    """
+    Compare results with a baseline run.
+
+    A benchmark regresses if its reads/s drops, or its peak RSS grows, by more than ``tolerance``
+    (a fraction) relative to the baseline record with the same benchmark, scale and processes.
+
+    Returns:
+        pandas.DataFrame: One row per result found in the baseline, with throughput and memory ratios
+            (current / baseline) and a ``regression`` flag.
+    """
+    key = ("benchmark", "scale", "processes")
+    current = pd.DataFrame(results["results"])
+    previous = pd.DataFrame(baseline["results"])
+    if current.empty or previous.empty:
+        return pd.DataFrame(columns=[*key, "throughput_ratio", "memory_ratio", "regression"])
+    df = current.merge(previous, on=list(key), suffixes=("", "_baseline"))
+    df["throughput_ratio"] = (df["reads_per_s"] / df["reads_per_s_baseline"]).round(3)
+    df["memory_ratio"] = (df["peak_rss_mb"] / df["peak_rss_mb_baseline"]).round(3)
+    df["regression"] = (df["throughput_ratio"] < 1 - tolerance) | (df["memory_ratio"] > 1 + tolerance)
+    return df[[*key, "reads_per_s", "reads_per_s_baseline", "throughput_ratio", "peak_rss_mb",
+               "peak_rss_mb_baseline", "memory_ratio", "regression"]]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the BAM pipeline entry points on synthetic data")
+    parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=["small"], help="Dataset scales (default: small)")
+    parser.add_argument("--benchmarks", nargs="+", choices=list(BENCHMARKS), help="Benchmarks to run (default: all)")
+    parser.add_argument("--processes", nargs="+", type=int, default=[1], help="Process counts to run each benchmark with (default: 1)")
+    parser.add_argument("--repeat", type=int, default=1, help="Measured runs per benchmark; the fastest is kept (default: 1)")
+    parser.add_argument("--data-dir", default=".benchmark_data", help="Directory for generated datasets (default: %(default)s)")
+    parser.add_argument("--work-dir", help="Directory for scratch outputs (default: system temp)")
+    parser.add_argument("-o", "--output", default="benchmark_results.json", help="Results JSON (default: %(default)s)")
+    parser.add_argument("--baseline", help="Baseline results JSON to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed fractional slowdown or memory growth (default: 0.1)")
+    parser.add_argument("--fail-on-regression", action="store_true", help="Exit with status 1 if any benchmark regresses")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run_suite(args.scales, args.benchmarks, args.processes, args.repeat, args.data_dir, args.work_dir)
+    save_results(results, args.output)
+    print(pd.DataFrame(results["results"]).to_string(index=False))
+    print(f"Results saved to {args.output}")
+    if args.baseline:
+        comparison = compare(results, load_results(args.baseline), args.tolerance)
+        print(comparison.to_string(index=False))
+        if args.fail_on_regression and comparison["regression"].any():
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
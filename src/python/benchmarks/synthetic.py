@@ -0,0 +1,187 @@
+# pylint: disable=no-member
+"""
+Module: synthetic
+
+Deterministic synthetic inputs for the BAM pipeline benchmarks.
+
+``generate`` writes, for a ``SyntheticConfig``, one coordinate-sorted and
+indexed 10x-style BAM per sample together with the files the pipelines read
+alongside it: a barcode-to-cell-type mapping in both the per-sample
+(``cc_barcode_Mira_1.csv``) and the pooled (``cc_barcode.csv``) layouts, and a
+read-to-transcript table as written by ``read_to_transcripts_tsv``. Every
+value is drawn from a ``numpy`` generator seeded from the config, so the same
+config always produces the same files, and nothing is downloaded.
+"""
+
+import csv
+import hashlib
+import json
+import os
+from dataclasses import asdict, dataclass, field
+
+import numpy as np
+import pysam
+
+BASES = np.array(list("ACGT"))
+
+
+@dataclass
+class SyntheticConfig:
+    """
+    Shape of a synthetic dataset.
+
+    Attributes:
+        n_reads (int): Reads per sample.
+        n_contigs (int): Contigs, named ``chr1``, ``chr2``, ...
+        contig_length (int): Length of each contig in bp.
+        n_barcodes (int): Cell barcodes per sample.
+        n_celltypes (int): Cell types barcodes are assigned to.
+        samples (list): Sample names, one BAM each.
+        read_length (int): Aligned length of every read.
+        splice_rate (float): Fraction of reads with an ``N`` operation (and an ``XS`` tag).
+        tag_density (float): Fraction of reads carrying ``CB`` and ``UB`` tags.
+        mapped_barcodes (float): Fraction of each sample's barcodes listed in the mapping.
+        cluster_rate (float): Fraction of reads assigned a transcript in the cluster table.
+        genes_per_contig (int): Genes laid out evenly along each contig, three transcripts each.
+        seed (int): Random seed.
+    """
+    n_reads: int = 100_000
+    n_contigs: int = 4
+    contig_length: int = 5_000_000
+    n_barcodes: int = 2_000
+    n_celltypes: int = 12
+    samples: list = field(default_factory=lambda: ["Mira_1"])
+    read_length: int = 90
+    splice_rate: float = 0.2
+    tag_density: float = 0.9
+    mapped_barcodes: float = 0.8
+    cluster_rate: float = 0.5
+    genes_per_contig: int = 200
+    seed: int = 0
+
+    def digest(self):
+        """Short hash identifying the dataset this config generates."""
+        return hashlib.sha256(json.dumps(asdict(self), sort_keys=True).encode()).hexdigest()[:12]
+
+
+def _barcodes(rng, n):
+    codes = rng.integers(0, 4, size=(n, 16))
+    return ["".join(row) + "-1" for row in BASES[codes]]
+
+
+def _write_bam(path, config, rng, barcodes):
+    header = {
+        "HD": {"VN": "1.6", "SO": "coordinate"},
+        "SQ": [{"SN": f"chr{i + 1}", "LN": config.contig_length} for i in range(config.n_contigs)],
+    }
+    n = config.n_reads
+    length = config.read_length
+    contigs = rng.integers(0, config.n_contigs, size=n)
+    starts = rng.integers(0, config.contig_length - 10 * length - 5000, size=n)
+    order = np.lexsort((starts, contigs))
+    contigs, starts = contigs[order], starts[order]
+    reverse = rng.random(n) < 0.5
+    spliced = rng.random(n) < config.splice_rate
+    anchors = rng.integers(10, length - 10, size=n)
+    introns = rng.integers(80, 5000, size=n)
+    tagged = rng.random(n) < config.tag_density
+    barcode_idx = rng.integers(0, len(barcodes), size=n)
+    umis = ["".join(row) for row in BASES[rng.integers(0, 4, size=(min(n, 50_000), 12))]]
+    umi_idx = rng.integers(0, len(umis), size=n)
+    sequences = ["".join(row) for row in BASES[rng.integers(0, 4, size=(256, length))]]
+    seq_idx = rng.integers(0, len(sequences), size=n)
+    qualities = pysam.qualitystring_to_array("F" * length)
+
+    with pysam.AlignmentFile(str(path), "wb", header=header) as bam:
+        for i in range(n):
+            read = pysam.AlignedSegment(bam.header)
+            read.query_name = f"read{i:09d}"
+            read.flag = 16 if reverse[i] else 0
+            read.reference_id = int(contigs[i])
+            read.reference_start = int(starts[i])
+            read.mapping_quality = 255
+            if spliced[i]:
+                read.cigarstring = f"{anchors[i]}M{introns[i]}N{length - anchors[i]}M"
+            else:
+                read.cigarstring = f"{length}M"
+            read.query_sequence = sequences[seq_idx[i]]
+            read.query_qualities = qualities
+            tags = [("NH", 1)]
+            if spliced[i]:
+                tags.append(("XS", "-" if reverse[i] else "+"))
+            if tagged[i]:
+                tags.extend([("CB", barcodes[barcode_idx[i]]), ("UB", umis[umi_idx[i]])])
+            read.set_tags(tags)
+            bam.write(read)
+    pysam.index(str(path))
+    return contigs, starts
+
+
+def _write_cluster_table(path, config, rng, contigs, starts):
+    # Genes are laid out evenly along each contig; a read belongs to the gene its start falls in
+    gene_span = config.contig_length // config.genes_per_contig
+    chosen = np.flatnonzero(rng.random(len(starts)) < config.cluster_rate)
+    transcripts = rng.integers(1, 4, size=len(chosen))
+    with open(path, "w") as out:
+        out.write("#read_id\ttranscript_id\tgene_id\tprob_assignment_zw\n")
+        for i, t in zip(chosen.tolist(), transcripts.tolist()):
+            gene = f"G{contigs[i] + 1}_{starts[i] // gene_span:05d}"
+            out.write(f"read{i:09d}\t{gene}.{t}\t{gene}\t1.0\n")
+
+
+def generate(config, output_dir):
+    """
+    Write the synthetic dataset for ``config`` into ``output_dir``, unless it is already there.
+
+    Args:
+        config (SyntheticConfig): Dataset shape.
+        output_dir (str): Directory for the dataset; a ``dataset.json`` manifest marks it complete.
+
+    Returns:
+        dict: Dataset description, with keys ``bams`` ({sample: bam}), ``clusters`` ({sample: tsv}),
+            ``mappings`` ({sample: per-sample csv}), ``mapping`` (pooled csv), ``celltypes`` and ``config``.
+    """
+    manifest_path = os.path.join(output_dir, "dataset.json")
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as fh:
+            dataset = json.load(fh)
+        if dataset["config"] == asdict(config):
+            return dataset
+    os.makedirs(output_dir, exist_ok=True)
+
+    rng = np.random.default_rng(config.seed)
+    celltypes = [f"Type {chr(ord('A') + i % 26)}{i // 26 or ''}" for i in range(config.n_celltypes)]
+    dataset = {"bams": {}, "clusters": {}, "mappings": {}, "celltypes": celltypes, "config": asdict(config)}
+    pooled = []
+    for sample in config.samples:
+        barcodes = _barcodes(rng, config.n_barcodes)
+        assigned = rng.integers(0, config.n_celltypes, size=len(barcodes))
+        listed = rng.random(len(barcodes)) < config.mapped_barcodes
+        rows = [(bc, celltypes[ct]) for bc, ct, keep in zip(barcodes, assigned.tolist(), listed) if keep]
+        pooled.extend((sample, bc, ct) for bc, ct in rows)
+        mapping_path = os.path.join(output_dir, f"cc_barcode_{sample}.csv")
+        with open(mapping_path, "w", newline="") as fh:
+            writer = csv.writer(fh)
+            writer.writerow(["cell_barcode", "Cluster"])
+            writer.writerows(rows)
+
+        bam_path = os.path.join(output_dir, f"{sample}.bam")
+        contigs, starts = _write_bam(bam_path, config, rng, barcodes)
+        cluster_path = os.path.join(output_dir, f"{sample}.read_to_transcripts.tsv")
+        _write_cluster_table(cluster_path, config, rng, contigs, starts)
+
+        dataset["bams"][sample] = bam_path
+        dataset["clusters"][sample] = cluster_path
+        dataset["mappings"][sample] = mapping_path
+
+    dataset["mapping"] = os.path.join(output_dir, "cc_barcode.csv")
+    with open(dataset["mapping"], "w", newline="") as fh:
+        writer = csv.writer(fh)
+        writer.writerow(["sample", "cell_barcode", "Cluster"])
+        writer.writerows(pooled)
+
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w") as fh:
+        json.dump(dataset, fh, indent=2)
+    os.replace(tmp_path, manifest_path)
+    return dataset
@@ -0,0 +1,245 @@
+"""
+Module: batch
+
+Renders many regions with pyGenomeTracks concurrently.
+
+Each plot is described by a ``PlotJob``: a region, an output PNG and the
+track definitions of ``plot_by_cell_type`` or ``plot_by_score``. Jobs run in a
+worker pool, each with its own temporary ``.ini`` file, so concurrent jobs and
+concurrent runs in one working directory do not overwrite each other's
+configuration. Unless disabled, each job's BEDs are first pre-sliced to its
+region through ``track_index``, so drawing time follows the region size rather
+than the size of the tracks. Rendered images are kept in a content-addressed cache keyed by
+the hashes of the input files, the region and the style, and a job whose key is
+already cached is copied from the cache instead of being drawn again.
+"""
+
+import csv
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+from plotting.plot_by_score import score_tracks_ini
+from plotting.plot_cell_types import cell_type_tracks_ini
+from plotting.track_index import FILE_PARAMS, INDEX_DIR, PADDING, file_digest, preslice_tracks
+
+TRACK_BUILDERS = {"cell_type": cell_type_tracks_ini, "score": score_tracks_ini}
+REGION_PATTERN = re.compile(r"^(\S+):([\d,]+)(?:-|\.\.)([\d,]+)$")
+
+
+@dataclass
+class PlotJob:
+    """
+    One pyGenomeTracks figure.
+
+    Attributes:
+        region (str): Region as ``contig:start-end`` (``contig:start..end`` is also accepted).
+        output_file (str): Output image path.
+        tracks (dict): Keyword arguments of ``cell_type_tracks_ini`` or ``score_tracks_ini``.
+        kind (str): "cell_type" or "score".
+        dpi, width, trackLabelFraction: pyGenomeTracks options, as in ``plot_by_cell_type``.
+    """
+    region: str
+    output_file: str
+    tracks: dict = field(default_factory=dict)
+    kind: str = "cell_type"
+    dpi: int = 130
+    width: int = 38
+    trackLabelFraction: float = 0.2
+
+
+def normalise_region(region):
+    """Return ``region`` as ``contig:start-end``; raises ValueError if it is not a region."""
+    match = REGION_PATTERN.match(str(region).strip())
+    if not match:
+        raise ValueError(f"Not a region: '{region}'. Expected contig:start-end.")
+    contig, start, end = match.groups()
+    return f"{contig}:{start.replace(',', '')}-{end.replace(',', '')}"
+
+
+def load_gene_regions(path, id_column="Gene ID", coord_column="Genomic Coordinates"):
+    """
+    Read gene regions from a table such as ``analysis/genes_of_interest.csv``.
+
+    Returns:
+        dict: Mapping {gene_id: "contig:start-end"}.
+    """
+    with open(path, newline="") as fh:
+        return {row[id_column]: normalise_region(row[coord_column]) for row in csv.DictReader(fh)}
+
+
+def resolve_region(item, gene_regions=None):
+    """
+    Resolve a region string or gene ID.
+
+    Returns:
+        tuple: (label usable in file names, "contig:start-end").
+    """
+    gene_regions = gene_regions or {}
+    if item in gene_regions:
+        return item, gene_regions[item]
+    region = normalise_region(item)
+    return region.replace(":", "_"), region
+
+
+def job_ini(job, tracks=None):
+    """Track configuration text of a job, optionally with substituted ``tracks``."""
+    if job.kind not in TRACK_BUILDERS:
+        raise ValueError(f"kind must be one of {list(TRACK_BUILDERS)}, not '{job.kind}'.")
+    return TRACK_BUILDERS[job.kind](**(job.tracks if tracks is None else tracks))
+
+
+def _input_files(job):
+    files = []
+    for name in FILE_PARAMS:
+        value = job.tracks.get(name)
+        if value is None:
+            continue
+        files.extend([value] if isinstance(value, (str, os.PathLike)) else value)
+    return [str(f) for f in files]
+
+
+def cache_key(job, ini=None):
+    """
+    Content address of a job's image.
+
+    Input file paths in the configuration are replaced by their content hashes, so a figure is found in
+    the cache as long as its inputs, region and style are unchanged, wherever the inputs live.
+    """
+    ini = job_ini(job) if ini is None else ini
+    for path in _input_files(job):
+        ini = ini.replace(f"file = {path}\n", f"file = {file_digest(path)}\n")
+    h = hashlib.sha256()
+    h.update(ini.encode())
+    h.update(f"\n{normalise_region(job.region)}\t{job.dpi}\t{job.width}\t{job.trackLabelFraction}".encode())
+    return h.hexdigest()
+
+
+def _render(job, ini, work_dir):
+    fd, ini_path = tempfile.mkstemp(suffix=".ini", dir=work_dir)
+    try:
+        with os.fdopen(fd, "w") as fh:
+            fh.write(ini)
+        subprocess.run([
+            "pyGenomeTracks",
+            "--tracks", ini_path,
+            "--region", normalise_region(job.region),
+            "--outFileName", str(job.output_file),
+            "--dpi", str(job.dpi),
+            "--width", str(job.width),
+            "--trackLabelFraction", str(job.trackLabelFraction)
+        ], check=True, capture_output=True)
+    finally:
+        os.unlink(ini_path)
+
+
+def _store(src, dst):
+    # Copy then rename, so a concurrent reader never sees a partial image
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst))
+    os.close(fd)
+    shutil.copyfile(src, tmp)
+    os.replace(tmp, dst)
+
+
+def render_jobs(jobs, processes=4, cache_dir=None, preslice=True, padding=PADDING, index_dir=INDEX_DIR):
+    """
+    Render jobs concurrently, reusing cached images.
+
+    Jobs with the same cache key are drawn once. pyGenomeTracks runs as a subprocess, so jobs are
+    dispatched from a thread pool.
+
+    Args:
+        jobs (list): ``PlotJob`` instances.
+        processes (int): Maximum concurrent pyGenomeTracks processes.
+        cache_dir (str, optional): Image cache directory; no caching if None.
+        preslice (bool): Draw from slices of the BEDs around each region (see ``track_index``).
+        padding (int): Bases kept either side of the region when slicing.
+        index_dir (str): Directory of the indexed BED copies used for slicing.
+
+    Returns:
+        list: (output_file, cached) per job, in input order; ``cached`` is True if the image was not drawn.
+
+    Raises:
+        subprocess.CalledProcessError: If pyGenomeTracks fails for any job.
+    """
+    jobs = list(jobs)
+    inis = [job_ini(job) for job in jobs]
+    keys = [cache_key(job, ini) for job, ini in zip(jobs, inis)]
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    work_dir = cache_dir or "."
+
+    first = {}
+    for i, key in enumerate(keys):
+        first.setdefault(key, i)
+    cached = {key for key in first if cache_dir and os.path.exists(os.path.join(cache_dir, f"{key}.png"))}
+
+    def run(i):
+        job = jobs[i]
+        os.makedirs(os.path.dirname(os.path.abspath(job.output_file)), exist_ok=True)
+        if not preslice:
+            _render(job, inis[i], work_dir)
+        else:
+            slice_dir = tempfile.mkdtemp(dir=work_dir)
+            try:
+                tracks = preslice_tracks(job.tracks, normalise_region(job.region), slice_dir, padding, index_dir)
+                _render(job, job_ini(job, tracks), work_dir)
+            finally:
+                shutil.rmtree(slice_dir)
+        if cache_dir:
+            _store(job.output_file, os.path.join(cache_dir, f"{keys[i]}.png"))
+
+    with ThreadPoolExecutor(max_workers=max(processes, 1)) as pool:
+        list(pool.map(run, [i for key, i in first.items() if key not in cached]))
+
+    results = []
+    for i, job in enumerate(jobs):
+        drawn = first[keys[i]] == i and keys[i] not in cached
+        if not drawn:
+            src = os.path.join(cache_dir, f"{keys[i]}.png") if cache_dir else jobs[first[keys[i]]].output_file
+            if os.path.abspath(src) != os.path.abspath(job.output_file):
+                os.makedirs(os.path.dirname(os.path.abspath(job.output_file)), exist_ok=True)
+                shutil.copyfile(src, job.output_file)
+        results.append((str(job.output_file), not drawn))
+    return results
+
+
+def plot_regions(regions, output_dir=".", kind="cell_type", processes=4, cache_dir=None, gene_regions=None,
+                 dpi=130, width=38, trackLabelFraction=0.2, preslice=True, padding=PADDING, index_dir=INDEX_DIR,
+                 **tracks):
+    """
+    Plot the same tracks over many regions or genes.
+
+    Args:
+        regions (list): Region strings and/or gene IDs found in ``gene_regions``.
+        output_dir (str): Images are written as ``{output_dir}/{gene_id or contig_start-end}.png``.
+        kind (str): "cell_type" (tracks as ``plot_by_cell_type``) or "score" (as ``plot_by_score``).
+        processes (int): Maximum concurrent pyGenomeTracks processes.
+        cache_dir (str, optional): Image cache directory, shared between runs.
+        gene_regions (dict or str, optional): {gene_id: region}, or a table for ``load_gene_regions``.
+        dpi, width, trackLabelFraction: pyGenomeTracks options.
+        preslice, padding, index_dir: Region pre-slicing options, as in ``render_jobs``.
+        **tracks: Track definitions, e.g. ``bed_files``, ``colormaps``, ``titles``, ``gene_file``.
+
+    Returns:
+        dict: Mapping {region or gene ID: output image path}.
+    """
+    regions = list(regions)
+    if gene_regions is not None and not isinstance(gene_regions, dict):
+        gene_regions = load_gene_regions(gene_regions)
+    for name in ("bed_files", "colormaps", "titles"):
+        if tracks.get(name) is not None:
+            tracks[name] = list(tracks[name])
+    jobs = []
+    for item in regions:
+        label, region = resolve_region(item, gene_regions)
+        jobs.append(PlotJob(region, os.path.join(output_dir, f"{label}.png"), tracks, kind, dpi, width,
+                            trackLabelFraction))
+    results = render_jobs(jobs, processes=processes, cache_dir=cache_dir, preslice=preslice, padding=padding,
+                          index_dir=index_dir)
+    return {item: path for item, (path, _) in zip(regions, results)}
@@ -1,5 +1,9 @@
 import os
+import shutil
 import subprocess
+import tempfile
+
+from plotting.track_index import INDEX_DIR, PADDING, preslice_tracks
 
 #Creates a plot defined by score from a single BED file
 # Assumes no thickStart, thickEnd, and block columns
@@ -13,10 +17,39 @@ def plot_by_score(
     trackLabelFraction=0.2,
     dpi=130,
     width=38,
-    temp_ini="temp.ini"
+    temp_ini="temp.ini",
+    preslice=False, #draw from a BED slice around the region (see plotting.track_index)
+    padding=PADDING,
+    index_dir=INDEX_DIR
 ):
+    tracks = dict(bed_file=bed_file, height=height, title=title)
+    slice_dir = None
+    if preslice:
+        slice_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(temp_ini)))
+        tracks = preslice_tracks(tracks, region, slice_dir, padding, index_dir)
+
     with open(temp_ini, "w") as f:
-        f.write(f"""
+        f.write(score_tracks_ini(**tracks))
+
+    # Call pyGenomeTracks
+    subprocess.run([
+        "pyGenomeTracks",
+        "--tracks", temp_ini,
+        "--region", region,
+        "--outFileName", output_file,
+        "--dpi", str(dpi),
+        "--width", str(width),
+        "--trackLabelFraction", str(trackLabelFraction)
+    ])
+    if slice_dir:
+        shutil.rmtree(slice_dir)
+
+    print(f"✅ Plot saved to: {output_file}")
+
+
+#Track configuration (.ini text) for plot_by_score
+def score_tracks_ini(bed_file, height=2, title="test"):
+    return f"""
 [x-axis]
 where = top
 show_labels = false
@@ -34,17 +67,4 @@ fontsize = 10
 file = {bed_file}
 show_labels = true
 show_data_range = true
-""")
-
-    # Call pyGenomeTracks
-    subprocess.run([
-        "pyGenomeTracks",
-        "--tracks", temp_ini,
-        "--region", region,
-        "--outFileName", output_file,
-        "--dpi", str(dpi),
-        "--width", str(width),
-        "--trackLabelFraction", str(trackLabelFraction)
-    ])
-
-    print(f"✅ Plot saved to: {output_file}")
+"""
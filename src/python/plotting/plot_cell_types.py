@@ -1,5 +1,9 @@
 import os
+import shutil
 import subprocess
+import tempfile
+
+from plotting.track_index import INDEX_DIR, PADDING, preslice_tracks
 
 #Creates a plot defined by cell typed using multiple BED file
 # Assumes no thickStart, thickEnd, and block columns
@@ -17,18 +21,63 @@ def plot_by_cell_type(
     max_score=1000,
     min_score=0,
     temp_ini="temp.ini",
-    gene_file=None
+    gene_file=None,
+    preslice=False, #draw from BED slices around the region (see plotting.track_index)
+    padding=PADDING,
+    index_dir=INDEX_DIR
 ):
+    tracks = dict(
+        bed_files=list(bed_files),
+        colormaps=colormaps,
+        titles=titles,
+        height=height,
+        max_score=max_score,
+        min_score=min_score,
+        gene_file=gene_file
+    )
+    slice_dir = None
+    if preslice:
+        slice_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(temp_ini)))
+        tracks = preslice_tracks(tracks, region, slice_dir, padding, index_dir)
+
+    with open(temp_ini, "w") as f:
+        f.write(cell_type_tracks_ini(**tracks))
+
+    # Call pyGenomeTracks
+    subprocess.run([
+        "pyGenomeTracks",
+        "--tracks", temp_ini,
+        "--region", region,
+        "--outFileName", output_file,
+        "--dpi", str(dpi),
+        "--width", str(width),
+        "--trackLabelFraction", str(trackLabelFraction)
+    ])
+    if slice_dir:
+        shutil.rmtree(slice_dir)
 
+    print(f"✅ Plot saved to: {output_file}")
+
+
+#Track configuration (.ini text) for plot_by_cell_type
+def cell_type_tracks_ini(
+    bed_files,
+    colormaps=["Reds", "Blues", "Greens", "coolwarm"],
+    titles=None,
+    height=2,
+    max_score=1000,
+    min_score=0,
+    gene_file=None
+):
+    bed_files = list(bed_files)
     if titles is None:
         titles = [os.path.basename(f).split(".")[0] for f in bed_files]
 
-    with open(temp_ini, "w") as f:
-        f.write("[x-axis]\nwhere = top\nshow_labels = false\n\n")
-        f.write("[spacer]\nheight = 0.1\n\n")
+    ini = "[x-axis]\nwhere = top\nshow_labels = false\n\n"
+    ini += "[spacer]\nheight = 0.1\n\n"
 
-        if gene_file:
-            f.write(f"""
+    if gene_file:
+        ini += f"""
 [{os.path.basename(gene_file).split(".")[0]}]
 file = {gene_file}
 file_type = bed
@@ -41,10 +90,10 @@ border_color = black
 [spacer]
 height = 0.1
 
-""")
+"""
 
-        for i, bed in enumerate(bed_files):
-            f.write(f"""
+    for i, bed in enumerate(bed_files):
+        ini += f"""
 [{titles[i]}]
 file = {bed}
 file_type = bed
@@ -64,17 +113,5 @@ gene_rows = 3
 [spacer]
 height = 0.1
 
-""")
-
-    # Call pyGenomeTracks
-    subprocess.run([
-        "pyGenomeTracks",
-        "--tracks", temp_ini,
-        "--region", region,
-        "--outFileName", output_file,
-        "--dpi", str(dpi),
-        "--width", str(width),
-        "--trackLabelFraction", str(trackLabelFraction)
-    ])
-
-    print(f"✅ Plot saved to: {output_file}")
+"""
+    return ini
@@ -0,0 +1,121 @@
+import os
+import shutil
+import subprocess
+import tempfile
+
+from bam_manipulation.celltype_coverage import CoverageTracks
+from plotting.track_index import PADDING, parse_region
+
+#Plots per-cell-type coverage written by bam_manipulation.celltype_coverage
+# Only the bins around the region are read (memory-mapped) and handed to pyGenomeTracks as small bedGraphs
+def plot_coverage(
+    coverage_dir,
+    region,
+    output_file="coverage_plot.png",
+    celltypes=None, #default: every cell type, in manifest order
+    colors=["#d62728", "#1f77b4", "#2ca02c", "#9467bd", "#ff7f0e", "#8c564b"],
+    titles=None,
+    trackLabelFraction=0.2,
+    dpi=130,
+    width=38,
+    height=2,
+    max_value=None, #default: shared maximum of the plotted slices, so tracks are comparable
+    temp_ini="temp.ini",
+    gene_file=None,
+    padding=PADDING
+):
+    tracks = CoverageTracks(coverage_dir)
+    celltypes = list(celltypes or tracks.celltypes)
+    slice_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(temp_ini)))
+    bedgraph_files, peak = slice_coverage(tracks, region, celltypes, slice_dir, padding)
+
+    with open(temp_ini, "w") as f:
+        f.write(coverage_tracks_ini(
+            bedgraph_files,
+            colors=colors,
+            titles=titles or celltypes,
+            height=height,
+            max_value=max_value if max_value is not None else max(peak, 1),
+            gene_file=gene_file
+        ))
+
+    # Call pyGenomeTracks
+    subprocess.run([
+        "pyGenomeTracks",
+        "--tracks", temp_ini,
+        "--region", region,
+        "--outFileName", output_file,
+        "--dpi", str(dpi),
+        "--width", str(width),
+        "--trackLabelFraction", str(trackLabelFraction)
+    ])
+    shutil.rmtree(slice_dir)
+
+    print(f"✅ Plot saved to: {output_file}")
+
+
+#Writes one bedGraph per cell type covering region +/- padding
+# Returns the file paths and the highest depth in them
+def slice_coverage(tracks, region, celltypes, work_dir, padding=PADDING):
+    if not isinstance(tracks, CoverageTracks):
+        tracks = CoverageTracks(tracks)
+    contig, start, end = parse_region(region)
+    files, peak = [], 0.0
+    for i, celltype in enumerate(celltypes):
+        path = os.path.join(work_dir, f"{i}.bedgraph")
+        tracks.write_bedgraph(celltype, contig, start - 1 - padding, end + padding, path)
+        _, values = tracks.slice(celltype, contig, start - 1, end)
+        peak = max([peak, *values.tolist()])
+        files.append(path)
+    return files, peak
+
+
+#Track configuration (.ini text) for plot_coverage
+def coverage_tracks_ini(
+    bedgraph_files,
+    colors=["#d62728", "#1f77b4", "#2ca02c", "#9467bd", "#ff7f0e", "#8c564b"],
+    titles=None,
+    height=2,
+    max_value=None,
+    gene_file=None
+):
+    bedgraph_files = list(bedgraph_files)
+    if titles is None:
+        titles = [os.path.basename(f).split(".")[0] for f in bedgraph_files]
+
+    ini = "[x-axis]\nwhere = top\nshow_labels = false\n\n"
+    ini += "[spacer]\nheight = 0.1\n\n"
+
+    if gene_file:
+        ini += f"""
+[{os.path.basename(gene_file).split(".")[0]}]
+file = {gene_file}
+file_type = bed
+height = {height / 2}
+title = gene:{os.path.basename(gene_file).split(".")[0]}
+style = UCSC
+color = green
+border_color = black
+
+[spacer]
+height = 0.1
+
+"""
+
+    for i, bedgraph in enumerate(bedgraph_files):
+        ini += f"""
+[{titles[i]}]
+file = {bedgraph}
+file_type = bedgraph
+height = {height}
+title = {titles[i]}
+color = {colors[i % len(colors)]}
+min_value = 0
+{f"max_value = {max_value}" if max_value is not None else ""}
+show_data_range = true
+
+[spacer]
+height = 0.1
+
+"""
+    return ini
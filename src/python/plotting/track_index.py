@@ -0,0 +1,157 @@
+# pylint: disable=no-member
+"""
+Module: track_index
+
+Region pre-slicing for pyGenomeTracks.
+
+pyGenomeTracks parses every BED it is given in full before drawing, so the
+cost of a 20 kb figure grows with the genome-wide size of its tracks. Here each
+BED is instead sorted once into a bgzipped, tabix-indexed copy, stored in an
+index directory under the hash of the file's contents, so it is reused by later
+plots and later runs until the file changes. Before a plot is drawn, only the
+records overlapping the (padded) region are fetched into small temporary BEDs,
+and pyGenomeTracks is pointed at those. Files that are already bgzipped and
+tabix-indexed (such as ``all_celltypes.junctions.bed.gz``) are queried in place.
+
+Track colours do not depend on the records kept, as ``plot_by_cell_type`` pins
+``min_value``/``max_value``.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+import pysam
+
+INDEX_DIR = ".track_index"
+PADDING = 10_000
+FILE_PARAMS = ("bed_files", "bed_file", "gene_file")
+
+_digests = {}
+_build_lock = threading.Lock()
+
+
+def file_digest(path):
+    """SHA-256 of a file's contents, memoised on (path, size, mtime)."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _digests:
+        h = hashlib.sha256()
+        with open(path, "rb") as fh:
+            for chunk in iter(lambda: fh.read(1 << 20), b""):
+                h.update(chunk)
+        _digests[key] = h.hexdigest()
+    return _digests[key]
+
+
+def _is_indexed(path):
+    path = str(path)
+    return path.endswith(".gz") and (os.path.exists(f"{path}.tbi") or os.path.exists(f"{path}.csi"))
+
+
+def _bed_records(path):
+    with open(path) as fh:
+        for line in fh:
+            if line.strip() and not line.startswith(("#", "track", "browser")):
+                fields = line.rstrip("\n").split("\t")
+                yield fields[0], int(fields[1]), int(fields[2]), line if line.endswith("\n") else line + "\n"
+
+
+def track_index(bed_path, index_dir=INDEX_DIR):
+    """
+    Return a bgzipped, tabix-indexed copy of a BED, building it if needed.
+
+    Args:
+        bed_path (str): BED file, in any order; header, ``track`` and ``browser`` lines are dropped.
+        index_dir (str): Directory holding indexed copies, named by content hash.
+
+    Returns:
+        str: Path of the indexed ``.bed.gz`` (``bed_path`` itself if it is already indexed).
+    """
+    if _is_indexed(bed_path):
+        return str(bed_path)
+    indexed = os.path.join(index_dir, f"{file_digest(bed_path)}.bed.gz")
+    with _build_lock:
+        if os.path.exists(f"{indexed}.tbi"):
+            return indexed
+        os.makedirs(index_dir, exist_ok=True)
+        records = sorted(_bed_records(bed_path), key=lambda r: (r[0], r[1], r[2]))
+        tmp_dir = tempfile.mkdtemp(dir=index_dir)
+        try:
+            tmp = os.path.join(tmp_dir, "track.bed.gz")
+            with pysam.BGZFile(tmp, "wb") as out:
+                for record in records:
+                    out.write(record[3].encode())
+            pysam.tabix_index(tmp, preset="bed", force=True)
+            # The index is published last, so its presence means the copy is complete
+            os.replace(tmp, indexed)
+            os.replace(f"{tmp}.tbi", f"{indexed}.tbi")
+        finally:
+            shutil.rmtree(tmp_dir)
+    return indexed
+
+
+def parse_region(region):
+    """Split a ``contig:start-end`` region (1-based, inclusive) into (contig, start, end)."""
+    contig, interval = str(region).rsplit(":", 1)
+    start, end = interval.replace(",", "").split("-")
+    return contig, int(start), int(end)
+
+
+def slice_track(bed_path, region, output_path, padding=PADDING, index_dir=INDEX_DIR):
+    """
+    Write the records of a BED overlapping ``region`` +/- ``padding`` to ``output_path``.
+
+    Returns:
+        int: Number of records written.
+    """
+    contig, start, end = parse_region(region)
+    n = 0
+    with pysam.TabixFile(track_index(bed_path, index_dir)) as tbx, open(output_path, "w") as out:
+        if contig in tbx.contigs:
+            for line in tbx.fetch(contig, max(start - 1 - padding, 0), end + padding):
+                out.write(line + "\n")
+                n += 1
+    return n
+
+
+def preslice_tracks(tracks, region, work_dir, padding=PADDING, index_dir=INDEX_DIR):
+    """
+    Replace the BED files in track definitions with slices around ``region``.
+
+    Slices keep their file's base name, so titles taken from file names are unchanged.
+
+    Args:
+        tracks (dict): Keyword arguments of ``cell_type_tracks_ini`` or ``score_tracks_ini``.
+        region (str): Region as ``contig:start-end``.
+        work_dir (str): Directory for the slices; the caller removes it.
+
+    Returns:
+        dict: ``tracks`` with ``bed_files``, ``bed_file`` and ``gene_file`` pointing at the slices.
+    """
+    sliced = dict(tracks)
+    n = 0
+
+    def _slice(path):
+        nonlocal n
+        name = os.path.basename(str(path))
+        if name.endswith(".gz"):
+            name = name[:-3]
+        out_dir = os.path.join(work_dir, str(n))
+        os.makedirs(out_dir)
+        n += 1
+        output_path = os.path.join(out_dir, name)
+        slice_track(path, region, output_path, padding=padding, index_dir=index_dir)
+        return output_path
+
+    for name in FILE_PARAMS:
+        value = tracks.get(name)
+        if value is None:
+            continue
+        if isinstance(value, (str, os.PathLike)):
+            sliced[name] = _slice(value)
+        else:
+            sliced[name] = [_slice(path) for path in value]
+    return sliced
@@ -0,0 +1,9 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def mapping_cache(tmp_path, monkeypatch):
+    # Mappings compiled by any test go to a per-test directory, not the user cache
+    path = tmp_path / "mapping_cache"
+    monkeypatch.setenv("BAM_MAPPING_CACHE", str(path))
+    return path
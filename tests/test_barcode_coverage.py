@@ -0,0 +1,70 @@
+# pylint: disable=redefined-outer-name
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+from bam_manipulation.barcode_coverage import barcode_coverage, estimate_barcode_coverage, write_coverage_results
+
+
+@pytest.fixture
+def small_bam():
+    return Path(__file__).parent / "test_data" / "possorted_genome_bam.sample.CB.bam"
+
+
+@pytest.fixture
+def muscle_mapping():
+    labeled = pd.read_csv(Path(__file__).parent / "test_data" / "cell_barcodes_labeled.tsv", sep="\t")
+    return {"sample1": dict(zip(labeled["cell_barcode"], labeled["Cluster"])),
+            "sample2": {bc: ct for bc, ct in zip(labeled["cell_barcode"], labeled["Cluster"]) if ct == "Muscle"}}
+
+
+def test_barcode_coverage_sharded_matches_serial(small_bam, muscle_mapping):
+    samples = {"Mira_1": small_bam, "Mira_2": small_bam}
+    sample_map = {"Mira_1": "sample1", "Mira_2": "sample2"}
+    serial = barcode_coverage(samples, muscle_mapping, sample_map=sample_map)
+    sharded = barcode_coverage(samples, muscle_mapping, sample_map=sample_map, processes=2, shard_size=5_000_000)
+    assert serial == sharded
+    assert [(r.total_reads, r.matched_reads, r.untagged_reads) for r in serial] == [(139, 139, 0), (139, 47, 0)]
+    assert sum(serial[1].barcode_counts.values()) == 47
+
+    output_file = Path() / "test_coverage.csv"
+    counts_file = Path() / "test_coverage_barcodes.csv"
+    write_coverage_results(serial, output_file, counts_file)
+    summary = pd.read_csv(output_file)
+    assert list(summary.columns) == ["Sample", "Total Reads", "Matched Barcodes", "Coverage (%)"]
+    assert summary["Coverage (%)"].tolist() == [100.0, 33.81]
+    assert len(pd.read_csv(counts_file)) == 139 + 47
+    output_file.unlink()
+    counts_file.unlink()
+
+
+def test_estimate_barcode_coverage(small_bam, muscle_mapping):
+    samples = {"Mira_1": small_bam, "Mira_2": small_bam}
+    sample_map = {"Mira_1": "sample1", "Mira_2": "sample2"}
+    full = barcode_coverage(samples, muscle_mapping, sample_map=sample_map)
+
+    # Sampling every window and every unplaced read gives the full scan, with exact bounds
+    exact = estimate_barcode_coverage(samples, muscle_mapping, sample_map=sample_map, fraction=1, window_size=5_000_000)
+    for estimate, result in zip(exact, full):
+        assert (estimate.total_reads, estimate.matched_reads, estimate.untagged_reads) == \
+               (result.total_reads, result.matched_reads, result.untagged_reads)
+        assert estimate.matched_ci == (result.matched_reads,) * 2
+        assert estimate.unmapped_ci == (result.unmapped_reads,) * 2
+        assert estimate.sampled_fraction == 1
+        assert list(estimate.to_row().items())[:4] == list(result.to_row().items())
+
+    sampled = estimate_barcode_coverage(samples, muscle_mapping, sample_map=sample_map, fraction=0.3,
+                                        window_size=2_000_000, min_windows=2, min_unplaced=20, seed=1)
+    assert sampled == estimate_barcode_coverage(samples, muscle_mapping, sample_map=sample_map, fraction=0.3,
+                                                window_size=2_000_000, min_windows=2, min_unplaced=20, seed=1,
+                                                processes=2)
+    for estimate in sampled:
+        assert estimate.total_reads == 139
+        assert 0 < estimate.sampled_reads < 139
+        for name in ("matched", "untagged", "unmapped"):
+            low, high = getattr(estimate, f"{name}_ci")
+            assert 0 <= low <= getattr(estimate, f"{name}_reads") <= high <= 139
+    assert list(sampled[1].to_row())[4:] == ["Coverage CI Low (%)", "Coverage CI High (%)", "Sampled (%)"]
+    with pytest.raises(ValueError):
+        estimate_barcode_coverage(samples, muscle_mapping, sample_map=sample_map, fraction=0)
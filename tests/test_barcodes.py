@@ -0,0 +1,30 @@
+import numpy as np
+
+from bam_manipulation.barcodes import BarcodeIndex, INVALID, decode_barcode, encode_barcode, encode_barcodes
+
+
+def test_encode_decode_roundtrip():
+    barcodes = ["AAACCCAAGATACGAT-1", "TTTTTTTTTTTTTTTT-12", "ACGT", "A" * 24 + "-2046"]
+    codes = encode_barcodes(barcodes)
+    assert codes.dtype == np.uint64
+    assert len(set(codes.tolist())) == len(barcodes)
+    assert [decode_barcode(c) for c in codes] == barcodes
+    assert encode_barcode("AAAC-1") != encode_barcode("AAAC")
+
+
+def test_unencodable_barcodes_are_invalid():
+    codes = encode_barcodes(["ACGN-1", "", None, "A" * 25, "ACGT-", "ACGT-1x", "ACGT-2047"])
+    assert (codes == INVALID).all()
+
+
+def test_barcode_index_lookup():
+    index, labels = BarcodeIndex.from_mapping({
+        "AAACCCAAGATACGAT-1": "Stem A",
+        "AAACGAACAGCCCACA-1": "Muscle",
+        "not-a-barcode": "Muscle",
+    })
+    assert labels == ["Stem A", "Muscle"]
+    assert len(index) == 3
+    values = index.lookup(["AAACGAACAGCCCACA-1", None, "AAACCCAAGATACGAT-2", "not-a-barcode", "AAACCCAAGATACGAT-1"])
+    assert values.tolist() == [1, -1, -1, 1, 0]
+    assert sorted(index.keys()) == sorted(["AAACCCAAGATACGAT-1", "AAACGAACAGCCCACA-1", "not-a-barcode"])
@@ -0,0 +1,48 @@
+import shutil
+from pathlib import Path
+
+import pysam
+
+from benchmarks.run import compare, run_suite
+from benchmarks.synthetic import SyntheticConfig, generate
+
+CONFIG = SyntheticConfig(n_reads=2000, n_contigs=2, contig_length=200_000, n_barcodes=50, n_celltypes=3,
+                         samples=["s1", "s2"], genes_per_contig=10, seed=7)
+
+
+def test_generate_is_deterministic():
+    first = generate(CONFIG, str(Path() / "test_synthetic_a"))
+    second = generate(CONFIG, str(Path() / "test_synthetic_b"))
+    for key in ("bams", "clusters", "mappings"):
+        for sample in CONFIG.samples:
+            assert Path(first[key][sample]).read_bytes() == Path(second[key][sample]).read_bytes()
+    assert Path(first["bams"]["s1"]).read_bytes() != Path(first["bams"]["s2"]).read_bytes()
+
+    with pysam.AlignmentFile(first["bams"]["s1"], "rb") as bam:
+        reads = list(bam.fetch())
+        assert bam.has_index()
+    assert len(reads) == CONFIG.n_reads
+    assert [(r.reference_id, r.reference_start) for r in reads] == sorted((r.reference_id, r.reference_start) for r in reads)
+    spliced = sum("N" in r.cigarstring for r in reads) / len(reads)
+    tagged = sum(r.has_tag("CB") for r in reads) / len(reads)
+    assert abs(spliced - CONFIG.splice_rate) < 0.05 and abs(tagged - CONFIG.tag_density) < 0.05
+    assert all(r.has_tag("XS") == ("N" in r.cigarstring) for r in reads)
+    shutil.rmtree(Path() / "test_synthetic_a")
+    shutil.rmtree(Path() / "test_synthetic_b")
+
+
+def test_suite_results_compare_with_baseline():
+    data_dir = Path() / "test_benchmark_data"
+    results = run_suite(scales=["tiny"], benchmarks=["barcode_coverage", "add_isoform_tags"], data_dir=str(data_dir),
+                        configs={"tiny": CONFIG})
+    assert [r["benchmark"] for r in results["results"]] == ["barcode_coverage", "add_isoform_tags"]
+    for record in results["results"]:
+        assert record["reads_per_s"] > 0 and record["peak_rss_mb"] > 0 and record["output_bytes"] > 0
+    assert results["results"][0]["reads"] == 2 * CONFIG.n_reads
+
+    baseline = {"results": [dict(r, reads_per_s=r["reads_per_s"] * 2) if r["benchmark"] == "add_isoform_tags" else r
+                            for r in results["results"]]}
+    comparison = compare(results, baseline)
+    assert comparison.set_index("benchmark")["regression"].to_dict() == {"barcode_coverage": False,
+                                                                         "add_isoform_tags": True}
+    shutil.rmtree(data_dir)
@@ -0,0 +1,108 @@
+# pylint: disable=redefined-outer-name
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pysam
+import pytest
+
+from bam_manipulation.celltype_coverage import CoverageTracks, binned_depth, celltype_coverage
+from bam_manipulation.junctions import EXCLUDE_FLAGS
+from plotting.plot_coverage import coverage_tracks_ini, slice_coverage
+
+BIN_SIZE = 1000
+
+
+@pytest.fixture
+def small_bam():
+    return Path(__file__).parent / "test_data" / "possorted_genome_bam.sample.CB.bam"
+
+
+@pytest.fixture
+def mapping_csv():
+    labeled = pd.read_csv(Path(__file__).parent / "test_data" / "cell_barcodes_labeled.tsv", sep="\t")
+    path = Path() / "test_coverage_barcodes.csv"
+    labeled.assign(sample="sample1")[["sample", "cell_barcode", "Cluster"]].to_csv(path, index=False)
+    yield path
+    path.unlink()
+
+
+@pytest.fixture
+def output_dirs():
+    dirs = [Path() / "test_coverage_serial", Path() / "test_coverage_parallel"]
+    yield dirs
+    for path in dirs:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _expected_depth(bam_path, tag_to_celltype, bin_size):
+    # Bases of each aligned block added bin by bin
+    sums = {}
+    with pysam.AlignmentFile(str(bam_path), "rb") as bam:
+        lengths = dict(zip(bam.references, bam.lengths))
+        for read in bam:
+            if read.flag & EXCLUDE_FLAGS or not read.has_tag("CB") or read.get_tag("CB") not in tag_to_celltype:
+                continue
+            depth = sums.setdefault((tag_to_celltype[read.get_tag("CB")], read.reference_name),
+                                    np.zeros(-(-lengths[read.reference_name] // bin_size)))
+            for start, end in read.get_blocks():
+                for b in range(start // bin_size, (end - 1) // bin_size + 1):
+                    depth[b] += min(end, (b + 1) * bin_size) - max(start, b * bin_size)
+    for (_, contig), depth in sums.items():
+        depth /= bin_size
+        depth[-1] *= bin_size / (lengths[contig] - (len(depth) - 1) * bin_size)
+    return sums
+
+
+def test_binned_depth_splits_intervals_at_bin_edges():
+    assert binned_depth([(0, 10), (5, 7)], 10).tolist() == [1, 1, 1, 1, 1, 2, 2, 1, 1, 1]
+    assert binned_depth([(3, 25), (10, 20)], 27, bin_size=10).tolist() == pytest.approx([0.7, 2.0, 5 / 7])
+    assert binned_depth([], 5, bin_size=10).tolist() == [0]
+
+
+def test_celltype_coverage_matches_per_read_depth(small_bam, mapping_csv, output_dirs):
+    serial_dir, parallel_dir = output_dirs
+    tracks = celltype_coverage({"Mira_1": small_bam}, str(mapping_csv), str(serial_dir),
+                               sample_map={"Mira_1": "sample1"}, bin_size=BIN_SIZE)
+    tag_to_celltype = dict(pd.read_csv(mapping_csv)[["cell_barcode", "Cluster"]].values)
+    expected = _expected_depth(small_bam, tag_to_celltype, BIN_SIZE)
+
+    assert tracks.celltypes == ["Muscle", "Stem A", "Stem B"]
+    assert sum(tracks.reads.values()) > 0
+    for celltype in tracks.celltypes:
+        for contig in tracks.contigs:
+            depth = expected.get((celltype, contig))
+            if depth is None:
+                assert not tracks.depth(celltype, contig).any()
+            else:
+                assert tracks.depth(celltype, contig) == pytest.approx(depth, abs=1e-5)
+
+        # The genome-wide bedGraph holds the same bins, runs merged and zeros dropped
+        rebuilt = {contig: np.zeros(-(-length // BIN_SIZE)) for contig, length in tracks.contigs.items()}
+        with open(tracks.bedgraph(celltype)) as fh:
+            for line in fh:
+                contig, start, end, value = line.split("\t")
+                rebuilt[contig][int(start) // BIN_SIZE:-(-int(end) // BIN_SIZE)] = float(value)
+        for contig, depth in rebuilt.items():
+            assert depth == pytest.approx(tracks.depth(celltype, contig), rel=1e-5)
+    assert (serial_dir / "Stem_A.bedgraph").exists()
+
+    # Contigs in parallel workers give the same tracks
+    parallel = celltype_coverage({"Mira_1": small_bam}, str(mapping_csv), str(parallel_dir),
+                                 sample_map={"Mira_1": "sample1"}, bin_size=BIN_SIZE, processes=2)
+    assert parallel.reads == tracks.reads
+    for celltype in tracks.celltypes:
+        assert Path(parallel.bedgraph(celltype)).read_text() == Path(tracks.bedgraph(celltype)).read_text()
+
+    # The plotting package slices the arrays around a region
+    (celltype, contig), depth = next(iter(expected.items()))
+    b = int(np.flatnonzero(depth)[0])
+    region = f"{contig}:{b * BIN_SIZE + 1}-{(b + 1) * BIN_SIZE}"
+    positions, values = CoverageTracks(serial_dir).slice(celltype, contig, b * BIN_SIZE, (b + 1) * BIN_SIZE)
+    assert positions.tolist() == [b * BIN_SIZE] and values[0] == pytest.approx(depth[b])
+    files, peak = slice_coverage(str(serial_dir), region, [celltype], str(serial_dir), padding=0)
+    assert Path(files[0]).read_text().split("\t")[:3] == [contig, str(b * BIN_SIZE), str((b + 1) * BIN_SIZE)]
+    assert peak == pytest.approx(depth[b])
+    ini = coverage_tracks_ini(files, titles=[celltype], max_value=peak)
+    assert "file_type = bedgraph" in ini and f"[{celltype}]" in ini
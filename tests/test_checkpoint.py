@@ -0,0 +1,149 @@
+# pylint: disable=redefined-outer-name
+import json
+import shutil
+from pathlib import Path
+
+import pandas as pd
+import pysam
+import pytest
+
+from bam_manipulation import barcode_coverage as coverage_module
+from bam_manipulation import rs_bam_handling, wp3_add_custom_tags
+from bam_manipulation.barcode_coverage import barcode_coverage
+from bam_manipulation.checkpoint import ShardCheckpoint
+from bam_manipulation.rs_bam_handling import bamTagHandling
+from bam_manipulation.sharding import region_shards
+from bam_manipulation.wp3_add_custom_tags import add_isoform_tags
+
+
+@pytest.fixture
+def small_bam():
+    return Path(__file__).parent / "test_data" / "possorted_genome_bam.sample.CB.bam"
+
+
+@pytest.fixture
+def mapping_tsv():
+    return Path(__file__).parent / "test_data" / "cell_barcodes_labeled.tsv"
+
+
+class TimeLimit(Exception):
+    pass
+
+
+def _interrupted_after(func, n):
+    """Wrap a shard function so that it fails once n shards have completed, like a job hitting its time limit."""
+    calls = []
+
+    def wrapper(task):
+        if len(calls) == n:
+            raise TimeLimit()
+        calls.append(task)
+        return func(task)
+    return wrapper, calls
+
+
+def _counting(func):
+    calls = []
+
+    def wrapper(task):
+        calls.append(task)
+        return func(task)
+    return wrapper, calls
+
+
+def _bam_contents(path):
+    with pysam.AlignmentFile(str(path), "rb") as bam:
+        return [read.to_string() for read in bam]
+
+
+def _ic_tags(path):
+    with pysam.AlignmentFile(str(path), "rb") as bam:
+        return sorted((read.query_name, read.reference_start, read.get_tag("IC") if read.has_tag("IC") else None)
+                      for read in bam)
+
+
+def test_checkpoint_discarded_when_inputs_change():
+    path = Path() / "test.checkpoint.json"
+    checkpoint = ShardCheckpoint(path, {"input": "a"})
+    checkpoint.record("00000_chr1", [1, 2])
+    assert ShardCheckpoint(path, {"input": "a"}).get("00000_chr1") == [1, 2]
+    changed = ShardCheckpoint(path, {"input": "b"})
+    assert not changed.resumed and len(changed) == 0
+    checkpoint.remove()
+    assert not path.exists()
+
+
+def test_split_resumes_after_interruption(small_bam, mapping_tsv, monkeypatch):
+    reference_dir = Path() / "reference_files"
+    resumed_dir = Path() / "resumed_files"
+    for directory in (reference_dir, resumed_dir):
+        shutil.rmtree(directory, ignore_errors=True)
+    bamTagHandling(str(small_bam), output="reference", mapping=str(mapping_tsv), delim="\t", untagged=True,
+                   unmapped=True)
+
+    original = getattr(rs_bam_handling, "_split_shard")
+    failing, done = _interrupted_after(original, 3)
+    monkeypatch.setattr(rs_bam_handling, "_split_shard", failing)
+    with pytest.raises(TimeLimit):
+        bamTagHandling(str(small_bam), output="resumed", mapping=str(mapping_tsv), delim="\t", untagged=True,
+                       unmapped=True, checkpoint=True)
+    checkpoint_path = resumed_dir / ".checkpoint.json"
+    assert len(json.loads(checkpoint_path.read_text())["completed"]) == len(done) == 3
+
+    counting, redone = _counting(original)
+    monkeypatch.setattr(rs_bam_handling, "_split_shard", counting)
+    bamTagHandling(str(small_bam), output="resumed", mapping=str(mapping_tsv), delim="\t", untagged=True,
+                   unmapped=True, checkpoint=True)
+    # Checkpointing without a shardSize splits contigs at CHECKPOINT_SHARD_SIZE
+    assert len(redone) == len(region_shards(str(small_bam), rs_bam_handling.CHECKPOINT_SHARD_SIZE)) - 3
+    assert not checkpoint_path.exists()
+    assert sorted(p.name for p in resumed_dir.iterdir()) == sorted(
+        p.name.replace("reference", "resumed") for p in reference_dir.iterdir())
+    for p in reference_dir.iterdir():
+        assert _bam_contents(resumed_dir / p.name.replace("reference", "resumed")) == _bam_contents(p)
+    for directory in (reference_dir, resumed_dir):
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def test_barcode_coverage_resumes_after_interruption(small_bam, mapping_tsv, monkeypatch):
+    labeled = pd.read_csv(mapping_tsv, sep="\t")
+    mapping = {"Mira_1": dict(zip(labeled["cell_barcode"], labeled["Cluster"]))}
+    samples = {"Mira_1": small_bam}
+    checkpoint_path = Path() / "test_coverage.checkpoint.json"
+    reference = barcode_coverage(samples, mapping)
+
+    original = getattr(coverage_module, "_count_shard")
+    failing, _ = _interrupted_after(original, 4)
+    monkeypatch.setattr(coverage_module, "_count_shard", failing)
+    with pytest.raises(TimeLimit):
+        barcode_coverage(samples, mapping, checkpoint=str(checkpoint_path))
+    counting, redone = _counting(original)
+    monkeypatch.setattr(coverage_module, "_count_shard", counting)
+    resumed = barcode_coverage(samples, mapping, checkpoint=str(checkpoint_path))
+    assert resumed == reference
+    assert len(redone) == len(region_shards(str(small_bam))) - 4
+    assert not checkpoint_path.exists()
+
+
+def test_add_isoform_tags_resumes_after_interruption(small_bam, monkeypatch):
+    with pysam.AlignmentFile(str(small_bam), "rb") as bam:
+        cluster_map = {read.query_name: i % 3 + 1 for i, read in enumerate(bam.fetch(until_eof=True))}
+    reference_bam = Path() / "test_ic_reference.bam"
+    resumed_bam = Path() / "test_ic_resumed.bam"
+    add_isoform_tags(str(small_bam), str(reference_bam), cluster_map)
+
+    original = getattr(wp3_add_custom_tags, "_tag_shard")
+    failing, _ = _interrupted_after(original, 2)
+    monkeypatch.setattr(wp3_add_custom_tags, "_tag_shard", failing)
+    with pytest.raises(SystemExit):
+        add_isoform_tags(str(small_bam), str(resumed_bam), cluster_map, checkpoint=True)
+    assert Path(f"{resumed_bam}.ic_shards").is_dir()
+    counting, redone = _counting(original)
+    monkeypatch.setattr(wp3_add_custom_tags, "_tag_shard", counting)
+    add_isoform_tags(str(small_bam), str(resumed_bam), cluster_map, checkpoint=True)
+    assert len(redone) == len(region_shards(str(small_bam))) - 2
+    assert _ic_tags(resumed_bam) == _ic_tags(reference_bam)
+    assert not Path(f"{resumed_bam}.ic_shards").exists() and not Path(f"{resumed_bam}.checkpoint.json").exists()
+    for path in (reference_bam, resumed_bam):
+        path.unlink()
+        Path(f"{path}.bai").unlink()
@@ -0,0 +1,95 @@
+# pylint: disable=redefined-outer-name
+import json
+import pstats
+import shutil
+from pathlib import Path
+
+import pysam
+import pytest
+
+from bam_manipulation.instrumentation import Instrumentation, from_env
+from bam_manipulation.rs_bam_handling import bamTagHandling
+from bam_manipulation.wp3_add_custom_tags import add_isoform_tags
+
+
+@pytest.fixture
+def small_bam():
+    return Path(__file__).parent / "test_data" / "possorted_genome_bam.sample.CB.bam"
+
+
+@pytest.fixture
+def metrics_dir():
+    path = Path() / "test_metrics"
+    shutil.rmtree(path, ignore_errors=True)
+    yield path
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def _events(path):
+    with open(path) as fh:
+        return [json.loads(line) for line in fh]
+
+
+def test_events_summary_and_profiles(metrics_dir):
+    metrics_dir.mkdir()
+    with Instrumentation("tool", events_path=str(metrics_dir / "tool.events.jsonl"),
+                         summary_path=str(metrics_dir / "tool.summary.json"), interval=0, profile="cprofile",
+                         profile_path=str(metrics_dir / "tool.pstats")) as instrument:
+        with instrument.stage("count"), instrument.profiled():
+            for _ in range(3):
+                instrument.progress(reads=100, bytes_written=10)
+    summary = json.loads((metrics_dir / "tool.summary.json").read_text())
+    assert summary["reads"] == 300 and summary["bytes_written"] == 30
+    assert [s["stage"] for s in summary["stages"]] == ["count"] and summary["stages"][0]["reads"] == 300
+    events = _events(metrics_dir / "tool.events.jsonl")
+    assert [e["event"] for e in events] == ["start", "stage_start"] + ["progress"] * 3 + ["profile", "stage_end", "end"]
+    assert events[-2]["reads"] == 300
+    assert pstats.Stats(str(metrics_dir / "tool.pstats")).total_calls > 0
+
+    sampled = Instrumentation("tool", profile="sample", profile_path=str(metrics_dir / "tool.folded"),
+                              sample_interval=0.001)
+    with sampled.profiled():
+        sum(i * i for i in range(2_000_000))
+    lines = (metrics_dir / "tool.folded").read_text().splitlines()
+    assert lines and all(int(line.rsplit(" ", 1)[1]) > 0 for line in lines)
+
+
+def test_bytes_written_counts_only_files_of_this_run(metrics_dir):
+    output_dir = metrics_dir / "out"
+    output_dir.mkdir(parents=True)
+    (output_dir / "old.bam").write_bytes(b"x" * 100)
+    (output_dir / "rewritten.bam").write_bytes(b"x" * 10)
+    with Instrumentation("tool") as instrument:
+        instrument.add_output(output_dir)
+        (output_dir / "new.bam").write_bytes(b"x" * 7)
+        (output_dir / "rewritten.bam").write_bytes(b"x" * 5)
+    assert instrument.summary()["bytes_written"] == 12
+
+
+def test_tools_instrumented_from_environment(small_bam, metrics_dir, monkeypatch):
+    monkeypatch.setenv("BAM_METRICS_DIR", str(metrics_dir))
+    with pysam.AlignmentFile(str(small_bam), "rb") as bam:
+        total_reads = sum(1 for _ in bam.fetch(until_eof=True))
+
+    mapping = {"Muscle": ["AAACCCAAGAAACACT-1"], "Stem": ["AAACCCAAGAAACCAT-1"]}
+    bamTagHandling(str(small_bam), output="instrumented", mapping=mapping, processes=2)
+    add_isoform_tags(str(small_bam), "test_instrumented.bam", cluster_map={})
+
+    summaries = {p.name.split(".")[0]: json.loads(p.read_text()) for p in metrics_dir.glob("*.summary.json")}
+    assert set(summaries) == {"bamTagHandling", "add_isoform_tags"}
+    assert summaries["bamTagHandling"]["reads"] == total_reads
+    assert [s["stage"] for s in summaries["bamTagHandling"]["stages"]] == ["load_mapping", "split"]
+    assert summaries["add_isoform_tags"]["reads"] == total_reads
+    assert summaries["add_isoform_tags"]["bytes_written"] == Path("test_instrumented.bam").stat().st_size
+    assert all(s["peak_rss_mb"] > 0 and s["bytes_read"] == small_bam.stat().st_size for s in summaries.values())
+
+    # An instrument passed in is used as is and left open for the caller
+    instrument = from_env("pipeline")
+    add_isoform_tags(str(small_bam), "test_instrumented.bam", cluster_map={}, instrument=instrument)
+    assert instrument.reads == total_reads and len(list(metrics_dir.glob("*.summary.json"))) == 2
+    assert instrument.close()["stages"][0]["stage"] == "tag"
+    assert len(list(metrics_dir.glob("*.summary.json"))) == 3
+
+    shutil.rmtree(Path() / "instrumented_files")
+    Path("test_instrumented.bam").unlink()
+    Path("test_instrumented.bam.bai").unlink()
@@ -0,0 +1,101 @@
+# pylint: disable=redefined-outer-name
+from pathlib import Path
+
+import numpy as np
+import pysam
+import pytest
+
+from bam_manipulation.junction_matrix import junction_matrix, load_junction_matrix
+from bam_manipulation.junctions import junction_beds
+from bam_manipulation.mapping_registry import compile_mapping
+
+MAPPING = {"s1": {"AAAC-1": "Muscle", "AAAG-1": "Muscle", "CCCA-1": "Stem A"}}
+# (contig, start, cigar, XS, CB)
+READS = [
+    ("chr1", 100, "20M100N30M", "+", "AAAC-1"),
+    ("chr1", 110, "10M100N40M", "+", "AAAG-1"),
+    ("chr1", 110, "10M100N40M", "+", "CCCA-1"),
+    ("chr1", 150, "70M300N30M", "-", "CCCA-1"),
+    ("chr1", 150, "70M300N30M", "-", "GGGG-1"),  # barcode not in the mapping
+    ("chr1", 600, "50M", "+", "AAAC-1"),         # unspliced
+    ("chr2", 60, "30M1000N30M2000N30M", "+", "CCCA-1"),
+    ("chr2", 60, "30M1000N30M", "+", None),      # no barcode
+]
+
+
+def _write_bam(path, reads):
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"}, "SQ": [{"SN": "chr1", "LN": 5000}, {"SN": "chr2", "LN": 5000}]}
+    unsorted = Path(f"{path}.unsorted.bam")
+    with pysam.AlignmentFile(str(unsorted), "wb", header=header) as bam:
+        for i, (contig, start, cigar, xs, cb) in enumerate(reads):
+            read = pysam.AlignedSegment(bam.header)
+            read.query_name = f"read{i}"
+            read.reference_name = contig
+            read.reference_start = start
+            read.cigarstring = cigar
+            read.query_sequence = "A" * read.infer_query_length()
+            read.set_tag("XS", xs)
+            if cb:
+                read.set_tag("CB", cb)
+            bam.write(read)
+    pysam.sort("-o", str(path), str(unsorted))
+    pysam.index(str(path))
+    unsorted.unlink()
+
+
+@pytest.fixture
+def sample_bam():
+    path = Path() / "test_junction_matrix.bam"
+    _write_bam(path, READS)
+    yield path
+    path.unlink()
+    Path(f"{path}.bai").unlink()
+
+
+def test_celltype_matrix_matches_split_then_extract(sample_bam):
+    matrix = junction_matrix({"s1": sample_bam}, MAPPING, processes=2, shard_size=500)
+    assert list(matrix.columns) == ["Muscle", "Stem A"]
+
+    # The split-merge-extract route the matrix replaces
+    celltype_bams = {}
+    for celltype in matrix.columns:
+        path = Path() / f"test_junction_matrix_{celltype.replace(' ', '_')}.bam"
+        _write_bam(path, [r for r in READS if MAPPING["s1"].get(r[4]) == celltype])
+        celltype_bams[celltype] = path
+    beds = junction_beds(celltype_bams, name_prefix=False)
+
+    dense = matrix.to_dense()
+    for j, celltype in enumerate(matrix.columns):
+        counts = {(f[0], int(f[1]) + int(f[10].split(",")[0]), f[5]): int(f[4]) for f in beds[celltype]}
+        found = {(c, s, st): int(n) for c, s, st, n in zip(matrix.contig, matrix.start, matrix.strand, dense[:, j]) if n}
+        assert found == counts
+    for path in celltype_bams.values():
+        path.unlink()
+        Path(f"{path}.bai").unlink()
+
+
+def test_barcode_matrix_roundtrip(sample_bam):
+    matrix = junction_matrix({"s1": sample_bam}, MAPPING, by="barcode")
+    assert list(matrix.columns) == ["s1:AAAC-1", "s1:AAAG-1", "s1:CCCA-1"]
+    assert matrix.to_dense().sum() == 6
+
+    output_file = Path() / "test_junction_matrix.npz"
+    matrix.save(output_file)
+    loaded = load_junction_matrix(output_file)
+    for name in matrix.__dataclass_fields__:
+        assert np.array_equal(getattr(loaded, name), getattr(matrix, name))
+    assert (loaded.to_scipy().toarray() == matrix.to_dense()).all()
+    output_file.unlink()
+
+
+def test_compiled_mapping_gives_the_same_matrix(sample_bam):
+    mapping_csv = Path() / "test_junction_matrix_mapping.csv"
+    mapping_csv.write_text("sample,cell_barcode,Cluster\n"
+                           + "".join(f"s1,{barcode},{celltype}\n" for barcode, celltype in MAPPING["s1"].items()))
+    compiled = compile_mapping(str(mapping_csv))
+    for by in ("celltype", "barcode"):
+        expected = junction_matrix({"s1": sample_bam}, MAPPING, by=by)
+        matrix = junction_matrix({"s1": sample_bam}, compiled, by=by, processes=2)
+        assert list(matrix.columns) == list(expected.columns)
+        assert (matrix.to_dense() == expected.to_dense()).all()
+    mapping_csv.unlink()
@@ -0,0 +1,76 @@
+# pylint: disable=redefined-outer-name
+import math
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from bam_manipulation.junction_usage import erfc, load_junctions, main as junction_usage
+
+# (celltype, contig, intron start, intron end, strand, reads); introns 1 and 2 share a donor
+JUNCTIONS = [
+    ("Muscle", "SM_V10_1", 1000, 2000, "+", 90),
+    ("Muscle", "SM_V10_1", 1000, 3000, "+", 10),
+    ("Muscle", "SM_V10_1", 5000, 6000, "-", 40),
+    ("Stem_A", "SM_V10_1", 1000, 2000, "+", 15),
+    ("Stem_A", "SM_V10_1", 1000, 3000, "+", 85),
+    ("Stem_A", "SM_V10_1", 5000, 6000, "-", 30),
+    ("Stem_B", "SM_V10_2", 100, 900, "?", 5),
+]
+COLORS = {"Muscle": "85,68,229", "Stem_A": "229,119,68", "Stem_B": "68,102,229"}
+
+
+@pytest.fixture
+def junction_bed():
+    path = Path() / "test_all_celltypes.junctions.bed.rgb"
+    with open(path, "w") as fh:
+        for i, (celltype, contig, start, end, strand, n) in enumerate(JUNCTIONS):
+            s, e = start - 20, end + 30
+            fh.write(f"{contig}\t{s}\t{e}\t{celltype}_JUNC{i + 1:08d}\t{n}\t{strand}\t{s}\t{e}\t{COLORS[celltype]}\t2\t"
+                     f"20,30\t0,{end - s}\n")
+    yield path
+    path.unlink()
+
+
+def test_erfc_matches_math():
+    x = np.linspace(-6, 30, 500)
+    expected = np.array([math.erfc(v) for v in x])
+    assert np.allclose(erfc(x), expected, rtol=2e-7, atol=0)
+
+
+def test_load_bed_and_matrix_agree(junction_bed):
+    matrix, colors = load_junctions(str(junction_bed))
+    assert list(matrix.columns) == ["Muscle", "Stem_A", "Stem_B"]
+    assert colors == COLORS
+    assert matrix.shape == (4, 3)
+    assert list(matrix.start) == [1000, 1000, 5000, 100]
+    assert matrix.to_dense()[:, 1].tolist() == [15, 85, 30, 0]
+
+    npz = Path() / "test_junction_usage.npz"
+    matrix.save(npz)
+    loaded, _ = load_junctions(str(npz))
+    assert (loaded.to_dense() == matrix.to_dense()).all()
+    npz.unlink()
+
+
+def test_differential_usage(junction_bed):
+    output_dir = Path() / "test_junction_usage"
+    junction_usage([str(junction_bed), "-o", str(output_dir)])
+    results = pd.read_csv(output_dir / "differential_junction_usage.tsv", sep="\t")
+
+    # Only the shared donor is alternative; both of its junctions are tested for the one pair with reads
+    assert set(results["site"]) == {"donor"}
+    assert set(zip(results["celltype_a"], results["celltype_b"])) == {("Muscle", "Stem_A")}
+    top = results.iloc[0]
+    assert top["qvalue"] < 1e-10
+    assert abs(top["delta"]) == pytest.approx(0.75)
+    assert (results["qvalue"].diff().dropna() >= 0).all()
+
+    muscle = (output_dir / "Muscle.filtered.bed").read_text().splitlines()
+    assert [line.split("\t")[4] for line in muscle] == ["90", "10"]
+    assert muscle[0].split("\t")[8] == COLORS["Muscle"]
+    assert (output_dir / "Stem_B.filtered.bed").read_text() == ""
+    for path in output_dir.iterdir():
+        path.unlink()
+    output_dir.rmdir()
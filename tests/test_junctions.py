@@ -0,0 +1,85 @@
+# pylint: disable=redefined-outer-name
+from pathlib import Path
+
+import pysam
+import pytest
+
+from bam_manipulation.junctions import celltype_colors, junction_beds, merge_bed_track, write_bed
+
+# (contig, start, cigar, XS, flag)
+READS = [
+    ("chr1", 100, "20M100N30M", "+", 0),
+    ("chr1", 110, "10M100N40M", "+", 0),
+    ("chr1", 105, "15M100N40M", "-", 0),        # same intron, other strand
+    ("chr1", 100, "5M2D11M2I2M100N30M", "+", 0),  # deletions count towards the anchor, insertions do not
+    ("chr1", 300, "10M50N20M", "+", 0),          # intron shorter than 70
+    ("chr1", 400, "30M100N30M", "+", 0x100),     # secondary
+    ("chr2", 50, "4M200N30M", "+", 0),           # anchor shorter than 8
+    ("chr2", 60, "30M1000N30M2000N30M", None, 0),
+]
+
+
+@pytest.fixture
+def spliced_bam():
+    path = Path() / "test_junctions.bam"
+    header = {"HD": {"VN": "1.6", "SO": "coordinate"}, "SQ": [{"SN": "chr1", "LN": 5000}, {"SN": "chr2", "LN": 5000}]}
+    unsorted = Path() / "test_junctions.unsorted.bam"
+    with pysam.AlignmentFile(str(unsorted), "wb", header=header) as bam:
+        for i, (contig, start, cigar, xs, flag) in enumerate(READS):
+            read = pysam.AlignedSegment(bam.header)
+            read.query_name = f"read{i}"
+            read.flag = flag
+            read.reference_name = contig
+            read.reference_start = start
+            read.cigarstring = cigar
+            read.query_sequence = "A" * read.infer_query_length()
+            if xs:
+                read.set_tag("XS", xs)
+            bam.write(read)
+    pysam.sort("-o", str(path), str(unsorted))
+    pysam.index(str(path))
+    unsorted.unlink()
+    yield path
+    path.unlink()
+    Path(f"{path}.bai").unlink()
+
+
+def test_junction_records_match_regtools_layout(spliced_bam):
+    beds = junction_beds({"Muscle": spliced_bam}, colors={"Muscle": "1,2,3"})
+    assert beds["Muscle"] == [
+        ["chr1", "100", "260", "Muscle_JUNC00000001", "3", "+", "100", "260", "1,2,3", "2", "20,40", "0,120"],
+        ["chr1", "105", "260", "Muscle_JUNC00000002", "1", "-", "105", "260", "1,2,3", "2", "15,40", "0,115"],
+        ["chr2", "60", "1120", "Muscle_JUNC00000003", "1", "?", "60", "1120", "1,2,3", "2", "30,30", "0,1030"],
+        ["chr2", "1090", "3150", "Muscle_JUNC00000004", "1", "?", "1090", "3150", "1,2,3", "2", "30,30", "0,2030"],
+    ]
+
+
+def test_parallel_shards_match_serial(spliced_bam):
+    bams = {"Stem_A": spliced_bam, "Stem_B": spliced_bam}
+    colors = celltype_colors(list(bams))
+    serial = junction_beds(bams, colors=colors)
+    # Small shards put the reads of one junction into different shards
+    parallel = junction_beds(bams, processes=3, shard_size=100, colors=colors)
+    assert parallel == serial
+    assert serial["Stem_B"][0][3] == "Stem_B_JUNC00000001"
+    assert serial["Stem_A"][0][8] != serial["Stem_B"][0][8]
+
+
+def test_merged_track_is_sorted_and_indexed(spliced_bam):
+    beds = junction_beds({"Stem_A": spliced_bam, "Stem_B": spliced_bam})
+    bed_paths = []
+    for celltype, rows in beds.items():
+        bed_paths.append(Path() / f"test_junctions.{celltype}.bed")
+        write_bed(rows, bed_paths[-1])
+    output_file = Path() / "test_junctions.bed.gz"
+    index = merge_bed_track(bed_paths, output_file, contig_order=["chr1", "chr2"])
+    assert Path(index).exists()
+
+    with pysam.TabixFile(str(output_file)) as tbx:
+        records = [line.split("\t") for contig in tbx.contigs for line in tbx.fetch(contig)]
+        assert len(records) == 8
+        assert records == sorted(records, key=lambda f: (f[0], int(f[1]), int(f[2])))
+        assert [f[3] for f in map(lambda line: line.split("\t"), tbx.fetch("chr2", 2000, 2100))] == [
+            "Stem_A_JUNC00000004", "Stem_B_JUNC00000004"]
+    for path in bed_paths + [output_file, Path(index)]:
+        path.unlink()
@@ -0,0 +1,88 @@
+# pylint: disable=redefined-outer-name
+import gzip
+import shutil
+from pathlib import Path
+
+import pysam
+import pytest
+
+from bam_manipulation.kallisto_ic_tagging import build_index_from_pseudobam, main as kallisto_ic_tagging
+from bam_manipulation.read_to_transcripts_tsv import write_read_transcripts
+from bam_manipulation.wp3_add_custom_tags import add_isoform_tags, load_cluster_map
+
+TRANSCRIPTS = {"STRG.1.1": "STRG.1", "STRG.1.2": "STRG.1", "STRG.2.1": "STRG.2", "STRG.2.2": "STRG.2"}
+
+
+@pytest.fixture
+def small_bam():
+    return Path(__file__).parent / "test_data" / "possorted_genome_bam.sample.CB.bam"
+
+
+@pytest.fixture
+def gtf():
+    path = Path() / "test_fused_stringtie.gtf"
+    with open(path, "w") as fh:
+        for tx, gene in TRANSCRIPTS.items():
+            fh.write(f'chr1\tStringTie\ttranscript\t1\t100\t1000\t+\t.\tgene_id "{gene}"; transcript_id "{tx}";\n')
+    yield path
+    path.unlink()
+
+
+@pytest.fixture
+def pseudobam(small_bam):
+    """Pseudoalignments of the genome BAM's reads, some multimapped and some below the ZW cutoff."""
+    with pysam.AlignmentFile(str(small_bam), "rb") as bam:
+        names = list(dict.fromkeys(read.query_name for read in bam))
+    path = Path() / "test_fused_pseudoalignments.bam"
+    header = {"HD": {"VN": "1.0"}, "SQ": [{"SN": tx, "LN": 100} for tx in TRANSCRIPTS]}
+    with pysam.AlignmentFile(str(path), "wb", header=header) as out:
+        for i, name in enumerate(names):
+            for j in range(i % 3):
+                aln = pysam.AlignedSegment(out.header)
+                aln.query_name = name
+                aln.query_sequence = "ACGT" * 5
+                aln.reference_id = (i + j) % len(TRANSCRIPTS)
+                aln.reference_start = 0
+                aln.cigarstring = "20M"
+                aln.set_tag("ZW", 0.9 if (i + j) % 5 else 0.5, value_type="f")
+                out.write(aln)
+    yield path
+    path.unlink()
+
+
+def test_fused_stage_matches_tsv_pipeline(small_bam, pseudobam, gtf):
+    def tags(path):
+        with pysam.AlignmentFile(str(path), "rb") as bam:
+            return [(r.query_name, r.reference_id, r.reference_start, r.get_tag("IC") if r.has_tag("IC") else None)
+                    for r in bam]
+
+    # The read_to_transcripts_tsv -> load_cluster_map route the fused stage replaces
+    table = Path() / "test_fused_read_transcripts.tsv"
+    expected_file = Path() / "test_fused_expected.bam"
+    write_read_transcripts(str(pseudobam), str(gtf), output=str(table))
+    cluster_map = load_cluster_map(str(table), read_col=1, gene_col=3, transcript_col=2)
+    add_isoform_tags(str(small_bam), str(expected_file), cluster_map=cluster_map)
+
+    fused_files = []
+    for label, extra in [("serial", []), ("parallel", ["--processes", "2"])]:
+        fused_file = Path() / f"test_fused_{label}.bam"
+        debug_table = Path() / f"test_fused_{label}.tsv.gz"
+        kallisto_ic_tagging(["--pseudobam", str(pseudobam), "--gtf", str(gtf), "-i", str(small_bam),
+                             "-o", str(fused_file), "--read-transcripts", str(debug_table)] + extra)
+        assert tags(fused_file) == tags(expected_file)
+        with gzip.open(debug_table, "rt") as a, open(table) as b:
+            assert a.read() == b.read()
+        fused_files += [fused_file, debug_table]
+
+    # Spilling the index in small sorted runs gives the same cluster IDs
+    index_dir = Path() / "test_fused_index"
+    index = build_index_from_pseudobam(str(pseudobam), str(gtf), str(index_dir), chunk_size=3)
+    assert len(index) == len(cluster_map)
+    assert index.lookup(list(cluster_map)).tolist() == list(cluster_map.values())
+    shutil.rmtree(index_dir)
+
+    assert len(set(cluster_map.values())) > 1
+    for path in [table, expected_file, *fused_files]:
+        path.unlink()
+        if path.suffix == ".bam":
+            Path(f"{path}.bai").unlink()
@@ -0,0 +1,111 @@
+# pylint: disable=redefined-outer-name
+import json
+import pickle
+import shutil
+from pathlib import Path
+
+import pandas as pd
+import pysam
+import pytest
+
+from bam_manipulation.barcode_coverage import barcode_coverage
+from bam_manipulation.mapping_registry import CompiledMapping, compile_mapping, default_cache_dir, load_mapping
+from bam_manipulation.rs_bam_handling import bamTagHandling
+from bam_manipulation.split_merge_by_celltype import load_sample_mapping
+
+
+@pytest.fixture
+def small_bam():
+    return Path(__file__).parent / "test_data" / "possorted_genome_bam.sample.CB.bam"
+
+
+@pytest.fixture
+def mapping_tsv():
+    return Path(__file__).parent / "test_data" / "cell_barcodes_labeled.tsv"
+
+
+@pytest.fixture
+def pooled_csv(mapping_tsv):
+    labeled = pd.read_csv(mapping_tsv, sep="\t")
+    sample2 = labeled[labeled["Cluster"] == "Muscle"].assign(Cluster="Muscle 2")
+    rows = pd.concat([labeled.assign(sample="sample1"), sample2.assign(sample="sample2")])
+    # An unencodable barcode, and a repeated barcode whose last row wins
+    extra = pd.DataFrame({"sample": ["sample1", "sample2"], "cell_barcode": ["not-a-barcode", rows["cell_barcode"].iloc[0]],
+                          "Cluster": ["Other", "Stem B"]})
+    path = Path() / "test_cc_barcode.csv"
+    pd.concat([rows, extra])[["sample", "cell_barcode", "Cluster"]].to_csv(path, index=False)
+    yield path
+    path.unlink()
+
+
+def test_compiled_mapping_matches_csv_and_is_cached(pooled_csv, mapping_cache):
+    compiled = compile_mapping(str(pooled_csv))
+    assert compile_mapping(str(pooled_csv)).path == compiled.path
+    assert [p.name for p in mapping_cache.iterdir()] == [Path(compiled.path).name]
+    assert load_mapping(compiled.path).digest == compiled.digest
+
+    expected = load_sample_mapping(str(pooled_csv))
+    assert compiled.samples == ["sample1", "sample2"]
+    assert {sample: compiled.get(sample) for sample in compiled} == expected
+    assert compiled.get("sample3") is None
+
+    index, labels = compiled.index("sample2")
+    barcodes = list(expected["sample2"]) + ["not-a-barcode", None]
+    assert [labels[v] if v >= 0 else None for v in index.lookup(barcodes)] == list(expected["sample2"].values()) + [None, None]
+    assert compiled.index("sample1")[0].lookup(["not-a-barcode"]).tolist() == [labels.index("Other")]
+    with pytest.raises(ValueError):
+        compiled.index()
+
+    # Workers receive the path and map the same arrays instead of a copy
+    payload = pickle.dumps(index)
+    assert len(payload) < 500
+    assert pickle.loads(payload).lookup(barcodes).tolist() == index.lookup(barcodes).tolist()
+    assert pickle.loads(pickle.dumps(compiled)).path == compiled.path
+
+
+def test_stale_or_incomplete_entries_are_rebuilt(pooled_csv, mapping_cache):
+    compiled = compile_mapping(str(pooled_csv))
+    expected = {sample: compiled.get(sample) for sample in compiled}
+    path = Path(compiled.path)
+
+    meta = json.loads((path / "meta.json").read_text())
+    (path / "meta.json").write_text(json.dumps(dict(meta, version=0)))
+    (path / "codes.npy").write_bytes(b"")
+    rebuilt = compile_mapping(str(pooled_csv))
+    assert rebuilt.path == compiled.path
+    assert {sample: rebuilt.get(sample) for sample in rebuilt} == expected
+
+    (path / "codes.npy").unlink()
+    assert compile_mapping(str(pooled_csv)).get("sample2") == expected["sample2"]
+    assert [p.name for p in mapping_cache.iterdir()] == [path.name]
+
+
+def test_default_cache_is_in_the_user_cache(tmp_path, monkeypatch):
+    monkeypatch.delenv("BAM_MAPPING_CACHE")
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "xdg"))
+    assert default_cache_dir() == str(tmp_path / "xdg" / "bam_manipulation" / "mappings")
+
+
+def test_entry_points_accept_compiled_mappings(small_bam, mapping_tsv, pooled_csv, mapping_cache):
+    compiled = compile_mapping(str(pooled_csv))
+    samples = {"Mira_1": small_bam, "Mira_2": small_bam}
+    sample_map = {"Mira_1": "sample1", "Mira_2": "sample2"}
+    expected = barcode_coverage(samples, load_sample_mapping(str(pooled_csv)), sample_map=sample_map)
+    assert barcode_coverage(samples, compiled, sample_map=sample_map, processes=2) == expected
+    assert barcode_coverage(samples, str(pooled_csv), sample_map=sample_map) == expected
+
+    def read_counts(directory, prefix):
+        counts = {}
+        for p in directory.iterdir():
+            with pysam.AlignmentFile(str(p), "rb") as bam:
+                counts[p.name.replace(prefix, "")] = sum(1 for _ in bam)
+        return counts
+
+    tsv_dir, compiled_dir = Path() / "tsv_files", Path() / "compiled_files"
+    bamTagHandling(str(small_bam), output="tsv", mapping=str(mapping_tsv), delim="\t")
+    bamTagHandling(str(small_bam), output="compiled", mapping=compiled, mappingSample="sample1")
+    assert read_counts(compiled_dir, "compiled_") == read_counts(tsv_dir, "tsv_")
+    assert len(list(mapping_cache.iterdir())) == 2
+    shutil.rmtree(tsv_dir, ignore_errors=True)
+    shutil.rmtree(compiled_dir, ignore_errors=True)
+    assert isinstance(load_mapping(compiled), CompiledMapping)
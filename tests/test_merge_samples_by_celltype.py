@@ -1,7 +1,11 @@
 from pathlib import Path
+import json
+import os
 import shutil
 
-from bam_manipulation.merge_samples_by_celltype import merge_samples_by_celltype
+import pytest
+
+from bam_manipulation.merge_samples_by_celltype import merge_samples_by_celltype, MANIFEST_NAME
 
 def test_merge_samples_by_celltype():
     input_dir = Path(__file__).parent / "test_data" / "dummy_bams"
@@ -10,5 +14,53 @@ def test_merge_samples_by_celltype():
     shutil.rmtree(output_dir, ignore_errors=True)
     merge_samples_by_celltype(input_dir, output_dir)
     assert output_dir.exists()
-    assert set(f.name for f in output_dir.iterdir()) == expected_files
+    assert set(f.name for f in output_dir.glob("*.bam")) == expected_files
+    assert set(f.name for f in output_dir.glob("*.bai")) == {f + ".bai" for f in expected_files}
+    assert (output_dir / MANIFEST_NAME).exists()
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def test_merge_samples_by_celltype_incremental():
+    input_dir = Path() / "test_merge_inputs"
+    output_dir = Path() / "test_merged_incremental"
+    shutil.rmtree(input_dir, ignore_errors=True)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    shutil.copytree(Path(__file__).parent / "test_data" / "dummy_bams", input_dir)
+    # A cell type whose name extends another must not be merged into it
+    shutil.copy(input_dir / "Mira_1_files" / "Mira_1_Stem_C.bam", input_dir / "Mira_1_files" / "Mira_1_Stem_C_2.bam")
+
+    built = merge_samples_by_celltype(input_dir, output_dir, threads=2)
+    assert set(built) == {"Neuron_1", "Stem_C", "Stem_C_2", "Stem_D", "Muscle_1"}
+    with open(output_dir / MANIFEST_NAME) as fh:
+        manifest = json.load(fh)
+    assert set(manifest["Stem_C_2"]) == {str(input_dir / "Mira_1_files" / "Mira_1_Stem_C_2.bam")}
+    assert len(manifest["Stem_C"]) == 2
+
+    assert merge_samples_by_celltype(input_dir, output_dir) == []
+    # Touching an input without changing its contents does not trigger a rebuild
+    os.utime(input_dir / "Mira_3_files" / "Mira_3_Muscle_1.bam")
+    assert merge_samples_by_celltype(input_dir, output_dir) == []
+    shutil.copy(input_dir / "Mira_2_files" / "Mira_2_Stem_C.bam", input_dir / "Mira_3_files" / "Mira_3_Stem_D.bam")
+    assert merge_samples_by_celltype(input_dir, output_dir) == ["Stem_D"]
+    shutil.rmtree(input_dir, ignore_errors=True)
+    shutil.rmtree(output_dir, ignore_errors=True)
+
+
+def test_failed_merge_keeps_the_manifest_of_the_others():
+    input_dir = Path() / "test_merge_failing_inputs"
+    output_dir = Path() / "test_merged_failing"
+    shutil.rmtree(input_dir, ignore_errors=True)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    shutil.copytree(Path(__file__).parent / "test_data" / "dummy_bams", input_dir)
+    (input_dir / "Mira_1_files" / "Mira_1_Broken.bam").write_bytes(b"not a bam")
+
+    for threads in (1, 2):
+        shutil.rmtree(output_dir, ignore_errors=True)
+        with pytest.raises(Exception):
+            merge_samples_by_celltype(input_dir, output_dir, threads=threads)
+        with open(output_dir / MANIFEST_NAME) as fh:
+            assert set(json.load(fh)) == {"Neuron_1", "Stem_C", "Stem_D", "Muscle_1"}
+    (input_dir / "Mira_1_files" / "Mira_1_Broken.bam").unlink()
+    assert merge_samples_by_celltype(input_dir, output_dir) == []
+    shutil.rmtree(input_dir, ignore_errors=True)
     shutil.rmtree(output_dir, ignore_errors=True)
@@ -1,7 +1,10 @@
+import shutil
 from pathlib import Path
 
+from plotting.batch import PlotJob, plot_regions, render_jobs
 from plotting.plot_cell_types import plot_by_cell_type
 from plotting.plot_by_score import plot_by_score
+from plotting.track_index import slice_track, track_index
 
 TEMP_INI_PATH = Path() / "temp.ini"
 
@@ -36,3 +39,69 @@ def test_plot_by_score_outputs():
     assert output_file.exists()
     output_file.unlink()
     TEMP_INI_PATH.unlink()
+
+
+def test_plot_regions_renders_in_parallel_and_caches():
+    input_files = sorted((Path(__file__).parent / "test_data").glob("volvox-bed12*.bed"))
+    output_dir = Path() / "test_plot_regions"
+    cache_dir = Path() / "test_plot_cache"
+    regions = ["ctgA:1000-25000", "ctgA:1000..10000", "ctgA:1,000-25,000"]
+    tracks = {"bed_files": input_files, "titles": ["Tissue1", "Tissue2", "Tissue3", "Tissue4"]}
+
+    outputs = plot_regions(regions, output_dir=output_dir, processes=2, cache_dir=cache_dir,
+                           index_dir=cache_dir / "index", **tracks)
+    assert list(outputs.values()) == [str(output_dir / "ctgA_1000-25000.png"), str(output_dir / "ctgA_1000-10000.png"),
+                                      str(output_dir / "ctgA_1000-25000.png")]
+    assert all(Path(p).exists() for p in outputs.values())
+    assert len(list(cache_dir.glob("*.png"))) == 2
+    assert not TEMP_INI_PATH.exists() and not list(cache_dir.glob("*.ini"))
+
+    # Unchanged inputs and style are served from the cache; a style change is drawn again
+    jobs = [PlotJob(r, output_dir / f"{i}.png", tracks) for i, r in enumerate(regions[:2])]
+    jobs.append(PlotJob(regions[0], output_dir / "2.png", dict(tracks, height=3)))
+    results = render_jobs(jobs, cache_dir=cache_dir, index_dir=cache_dir / "index")
+    assert [cached for _, cached in results] == [True, True, False]
+    assert len(list(cache_dir.glob("*.png"))) == 3
+    shutil.rmtree(output_dir)
+    shutil.rmtree(cache_dir)
+
+
+def test_slice_track_reuses_index():
+    bed_file = Path() / "test_slice_track.bed"
+    bed_file.write_text("track name=test\n"
+                        "ctgB\t10\t20\tb1\t0\t+\n"
+                        "ctgA\t5000\t6000\ta2\t0\t+\n"
+                        "ctgA\t100\t200\ta1\t0\t+\n"
+                        "ctgA\t9000\t9100\ta3\t0\t-\n")
+    index_dir = Path() / "test_track_index"
+    output_file = Path() / "test_slice_track.sliced.bed"
+
+    assert slice_track(bed_file, "ctgA:150-5500", output_file, padding=0, index_dir=index_dir) == 2
+    assert [line.split("\t")[3] for line in output_file.read_text().splitlines()] == ["a1", "a2"]
+    assert slice_track(bed_file, "ctgA:6100-8000", output_file, padding=1001, index_dir=index_dir) == 2
+    assert slice_track(bed_file, "ctgC:1-1000", output_file, index_dir=index_dir) == 0
+    assert len(list(index_dir.glob("*.bed.gz"))) == 1
+    indexed = track_index(bed_file, index_dir)
+    assert track_index(indexed) == indexed
+    bed_file.unlink()
+    output_file.unlink()
+    shutil.rmtree(index_dir)
+
+
+def test_plot_by_cell_type_preslice_outputs():
+    input_files = sorted((Path(__file__).parent / "test_data").glob("volvox-bed12*.bed"))
+    output_file = Path() / "celltype_plot_presliced.png"
+    index_dir = Path() / "test_preslice_index"
+    plot_by_cell_type(
+        bed_files=input_files,
+        region="ctgA:1000-25000",
+        output_file=output_file,
+        preslice=True,
+        index_dir=index_dir
+    )
+    assert output_file.exists()
+    assert len(list(index_dir.glob("*.bed.gz"))) == len(input_files)
+    assert not [p for p in Path().iterdir() if p.is_dir() and p.name.startswith("tmp")]
+    output_file.unlink()
+    TEMP_INI_PATH.unlink()
+    shutil.rmtree(index_dir)
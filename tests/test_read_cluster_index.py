@@ -0,0 +1,81 @@
+# pylint: disable=redefined-outer-name
+from pathlib import Path
+import pickle
+import shutil
+
+import numpy as np
+import pysam
+import pytest
+
+from bam_manipulation.read_cluster_index import ClusterIndex, ClusterIndexWriter, build_cluster_index, hash_read_names
+from bam_manipulation.wp3_add_custom_tags import add_isoform_tags, load_cluster_map
+
+
+@pytest.fixture
+def small_bam():
+    return Path(__file__).parent / "test_data" / "possorted_genome_bam.sample.CB.bam"
+
+
+@pytest.fixture
+def cluster_tsv(small_bam):
+    with pysam.AlignmentFile(str(small_bam), "rb") as bam:
+        names = [read.query_name for read in bam]
+    path = Path() / "test_clusters.tsv"
+    with open(path, "w") as fh:
+        fh.write("#read_id\tgene_id\ttranscript_id\n")
+        for i, name in enumerate(names[::2]):
+            fh.write(f"{name}\tgene{i % 3}\ttx{i % 7}\n")
+        # A later row for the same read replaces the earlier one
+        fh.write(f"{names[0]}\tgene2\ttx_late\n")
+    yield path
+    path.unlink()
+
+
+def test_index_matches_load_cluster_map(cluster_tsv):
+    index_dir = Path() / "test_cluster_index"
+    shutil.rmtree(index_dir, ignore_errors=True)
+    expected = load_cluster_map(str(cluster_tsv))
+    index = build_cluster_index(str(cluster_tsv), str(index_dir), chunk_size=10)
+    assert len(index) == len(expected)
+    assert all(index.get(name) == cid for name, cid in expected.items())
+    assert index.get("not-a-read", 0) == 0
+    assert index.lookup(list(expected) + ["not-a-read"]).tolist() == list(expected.values()) + [0]
+    reopened = pickle.loads(pickle.dumps(index))
+    assert isinstance(reopened, ClusterIndex)
+    assert reopened.get(next(iter(expected))) == next(iter(expected.values()))
+    shutil.rmtree(index_dir, ignore_errors=True)
+
+
+def test_writer_merges_spilled_runs_last_entry_winning():
+    index_dir = Path() / "test_cluster_index_runs"
+    shutil.rmtree(index_dir, ignore_errors=True)
+    rng = np.random.default_rng(0)
+    names = [f"read{i}" for i in rng.integers(0, 3000, size=6000)]
+    values = rng.integers(1, 50, size=len(names))
+    writer = ClusterIndexWriter(str(index_dir), chunk_size=250)
+    for start in range(0, len(names), 100):
+        writer.add(hash_read_names(names[start:start + 100]), values[start:start + 100])
+    index = writer.finish()
+    expected = dict(zip(names, values.tolist()))
+    assert len(index) == len(expected)
+    assert index.lookup(list(expected)).tolist() == list(expected.values())
+    assert np.all(index.keys[1:] > index.keys[:-1])
+    assert sorted(p.name for p in index_dir.iterdir()) == ["clusters.npy", "keys.npy", "meta.json"]
+    shutil.rmtree(index_dir, ignore_errors=True)
+
+
+def test_add_isoform_tags_with_index(small_bam, cluster_tsv):
+    index_dir = Path() / "test_cluster_index_tags"
+    shutil.rmtree(index_dir, ignore_errors=True)
+    outputs = []
+    for label, cluster_map in [("dict", load_cluster_map(str(cluster_tsv))),
+                               ("index", build_cluster_index(str(cluster_tsv), str(index_dir)))]:
+        output_file = Path() / f"test_{label}.bam"
+        add_isoform_tags(str(small_bam), str(output_file), cluster_map=cluster_map)
+        with pysam.AlignmentFile(str(output_file), "rb") as bam:
+            outputs.append([(r.query_name, r.get_tag("IC") if r.has_tag("IC") else None) for r in bam])
+        output_file.unlink()
+        Path(f"{output_file}.bai").unlink()
+    assert outputs[0] == outputs[1]
+    assert any(ic for _, ic in outputs[0])
+    shutil.rmtree(index_dir, ignore_errors=True)
@@ -0,0 +1,86 @@
+# pylint: disable=redefined-outer-name
+import gzip
+from pathlib import Path
+
+import numpy as np
+import pysam
+import pytest
+
+from bam_manipulation.read_to_transcripts_tsv import iter_read_transcripts, load_tx2gene, main
+
+TRANSCRIPTS = {"STRG.1.1": "STRG.1", "STRG.1.2": "STRG.1", "STRG.2.1": "STRG.2"}
+# (read name, transcript, ZW); kallisto writes a read's alignments consecutively
+ALIGNMENTS = [
+    ("r1", "STRG.1.1", 0.95),
+    ("r2", "STRG.1.1", 0.85),
+    ("r2", "STRG.1.2", 0.9),
+    ("r2", "STRG.2.1", 0.9),
+    ("r3", "STRG.2.1", 0.5),
+    ("r4", None, None),
+    ("r5", "STRG.1.2", 1.0),
+    ("r5", "STRG.2.1", 0.8),
+]
+
+
+@pytest.fixture
+def gtf():
+    path = Path() / "test_stringtie.gtf"
+    with open(path, "w") as fh:
+        fh.write("# StringTie\n")
+        for tx, gene in TRANSCRIPTS.items():
+            attrs = f'gene_id "{gene}"; transcript_id "{tx}"; ref_gene_id "Smp_{gene}";'
+            fh.write(f"chr1\tStringTie\ttranscript\t1\t100\t1000\t+\t.\t{attrs}\n")
+            fh.write(f"chr1\tStringTie\texon\t1\t100\t1000\t+\t.\t{attrs} exon_number \"1\";\n")
+    yield path
+    path.unlink()
+
+
+@pytest.fixture
+def pseudobam():
+    path = Path() / "test_pseudoalignments.bam"
+    header = {"HD": {"VN": "1.0"}, "SQ": [{"SN": tx, "LN": 100} for tx in TRANSCRIPTS]}
+    with pysam.AlignmentFile(str(path), "wb", header=header) as bam:
+        tids = {tx: i for i, tx in enumerate(TRANSCRIPTS)}
+        for name, tx, zw in ALIGNMENTS:
+            aln = pysam.AlignedSegment(bam.header)
+            aln.query_name = name
+            aln.query_sequence = "ACGT" * 5
+            if tx is None:
+                aln.is_unmapped = True
+                aln.reference_id = -1
+            else:
+                aln.reference_id = tids[tx]
+                aln.reference_start = 0
+                aln.cigarstring = "20M"
+                aln.set_tag("ZW", zw, value_type="f")
+            bam.write(aln)
+    yield path
+    path.unlink()
+
+
+def _rows(path):
+    with gzip.open(path, "rt") as fh:
+        return [line.rstrip("\n").split("\t") for line in fh]
+
+
+def test_load_tx2gene_ignores_ref_gene_id(gtf):
+    assert load_tx2gene(str(gtf)) == TRANSCRIPTS
+
+
+def test_read_to_transcripts_tsv(pseudobam, gtf):
+    output_file = Path() / "test_read_transcripts.tsv.gz"
+    main(["--bam", str(pseudobam), "--gtf", str(gtf), "--output", str(output_file)])
+    rows = _rows(output_file)
+    assert rows[0] == ["#read_id", "transcript_id", "gene_id", "prob_assignment_zw"]
+    assert [row[:3] for row in rows[1:]] == [
+        [name, tx, TRANSCRIPTS[tx]] for name, tx, zw in ALIGNMENTS if zw is not None and zw >= 0.8]
+    # ZW is written as pysam returns it, widened from the stored float
+    assert rows[2][3] == str(float(np.float32(0.85)))
+    output_file.unlink()
+
+
+@pytest.mark.parametrize("block_size", [1, 2, 3, 100])
+def test_best_per_read_across_blocks(pseudobam, gtf, block_size):
+    blocks = iter_read_transcripts(str(pseudobam), str(gtf), best_per_read=True, block_size=block_size)
+    kept = [(name, tx) for names, txs, _, _ in blocks for name, tx in zip(names, txs)]
+    assert kept == [("r1", "STRG.1.1"), ("r2", "STRG.1.2"), ("r5", "STRG.1.2")]
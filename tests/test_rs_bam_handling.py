@@ -2,6 +2,8 @@
 from pathlib import Path
 import shutil
 
+import pandas as pd
+import pysam
 import pytest
 
 from bam_manipulation.rs_bam_handling import bamTagHandling
@@ -25,3 +27,98 @@ def test_mapped_files_created(small_bam, mapping_tsv):
     assert expected_output_dir.exists()
     assert set(p.name for p in expected_output_dir.iterdir()) == expected_files
     shutil.rmtree(expected_output_dir, ignore_errors=True)
+
+
+def test_parallel_split_matches_serial(small_bam, mapping_tsv):
+    def read_names(directory):
+        names = {}
+        for p in directory.iterdir():
+            with pysam.AlignmentFile(str(p), "rb") as bam:
+                names[p.name] = [read.query_name for read in bam]
+        return names
+
+    serial_dir = Path() / "serial_files"
+    parallel_dir = Path() / "parallel_files"
+    shutil.rmtree(serial_dir, ignore_errors=True)
+    shutil.rmtree(parallel_dir, ignore_errors=True)
+    bamTagHandling(str(small_bam), output="serial", mapping=str(mapping_tsv), delim="\t", untagged=True, unmapped=True)
+    bamTagHandling(str(small_bam), output="parallel", mapping=str(mapping_tsv), delim="\t", untagged=True, unmapped=True,
+                   processes=2, shardSize=5_000_000)
+    serial = {name.replace("serial_", ""): reads for name, reads in read_names(serial_dir).items()}
+    parallel = {name.replace("parallel_", ""): reads for name, reads in read_names(parallel_dir).items()}
+    assert serial == parallel
+    shutil.rmtree(serial_dir, ignore_errors=True)
+    shutil.rmtree(parallel_dir, ignore_errors=True)
+
+
+def test_native_split_matches_samtools_split(small_bam):
+    def read_counts(directory):
+        counts = {}
+        for p in directory.iterdir():
+            with pysam.AlignmentFile(str(p), "rb") as bam:
+                counts[p.name] = sum(1 for _ in bam)
+        return counts
+
+    samtools_dir = Path() / "samtools_files"
+    native_dir = Path() / "native_files"
+    shutil.rmtree(samtools_dir, ignore_errors=True)
+    shutil.rmtree(native_dir, ignore_errors=True)
+    bamTagHandling(str(small_bam), output="samtools", threadNumber=1)
+    bamTagHandling(str(small_bam), output="native", native=True, maxOpenFiles=4)
+    samtools = {name.replace("samtools_", ""): n for name, n in read_counts(samtools_dir).items()}
+    native = {name.replace("native_", ""): n for name, n in read_counts(native_dir).items()}
+    # samtools split writes at most 100 tag values and sends the rest to untagged.bam
+    assert native.pop("untagged.bam") == 0
+    assert sum(native.values()) == 139
+    assert all(native[name] == n for name, n in samtools.items() if name != "untagged.bam")
+    shutil.rmtree(samtools_dir, ignore_errors=True)
+    shutil.rmtree(native_dir, ignore_errors=True)
+
+
+def test_key_expression_split(small_bam, mapping_tsv):
+    def read_names(directory):
+        names = {}
+        for p in directory.rglob("*.bam"):
+            with pysam.AlignmentFile(str(p), "rb") as bam:
+                names[str(p.relative_to(directory))] = [read.query_name for read in bam]
+        return names
+
+    serial_dir = Path() / "keyed_files"
+    parallel_dir = Path() / "keyed_parallel_files"
+    shutil.rmtree(serial_dir, ignore_errors=True)
+    shutil.rmtree(parallel_dir, ignore_errors=True)
+    bamTagHandling(str(small_bam), output="keyed", mapping=str(mapping_tsv), delim="\t", keyExpression="celltype/xf",
+                   untagged=True, unmapped=True)
+    with pysam.AlignmentFile(str(small_bam), "rb") as bam:
+        xf_values = {str(read.get_tag("xf")) for read in bam.fetch(until_eof=True)}
+    assert {p.name for p in serial_dir.iterdir() if p.is_dir()} == {"Muscle", "Stem_A", "Stem_B"}
+    assert {p.name for p in serial_dir.glob("*/*.bam")} <= {f"keyed_xf_{v}.bam" for v in xf_values}
+
+    group_counts = pd.read_csv(serial_dir / "group_counts.tsv", sep="\t", dtype={"xf": str})
+    assert list(group_counts.columns) == ["celltype", "xf", "file", "reads"]
+    assert group_counts["reads"].sum() == 139
+    names = read_names(serial_dir)
+    assert all(len(names[f]) == n for f, n in zip(group_counts["file"], group_counts["reads"]))
+
+    bamTagHandling(str(small_bam), output="keyed_parallel", mapping=str(mapping_tsv), delim="\t", keyExpression="celltype/xf",
+                   untagged=True, unmapped=True, processes=2, shardSize=5_000_000)
+    parallel = {name.replace("keyed_parallel_", "keyed_"): reads for name, reads in read_names(parallel_dir).items()}
+    assert parallel == names
+    shutil.rmtree(serial_dir, ignore_errors=True)
+    shutil.rmtree(parallel_dir, ignore_errors=True)
+
+
+def test_key_expression_without_mapping(small_bam):
+    output_dir = Path() / "cb_ub_files"
+    shutil.rmtree(output_dir, ignore_errors=True)
+    bamTagHandling(str(small_bam), output="cb_ub", keyExpression="CB+UB")
+    group_counts = pd.read_csv(output_dir / "group_counts.tsv", sep="\t")
+    with pysam.AlignmentFile(str(small_bam), "rb") as bam:
+        pairs = [(read.get_tag("CB"), read.get_tag("UB")) for read in bam.fetch(until_eof=True) if read.has_tag("UB")]
+    assert len(group_counts) == len(set(pairs)) and group_counts["reads"].sum() == len(pairs)
+    assert (output_dir / f"cb_ub_CB_{pairs[0][0]}_UB_{pairs[0][1]}.bam").exists()
+    with pytest.raises(ValueError):
+        bamTagHandling(str(small_bam), output="cb_ub", keyExpression="celltype/UB")
+    with pytest.raises(ValueError):
+        bamTagHandling(str(small_bam), output="cb_ub", keyExpression="CB/barcode")
+    shutil.rmtree(output_dir, ignore_errors=True)
@@ -0,0 +1,52 @@
+# pylint: disable=redefined-outer-name
+from pathlib import Path
+
+import pysam
+import pytest
+
+from bam_manipulation.sort_merge_tagging import add_isoform_tags_streaming
+from bam_manipulation.wp3_add_custom_tags import add_isoform_tags, load_cluster_map, parse_args
+
+
+@pytest.fixture
+def small_bam():
+    return Path(__file__).parent / "test_data" / "possorted_genome_bam.sample.CB.bam"
+
+
+@pytest.fixture
+def cluster_tsv(small_bam):
+    with pysam.AlignmentFile(str(small_bam), "rb") as bam:
+        names = [read.query_name for read in bam]
+    path = Path() / "test_sort_merge_clusters.tsv"
+    with open(path, "w") as fh:
+        for i, name in enumerate(names[::-2]):
+            fh.write(f"{name}\tgene{i % 4}\ttx{i % 9}\n")
+        fh.write(f"{names[-1]}\tgene1\ttx_late\n")
+    yield path
+    path.unlink()
+
+
+def test_streaming_join_matches_in_memory(small_bam, cluster_tsv):
+    def tags(path):
+        with pysam.AlignmentFile(str(path), "rb") as bam:
+            return [(r.query_name, r.reference_id, r.reference_start, r.get_tag("IC") if r.has_tag("IC") else None)
+                    for r in bam]
+
+    expected_file = Path() / "test_in_memory.bam"
+    streaming_file = Path() / "test_streaming.bam"
+    add_isoform_tags(str(small_bam), str(expected_file), cluster_map=load_cluster_map(str(cluster_tsv)))
+    # A tiny budget forces many sorted runs on both sides of the join
+    add_isoform_tags_streaming(str(small_bam), str(streaming_file), str(cluster_tsv), memory_mb=0.002)
+    expected = tags(expected_file)
+    assert tags(streaming_file) == expected
+    assert any(ic for *_, ic in expected)
+    for path in (expected_file, streaming_file):
+        path.unlink()
+        Path(f"{path}.bai").unlink()
+
+
+def test_streaming_rejects_options_it_would_ignore():
+    assert parse_args(["-i", "in.bam", "-o", "out.bam", "-c", "clusters.tsv", "--streaming"]).streaming
+    for extra in (["--processes", "4"], ["--threads", "2"], ["--checkpoint"], ["--index", "idx"], ["--metrics_dir", "m"]):
+        with pytest.raises(SystemExit):
+            parse_args(["-i", "in.bam", "-o", "out.bam", "-c", "clusters.tsv", "--streaming", *extra])
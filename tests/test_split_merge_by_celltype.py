@@ -0,0 +1,77 @@
+# pylint: disable=redefined-outer-name
+from pathlib import Path
+import shutil
+
+import pandas as pd
+import pysam
+import pytest
+
+from bam_manipulation.split_merge_by_celltype import split_merge_by_celltype
+
+
+@pytest.fixture
+def small_bam():
+    return Path(__file__).parent / "test_data" / "possorted_genome_bam.sample.CB.bam"
+
+
+@pytest.fixture
+def multi_sample_mapping():
+    labeled = pd.read_csv(Path(__file__).parent / "test_data" / "cell_barcodes_labeled.tsv", sep="\t")
+    # sample2 only knows the Muscle barcodes
+    mapping = pd.concat([
+        labeled.assign(sample="sample1"),
+        labeled[labeled["Cluster"] == "Muscle"].assign(sample="sample2"),
+    ])
+    path = Path() / "test_cc_barcode.csv"
+    mapping.to_csv(path, index=False)
+    yield path
+    path.unlink()
+
+
+def test_split_merge_by_celltype(small_bam, multi_sample_mapping):
+    output_dir = Path() / "test_split_merged"
+    intermediate_dir = Path() / "test_split_intermediates"
+    shutil.rmtree(output_dir, ignore_errors=True)
+    shutil.rmtree(intermediate_dir, ignore_errors=True)
+    counts = split_merge_by_celltype(
+        {"Mira_1": small_bam, "Mira_2": small_bam},
+        str(multi_sample_mapping),
+        output_dir,
+        sample_map={"Mira_1": "sample1", "Mira_2": "sample2"},
+        intermediate_dir=intermediate_dir,
+    )
+    assert counts == {"Muscle": 94, "Stem A": 46, "Stem B": 46}
+    assert set(f.name for f in output_dir.iterdir()) == {"Muscle.bam", "Stem_A.bam", "Stem_B.bam"}
+    assert set(f.name for f in (intermediate_dir / "Mira_2_files").iterdir()) == {"Mira_2_Muscle.bam"}
+    with pysam.AlignmentFile(str(output_dir / "Muscle.bam"), "rb") as bam:
+        keys = [(r.reference_id if r.reference_id >= 0 else 1 << 30, r.reference_start) for r in bam]
+    assert len(keys) == 94
+    assert keys == sorted(keys)
+    shutil.rmtree(output_dir, ignore_errors=True)
+    shutil.rmtree(intermediate_dir, ignore_errors=True)
+
+
+def test_conflicting_read_groups_are_renamed(small_bam, multi_sample_mapping):
+    # A second sample whose read group has the same ID but describes another sample
+    other_bam = Path() / "test_split_merge_other_rg.bam"
+    with pysam.AlignmentFile(str(small_bam), "rb") as bam:
+        header = bam.header.to_dict()
+        rg_id = header["RG"][0]["ID"]
+        header["RG"][0]["SM"] = "other"
+        with pysam.AlignmentFile(str(other_bam), "wb", header=header) as out:
+            for read in bam:
+                out.write(pysam.AlignedSegment.fromstring(read.to_string(), out.header))
+    pysam.index(str(other_bam))
+
+    output_dir = Path() / "test_split_merged_rg"
+    shutil.rmtree(output_dir, ignore_errors=True)
+    split_merge_by_celltype({"Mira_1": small_bam, "Mira_2": other_bam}, str(multi_sample_mapping), output_dir,
+                            sample_map={"Mira_1": "sample1", "Mira_2": "sample2"})
+    with pysam.AlignmentFile(str(output_dir / "Muscle.bam"), "rb") as bam:
+        assert {rg["ID"]: rg["SM"] for rg in bam.header.to_dict()["RG"]} == {rg_id: "41427_4_10",
+                                                                           f"{rg_id}-Mira_2": "other"}
+        tags = [r.get_tag("RG") for r in bam if r.has_tag("RG")]
+    assert tags.count(rg_id) == tags.count(f"{rg_id}-Mira_2") == 47
+    shutil.rmtree(output_dir, ignore_errors=True)
+    other_bam.unlink()
+    Path(f"{other_bam}.bai").unlink()
@@ -1,6 +1,7 @@
 # pylint: disable=redefined-outer-name
 from pathlib import Path
 
+import pysam
 import pytest
 
 from bam_manipulation.wp3_add_ic_tag import main as add_ic_tag
@@ -19,3 +20,24 @@ def test_add_ic_tag_without_cluster_map(small_bam):
     assert output_file.exists()
     output_file.unlink()
     output_file_index.unlink()
+
+
+def test_add_ic_tag_parallel_matches_serial(small_bam):
+    cluster_file = Path() / "test_ic_clusters.tsv"
+    with pysam.AlignmentFile(str(small_bam), "rb") as bam:
+        with open(cluster_file, "w") as fh:
+            for i, read in enumerate(bam):
+                fh.write(f"{read.query_name}\t{i % 5 + 1}\n")
+    results = []
+    for label, extra in [("serial", []), ("parallel", ["--processes", "3", "--threads", "2"])]:
+        output_file = Path() / f"test_{label}.bam"
+        add_ic_tag(["-i", str(small_bam), "-o", str(output_file), "-c", str(cluster_file)] + extra)
+        assert Path(f"{output_file}.bai").exists()
+        with pysam.AlignmentFile(str(output_file), "rb") as bam:
+            results.append([(r.query_name, r.flag, r.reference_id, r.reference_start,
+                             r.get_tag("IC") if r.has_tag("IC") else None) for r in bam])
+            assert bam.mapped == 83
+        output_file.unlink()
+        Path(f"{output_file}.bai").unlink()
+    assert results[0] == results[1]
+    cluster_file.unlink()
@@ -0,0 +1,36 @@
+# pylint: disable=redefined-outer-name
+from collections import defaultdict
+from pathlib import Path
+import shutil
+
+import pysam
+import pytest
+
+from bam_manipulation.writer_pool import BamWriterPool
+
+
+@pytest.fixture
+def small_bam():
+    return Path(__file__).parent / "test_data" / "possorted_genome_bam.sample.CB.bam"
+
+
+def test_evicted_outputs_are_merged_in_order(small_bam):
+    output_dir = Path() / "test_writer_pool"
+    shutil.rmtree(output_dir, ignore_errors=True)
+    output_dir.mkdir()
+    expected = defaultdict(list)
+    with pysam.AlignmentFile(str(small_bam), "rb") as bam:
+        # Tiny buffers and two handles for five outputs forces evictions and multi-segment outputs
+        with BamWriterPool(bam.header, max_open=2, buffer_reads=3) as pool:
+            pool.touch(str(output_dir / "empty.bam"))
+            for i, read in enumerate(bam):
+                path = str(output_dir / f"out_{i % 5}.bam")
+                pool.write(path, read)
+                expected[path].append(read.query_name)
+    assert set(p.name for p in output_dir.iterdir()) == {f"out_{i}.bam" for i in range(5)} | {"empty.bam"}
+    for path, names in expected.items():
+        with pysam.AlignmentFile(path, "rb") as bam:
+            assert [read.query_name for read in bam] == names
+    with pysam.AlignmentFile(str(output_dir / "empty.bam"), "rb") as bam:
+        assert not list(bam)
+    shutil.rmtree(output_dir, ignore_errors=True)